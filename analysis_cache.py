@@ -0,0 +1,122 @@
+"""Content-addressed cache for local image analysis results.
+
+Results are keyed by a SHA-256 of the image bytes plus an analysis version
+string, so a re-upload of the same file is served without decoding it again
+and bumping the version invalidates every stored result. The cache has two
+tiers:
+
+* an in-memory LRU bounded by entry count and total serialized bytes
+* an optional SQLite file that survives restarts
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def content_key(image_bytes, version):
+    """Build the cache key for a blob of image bytes and an analysis version."""
+    return f"{version}:{hashlib.sha256(image_bytes).hexdigest()}"
+
+
+class AnalysisCache:
+    """Two-tier (memory LRU + optional SQLite) cache of analysis dicts.
+
+    Values are stored as JSON, so every hit returns a fresh copy that callers
+    may mutate freely. All methods are thread-safe.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, db_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """Create a cache configured from ANALYSIS_CACHE_* environment variables."""
+        return cls(
+            max_entries=int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "256")),
+            max_bytes=int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+            db_path=os.getenv("ANALYSIS_CACHE_PATH") or None,
+        )
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss."""
+        with self._lock:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return json.loads(blob)
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM analysis WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    blob = bytes(row[0])
+                    self._remember(key, blob)
+                    self._counters["disk_hits"] += 1
+                    return json.loads(blob)
+
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        """Store a JSON-serializable value under key in every tier."""
+        blob = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._remember(key, blob)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO analysis (key, value) VALUES (?, ?)", (key, blob)
+                )
+                self._db.commit()
+
+    def clear(self):
+        """Drop every entry from both tiers. Counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM analysis")
+                self._db.commit()
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current memory-tier usage."""
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["disk_hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hit_rate": (lookups - self._counters["misses"]) / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, blob):
+        """Insert into the memory tier and evict least-recently-used entries."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        if len(blob) > self.max_bytes:
+            # Too large to ever fit; keep it on disk only
+            return
+        self._entries[key] = blob
+        self._bytes += len(blob)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self._counters["evictions"] += 1
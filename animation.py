@@ -0,0 +1,159 @@
+"""Frame sampling for animated GIF, WebP and PNG (APNG) images.
+
+An animation is read in one sequential pass. Every frame has to be decoded,
+because GIF and APNG frames are drawn over the previous ones and animated
+WebP can only be decoded in order. Only the frames on screen at each sample
+time, every 1 / ANIMATION_SAMPLE_FPS seconds, are kept, shrunk to the
+working size. Memory is therefore bounded by ANIMATION_MAX_FRAMES working
+images rather than by the length of the animation:
+
+    ANIMATION_SAMPLE_FPS  samples per second of animation (default 2)
+    ANIMATION_MAX_FRAMES  most samples kept; longer animations are sampled
+                          more sparsely, evenly over their whole length
+                          (default 24)
+    ANIMATION_KEYFRAMES   frames in the montage sent to Gemini (default 4)
+
+image_analysis.py aggregates statistics over the samples, and
+captioning.py sends keyframe_montage() to Gemini instead of the frames.
+"""
+
+import math
+import os
+from collections import namedtuple
+
+from dotenv import load_dotenv
+from PIL import Image
+
+load_dotenv()
+
+ANIMATION_SAMPLE_FPS = float(os.getenv("ANIMATION_SAMPLE_FPS", "2"))
+ANIMATION_MAX_FRAMES = int(os.getenv("ANIMATION_MAX_FRAMES", "24"))
+ANIMATION_KEYFRAMES = int(os.getenv("ANIMATION_KEYFRAMES", "4"))
+
+# Browsers show frames with a delay under 20 ms (including 0) for 100 ms
+MIN_FRAME_DURATION_MS = 20
+DEFAULT_FRAME_DURATION_MS = 100
+
+# Gap between montage cells, in pixels
+MONTAGE_GUTTER = 4
+
+FrameSample = namedtuple("FrameSample", ["time_ms", "index", "image"])
+FrameSample.__doc__ = """The frame on screen at one sample time.
+
+time_ms is the sample time from the start of the animation, index the
+frame number and image the frame in RGB, shrunk to the working size. A
+frame on screen at several sample times is one shared image.
+"""
+
+
+def is_animated(img):
+    """Whether an opened image has more than one frame."""
+    return getattr(img, "is_animated", False)
+
+
+def frame_duration(img):
+    """Display time in ms of the current (loaded) frame."""
+    duration = img.info.get("duration") or 0
+    return duration if duration >= MIN_FRAME_DURATION_MS else DEFAULT_FRAME_DURATION_MS
+
+
+def _flatten(frame):
+    """RGB copy of a frame; transparent areas become white, as in most viewers."""
+    if frame.mode in ("RGBA", "LA") or (frame.mode == "P" and "transparency" in frame.info):
+        rgba = frame.convert("RGBA")
+        flat = Image.new("RGB", rgba.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel("A"))
+        return flat
+    return frame.convert("RGB")
+
+
+def sample_frames(img, max_edge=0, fps=None, max_frames=None):
+    """Sample an animation at fixed time steps in one pass over its frames.
+
+    Whenever more than max_frames samples would be kept, every other one is
+    dropped and the step doubles, so the samples stay evenly spaced over the
+    whole animation without knowing its length in advance.
+
+    Args:
+        img: Opened animated image, positioned anywhere; left at its last frame
+        max_edge: Longest edge of the kept frames (0 keeps full size)
+        fps: Samples per second, defaults to ANIMATION_SAMPLE_FPS
+        max_frames: Most samples kept, defaults to ANIMATION_MAX_FRAMES
+
+    Returns:
+        tuple: (samples, interval_ms, duration_ms) where samples is a list of
+        FrameSample, interval_ms the final sampling step and duration_ms the
+        length of one loop of the animation
+    """
+    interval = 1000 / (fps or ANIMATION_SAMPLE_FPS)
+    max_frames = max(1, max_frames or ANIMATION_MAX_FRAMES)
+    samples = []
+    start = 0
+    for index in range(getattr(img, "n_frames", 1)):
+        img.seek(index)
+        img.load()
+        end = start + frame_duration(img)
+        frame = None
+        # Sample k is taken at k * interval
+        while len(samples) * interval < end:
+            if frame is None:
+                frame = _flatten(img)
+                if max_edge:
+                    frame.thumbnail((max_edge, max_edge), reducing_gap=2.0)
+            samples.append(FrameSample(round(len(samples) * interval), index, frame))
+            if len(samples) > max_frames:
+                samples = samples[::2]
+                interval *= 2
+        start = end
+    return samples, interval, start
+
+
+def keyframes(samples, count=None):
+    """Up to count distinct frames spread evenly over the samples, in order."""
+    count = count or ANIMATION_KEYFRAMES
+    distinct = []
+    for sample in samples:
+        if not distinct or sample.index != distinct[-1].index:
+            distinct.append(sample)
+    if len(distinct) <= count:
+        return distinct
+    if count == 1:
+        return distinct[:1]
+    step = (len(distinct) - 1) / (count - 1)
+    return [distinct[round(i * step)] for i in range(count)]
+
+
+def montage(frames, max_edge):
+    """Tile frames into one RGB grid no larger than max_edge on its longest edge."""
+    columns = math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / columns)
+    width, height = frames[0].size
+    scale = min(1.0, (max_edge - MONTAGE_GUTTER * (columns - 1)) / (columns * width),
+                (max_edge - MONTAGE_GUTTER * (rows - 1)) / (rows * height))
+    cell = (max(1, round(width * scale)), max(1, round(height * scale)))
+    grid = Image.new("RGB", (columns * cell[0] + MONTAGE_GUTTER * (columns - 1),
+                             rows * cell[1] + MONTAGE_GUTTER * (rows - 1)), (255, 255, 255))
+    for i, frame in enumerate(frames):
+        row, column = divmod(i, columns)
+        tile = frame if frame.size == cell else frame.resize(cell, Image.Resampling.LANCZOS)
+        grid.paste(tile, (column * (cell[0] + MONTAGE_GUTTER), row * (cell[1] + MONTAGE_GUTTER)))
+    return grid
+
+
+def keyframe_montage(img, max_edge, count=None):
+    """Grid of an animation's keyframes, read left to right, top to bottom.
+
+    Args:
+        img: Opened animated image
+        max_edge: Longest edge of the montage
+        count: Keyframes to include, defaults to ANIMATION_KEYFRAMES
+
+    Returns:
+        tuple: (montage, keyframe_count)
+    """
+    count = count or ANIMATION_KEYFRAMES
+    columns = math.ceil(math.sqrt(count))
+    # Frames only need to be as large as their cell
+    samples, _, _ = sample_frames(img, max_edge=max(1, max_edge // columns))
+    frames = [sample.image for sample in keyframes(samples, count)]
+    return montage(frames, max_edge), len(frames)
@@ -1,448 +1,449 @@
 import streamlit as st
-from PIL import Image, ImageStat, ImageFilter
-import io
-import random
-import colorsys
 import os
-import base64
-from dotenv import load_dotenv
+import time
+import uuid
+from image_analysis import LOCAL_ANALYSIS_STAGES
+from batch import IMAGE_EXTENSIONS, iter_batch_items, run_batch, rows_to_csv, rows_to_jsonl
+from captioning import (
+    GEMINI_AVAILABLE,
+    caption_with_gemini,
+    compose_gemini_prompt,
+    find_near_duplicate_analysis,
+    find_near_duplicate_caption,
+    fingerprint_image,
+    format_local_report,
+    generate_caption,
+    generate_caption_stream,
+    generate_caption_variants,
+    get_mood_prompts,
+    get_results_index,
+    local_caption,
+    preload_gemini,
+)
+from job_queue import FINISHED_STATUSES, JOB_POLL_INTERVAL, get_job_queue
+from metrics import METRICS_ADMIN_PANEL, get_metrics, render_prometheus, stage_timer
+from uploads import ImageUpload, MemoryLedger, UploadRejected
 
-# Load environment variables
-load_dotenv()
+PLATFORM_OPTIONS = ["Instagram", "Twitter/X", "LinkedIn", "Facebook", "TikTok", "Pinterest", "YouTube", "Generic"]
+TONE_OPTIONS = ["Professional", "Friendly", "Humorous", "Inspirational", "Bold", "Elegant", "Playful", "Minimal"]
+LENGTH_OPTIONS = ["Short", "Medium", "Long"]
+# Largest platform x tone x length fan-out sent as one request
+MAX_FANOUT_VARIANTS = 12
+JOB_LABELS = {"analysis": "📊 Analysis", "caption": "🤖 Caption", "variants": "🔀 Variants"}
+# Rows shown for one search
+SEARCH_LIMIT = 200
 
-# Optional import for Google Gemini
-try:
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
-except ImportError:
-    GEMINI_AVAILABLE = False
+def st_notify(level, message):
+    """Show a captioning message in the current Streamlit session."""
+    getattr(st, level)(message)
 
-def generate_caption_with_gemini(image_bytes, prompt=None):
-    """
-    Generate a caption for an image using Google's Gemini multimodal model.
-    
-    Args:
-        image_bytes: The binary image data
-        prompt: Custom prompt to guide the caption generation
-        
-    Returns:
-        str: A caption for the image generated by Gemini
+def upload_fingerprint(file_id, image_bytes):
+    """Perceptual fingerprint of an upload, computed once per file (None if dedup is off)."""
+    fingerprints = st.session_state.setdefault('fingerprints', {})
+    if file_id not in fingerprints:
+        fingerprints[file_id] = fingerprint_image(image_bytes)
+    return fingerprints[file_id]
+
+def get_upload(uploaded, slot):
+    """The ImageUpload for a file uploader's current file, created once per file.
+
+    One upload is kept per slot (tab); the previous file's memory is released
+    when it is replaced or removed. Returns None if nothing is uploaded or the
+    file was rejected (the reason is shown).
     """
-    try:
-        # Check if the API key is available
-        api_key = os.getenv("GOOGLE_GEMINI_API_KEY")
-        # Print debug info to console (not visible to user)
-        print(f"API Key exists: {bool(api_key)}, Value: {api_key[:5]}..." if api_key else "API Key not found")
-        if not api_key:
-            return "⚠️ Gemini API key not configured. Please add your API key to the .env file."
-        
-        # Configure the Gemini API client
-        genai.configure(api_key=api_key)
-        
-        # Select a supported vision model with robust fallbacks
-        model_candidates = [
-            'gemini-1.5-flash-latest',
-            'gemini-1.5-pro-latest',
-            'gemini-1.0-pro-vision-latest',
-            'gemini-pro-vision',
-        ]
-        model = None
-        last_error = None
-        for name in model_candidates:
-            try:
-                model = genai.GenerativeModel(name)
-                st.info(f"Using Gemini model: {name}")
-                break
-            except Exception as e:
-                last_error = e
-                continue
-        if model is None:
-            st.error(f"Unable to initialize a Gemini vision model. Last error: {last_error}")
-            return "Gemini model initialization failed. Please check your API access and model availability."
-        
-        # Default prompt if none provided
-        if not prompt:
-            prompt = "Generate a detailed, creative caption for this image that would work well on social media."
-        
-        # Convert image bytes to mime-encoded format for the API
-        mime_type = "image/jpeg"  # Default, but we could detect this from the image
-        image_parts = [
-            {
-                "inline_data": {
-                    "mime_type": mime_type,
-                    "data": base64.b64encode(image_bytes).decode("utf-8")
-                }
-            }
-        ]
-        
+    uploads = st.session_state.setdefault('uploads', {})
+    ledger = st.session_state.setdefault('upload_memory', MemoryLedger())
+    current = uploads.get(slot)
+    if current is not None and (uploaded is None or current[0] != uploaded.file_id):
+        current[1].release()
+        del uploads[slot]
+        current = None
+    if uploaded is None:
+        return None
+    if current is None:
         try:
-            # Generate the caption
-            generation_config = {
-                "temperature": 0.7,
-                "top_p": 1,
-                "top_k": 32,
-                "max_output_tokens": 1024,
-            }
-            
-            safety_settings = [
-                {
-                    "category": "HARM_CATEGORY_HARASSMENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_HATE_SPEECH",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-            ]
-            
-            response = model.generate_content(
-                contents=[prompt, image_parts[0]],
-                generation_config=generation_config,
-                safety_settings=safety_settings,
-            )
-            
-            # Extract and return the caption
-            if hasattr(response, 'text'):
-                return response.text.strip()
-            elif hasattr(response, 'parts'):
-                return ''.join(part.text for part in response.parts)
-            else:
-                return str(response)
-                
-        except Exception as gen_error:
-            st.error(f"Error during content generation: {str(gen_error)}")
-            return f"Unable to generate caption with the current model. Error: {str(gen_error)}"
-    
-    except Exception as e:
-        error_message = f"Error generating caption with Gemini: {str(e)}"
-        # Print detailed error for debugging
-        print(f"DETAILED ERROR: {type(e).__name__}: {e}")
-        st.error(error_message)
-        return f"Unable to generate caption with Gemini. Error: {str(e)}"
-
-def analyze_image_detailed(image_bytes):
+            # getvalue() shares the uploaded buffer; read() or getbuffer() may copy it
+            upload = ImageUpload(uploaded.getvalue(), ledger=ledger)
+        except UploadRejected as e:
+            st.error(f"🚫 {e}")
+            return None
+        current = uploads[slot] = (uploaded.file_id, upload)
+    return current[1]
+
+# File types the single-image uploaders accept (APNG is usually saved as .png)
+UPLOAD_TYPES = [extension.lstrip(".") for extension in IMAGE_EXTENSIONS]
+
+def preview_caption(upload):
+    """Caption under an upload's preview; animations show their first frame."""
+    if upload.animated:
+        return f"🎞️ Animated {upload.format}, {upload.frame_count} frames (first frame shown)"
+    return ""
+
+def show_upload_memory():
+    """Caption with this session's upload memory, current and peak."""
+    ledger = st.session_state.get('upload_memory')
+    if ledger is not None:
+        st.caption(
+            f"🧠 Upload memory this session: {ledger.current / (1024 * 1024):.1f} MB now, "
+            f"{ledger.peak / (1024 * 1024):.1f} MB peak"
+        )
+
+def client_id():
+    """Id the background jobs of this browser tab are filed under.
+
+    Kept in the URL, so a page reload still finds the jobs it submitted.
     """
-    Perform detailed offline image analysis for comprehensive image reading.
-    
-    Args:
-        image_bytes: The binary image data
-        
-    Returns:
-        dict: Detailed analysis results
+    if "client" not in st.query_params:
+        st.query_params["client"] = uuid.uuid4().hex
+    return st.query_params["client"]
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def wait_for_jobs(job_ids, compact=False):
+    """Show that jobs are pending, polling the queue; reruns the page once any has finished."""
+    jobs = [get_job_queue().get(job_id) for job_id in job_ids]
+    if any(job is None or job.status in FINISHED_STATUSES for job in jobs):
+        st.rerun()
+    queued = sum(job.status == "queued" for job in jobs)
+    message = f"⏳ {len(jobs) - queued} running, {queued} waiting for a worker"
+    if compact:
+        st.caption(message)
+    else:
+        st.info(message + " — you can keep working, or reload the page and find the result under Background Jobs.")
+
+def finished_job(job_id):
+    """The job if it has finished; otherwise shows its progress and returns None."""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        st.error("This background job no longer exists.")
+    elif job.status not in FINISHED_STATUSES:
+        wait_for_jobs((job_id,))
+        return None
+    return job
+
+def render_job_result(job):
+    """Show a finished job's result."""
+    if job.status == "failed":
+        st.error(job.error)
+    elif job.kind == "analysis":
+        st.markdown(job.result["report"])
+    elif job.kind == "caption":
+        st.success(job.result["caption"])
+    else:
+        for variant in job.result["variants"]:
+            st.markdown(f"**{variant['platform']} · {variant['tone']} · {variant['length']}**")
+            st.success(variant['caption'])
+
+def render_jobs_panel():
+    """Sidebar list of this browser tab's recent background jobs and their results."""
+    jobs = get_job_queue().list_jobs(client_id(), limit=10)
+    if not jobs:
+        return
+    with st.sidebar:
+        st.header("📬 Background Jobs")
+        pending = tuple(job.id for job in jobs if job.status not in FINISHED_STATUSES)
+        if pending:
+            wait_for_jobs(pending, compact=True)
+        for job in jobs:
+            submitted = time.strftime("%H:%M:%S", time.localtime(job.created))
+            with st.expander(f"{JOB_LABELS[job.kind]} · {job.status} · {submitted}"):
+                if job.status in FINISHED_STATUSES:
+                    render_job_result(job)
+                else:
+                    st.caption(f"Attempt {job.attempts}" if job.attempts else "Queued")
+
+def gemini_result(file_id):
+    """The last Gemini result for this upload, or None.
+
+    Results persist across reruns, so changing an option no longer throws the
+    caption away; they are dropped once a different file is uploaded.
     """
-    try:
-        # Open the image
-        img = Image.open(io.BytesIO(image_bytes))
-        
-        # Basic properties
-        width, height = img.size
-        format_name = img.format if img.format else "Unknown"
-        mode = img.mode
-        aspect_ratio = width / height
-        total_pixels = width * height
-        
-        # Determine orientation
-        if aspect_ratio > 1.2:
-            orientation = "Landscape"
-        elif aspect_ratio < 0.8:
-            orientation = "Portrait"
-        else:
-            orientation = "Square"
-        
-        # Color analysis
-        is_color = img.mode in ("RGB", "RGBA", "CMYK")
-        color_analysis = {}
-        
-        if is_color:
-            # Convert to RGB for analysis
-            if img.mode != "RGB":
-                img_rgb = img.convert("RGB")
-            else:
-                img_rgb = img
-                
-            # Resize for faster processing
-            img_small = img_rgb.resize((100, 100))
-            
-            # Get color statistics
-            stat = ImageStat.Stat(img_small)
-            r, g, b = stat.mean
-            
-            # Calculate brightness and contrast
-            brightness = (0.299 * r + 0.587 * g + 0.114 * b) / 255
-            contrast = max(stat.stddev) / 255
-            
-            # Dominant colors analysis
-            img_quantized = img_small.quantize(colors=8)
-            palette = img_quantized.getpalette()
-            color_counts = img_quantized.getcolors()
-            
-            dominant_colors = []
-            if palette and color_counts:
-                color_counts.sort(reverse=True)
-                
-                for count, color_index in color_counts[:5]:
-                    r, g, b = palette[color_index*3:color_index*3+3]
-                    percentage = (count / (100 * 100)) * 100
-                    
-                    # Convert RGB to HSV for better color naming
-                    h, s, v = colorsys.rgb_to_hsv(r/255, g/255, b/255)
-                    
-                    # Enhanced color naming
-                    if s < 0.1:
-                        if v < 0.3: color_name = "Black"
-                        elif v > 0.8: color_name = "White"
-                        else: color_name = "Gray"
-                    elif h < 0.05 or h > 0.95: color_name = "Red"
-                    elif 0.05 <= h < 0.15: color_name = "Orange"
-                    elif 0.15 <= h < 0.22: color_name = "Yellow"
-                    elif 0.22 <= h < 0.41: color_name = "Green"
-                    elif 0.41 <= h < 0.55: color_name = "Teal"
-                    elif 0.55 <= h < 0.75: color_name = "Blue"
-                    elif 0.75 <= h < 0.82: color_name = "Purple"
-                    else: color_name = "Pink"
-                    
-                    # Add intensity and tone
-                    if color_name not in ["Black", "White", "Gray"]:
-                        if s < 0.4: color_name = f"Pale {color_name}"
-                        elif s > 0.8: color_name = f"Vibrant {color_name}"
-                        if v < 0.4: color_name = f"Dark {color_name}"
-                    
-                    dominant_colors.append({
-                        "name": color_name,
-                        "percentage": round(percentage, 1),
-                        "rgb": (r, g, b)
-                    })
-            
-            color_analysis = {
-                "is_color": True,
-                "brightness": round(brightness * 100, 1),
-                "contrast": round(contrast * 100, 1),
-                "dominant_colors": dominant_colors,
-                "brightness_level": "Dark" if brightness < 0.3 else "Bright" if brightness > 0.7 else "Balanced",
-                "contrast_level": "Low" if contrast < 0.2 else "High" if contrast > 0.5 else "Medium"
-            }
-        else:
-            color_analysis = {
-                "is_color": False,
-                "mode": "Grayscale/Black & White"
-            }
-        
-        # Edge and complexity analysis
-        edge_img = img.convert("L").filter(ImageFilter.FIND_EDGES)
-        edge_stat = ImageStat.Stat(edge_img)
-        edge_mean = edge_stat.mean[0]
-        
-        complexity_level = "Simple/Minimalist" if edge_mean < 20 else "Detailed/Complex" if edge_mean > 50 else "Well-Composed"
-        
-        # File size estimation (approximate)
-        file_size_kb = len(image_bytes) / 1024
-        
-        # Aspect ratio classification
-        if aspect_ratio > 2.5:
-            aspect_class = "Ultra-wide/Panoramic"
-        elif aspect_ratio > 1.5:
-            aspect_class = "Wide"
-        elif aspect_ratio > 1.1:
-            aspect_class = "Standard Landscape"
-        elif aspect_ratio > 0.9:
-            aspect_class = "Square"
-        elif aspect_ratio > 0.7:
-            aspect_class = "Standard Portrait"
-        elif aspect_ratio > 0.4:
-            aspect_class = "Tall Portrait"
-        else:
-            aspect_class = "Ultra-tall"
-        
-        return {
-            "basic_info": {
-                "dimensions": f"{width} × {height} pixels",
-                "orientation": orientation,
-                "aspect_ratio": round(aspect_ratio, 2),
-                "aspect_class": aspect_class,
-                "total_pixels": f"{total_pixels:,}",
-                "file_format": format_name,
-                "color_mode": mode,
-                "file_size": f"{file_size_kb:.1f} KB"
-            },
-            "color_analysis": color_analysis,
-            "complexity": {
-                "level": complexity_level,
-                "edge_density": round(edge_mean, 1)
-            }
-        }
-        
-    except Exception as e:
-        return {"error": f"Error analyzing image: {str(e)}"}
-
-def get_mood_prompts():
-    """Get mood-based prompt templates for caption generation."""
-    return {
-        "Professional": "Generate a professional, business-appropriate caption for this image that would work well for corporate social media.",
-        "Casual/Friendly": "Create a casual, friendly caption that feels personal and relatable for everyday social media posts.",
-        "Creative/Artistic": "Write an artistic, creative caption that focuses on the aesthetic and emotional aspects of this image.",
-        "Humorous/Funny": "Generate a humorous, light-hearted caption that could make people smile or laugh.",
-        "Inspirational": "Create an uplifting, motivational caption that inspires and encourages viewers.",
-        "Travel/Adventure": "Write a travel-focused caption that captures the sense of adventure and wanderlust.",
-        "Food/Culinary": "Generate a mouth-watering caption perfect for food photography and culinary content.",
-        "Fashion/Style": "Create a stylish, fashion-forward caption that highlights the aesthetic and trendiness.",
-        "Nature/Outdoor": "Write a caption that celebrates nature, outdoor beauty, and environmental appreciation.",
-        "Minimalist": "Generate a clean, simple caption that matches a minimalist aesthetic.",
-        "Gen Z/Social Media": "Create a trendy, Gen Z style caption with relevant hashtags and social media language.",
-        "Custom": "Custom prompt"
-    }
-
-def compose_gemini_prompt(
-    base_prompt: str,
-    platform: str,
-    tone: str,
-    length: str,
-    include_hashtags: bool,
-    num_hashtags: int,
-    include_emojis: bool,
-    num_emojis: int,
-    keywords_csv: str,
-    audience: str,
-    call_to_action: str
-) -> str:
-    """Compose a detailed prompt for Gemini based on user-selected options.
-
-    The function appends clear, actionable instructions so the model tailors
-    its caption output to the desired platform, tone, and formatting.
+    result = st.session_state.get('gemini_result')
+    return result if result is not None and result['file_id'] == file_id else None
+
+@st.fragment
+def gemini_caption_panel(file_id, upload):
+    """Caption options, generation and results for the current Gemini upload.
+
+    Runs as a fragment: changing an option reruns only this panel (composing
+    the prompt again) instead of the whole script with its image preview.
     """
-    instructions = [base_prompt]
-
-    # Core style constraints
-    if platform and platform != "Generic":
-        instructions.append(f"Target the '{platform}' platform and follow its best practices.")
-    if tone:
-        instructions.append(f"Use a {tone.lower()} tone.")
-    if length:
-        instructions.append(f"Keep the caption {length.lower()} in length.")
-
-    # Formatting controls
-    if include_hashtags:
-        instructions.append(
-            f"Include up to {num_hashtags} concise, relevant hashtags at the end (no spaces inside hashtags)."
+    with stage_timer("caption_panel", pipeline="ui"):
+        _gemini_caption_panel(file_id, upload)
+
+def _gemini_caption_panel(file_id, upload):
+    image_bytes = upload.data
+    mood_options = list(get_mood_prompts().keys())
+    mood_type = st.selectbox(
+        "Choose caption style/mood:",
+        mood_options,
+        index=0,
+        help="Select the style that best matches your intended use for the caption"
+    )
+
+    mood_prompts = get_mood_prompts()
+    base_prompt = (
+        st.text_area(
+            "Custom Prompt:",
+            value="Generate a detailed, creative caption for this image that would work well on social media.",
+            height=100,
+            help="Write your own custom prompt to guide the AI caption generation"
         )
-    else:
-        instructions.append("Do not include any hashtags.")
+        if mood_type == "Custom" else mood_prompts[mood_type]
+    )
 
-    if include_emojis:
-        instructions.append(f"Use up to {num_emojis} relevant emojis for tone and emphasis.")
-    else:
-        instructions.append("Do not include any emojis.")
+    with st.expander("Caption options", expanded=True):
+        colA, colB = st.columns(2)
+        with colA:
+            platform = st.selectbox("Platform", PLATFORM_OPTIONS, index=0)
+            tone = st.selectbox("Tone", TONE_OPTIONS, index=0)
+            length = st.selectbox("Length", LENGTH_OPTIONS, index=0)
+            audience = st.text_input("Target audience (optional)")
+        with colB:
+            include_hashtags = st.checkbox("Include hashtags", value=True)
+            num_hashtags = st.slider("Number of hashtags", 0, 8, 3)
+            include_emojis = st.checkbox("Include emojis", value=True)
+            num_emojis = st.slider("Number of emojis", 0, 5, 2)
+            keywords_csv = st.text_input("Keywords (comma-separated)")
+            call_to_action = st.text_input("Call-to-action (optional)")
 
-    # Content constraints
-    if keywords_csv.strip():
-        instructions.append(
-            "Naturally incorporate these keywords if appropriate: " + keywords_csv.strip()
+    with st.expander("Multiple variants", expanded=False):
+        fan_out = st.checkbox(
+            "Generate one caption per platform / tone / length combination",
+            key="fan_out_gemini",
+            help="All combinations are written in a single Gemini request with one image upload"
         )
-    if audience.strip():
-        instructions.append(f"Write for this audience: {audience.strip()}.")
-    if call_to_action.strip():
-        instructions.append(f"End with a subtle call-to-action: {call_to_action.strip()}.")
-
-    # Safety and output format guidance
-    instructions.append(
-        "Return only the final caption text without explanations. Keep it readable and persuasive."
+        variant_platforms = st.multiselect("Platforms", PLATFORM_OPTIONS, default=[platform])
+        variant_tones = st.multiselect("Tones", TONE_OPTIONS, default=[tone])
+        variant_lengths = st.multiselect("Lengths", LENGTH_OPTIONS, default=[length])
+        variants = [
+            {"platform": p, "tone": t, "length": n}
+            for p in variant_platforms for t in variant_tones for n in variant_lengths
+        ]
+        if fan_out and len(variants) > MAX_FANOUT_VARIANTS:
+            st.warning(f"{len(variants)} combinations selected; only the first {MAX_FANOUT_VARIANTS} will be generated.")
+            variants = variants[:MAX_FANOUT_VARIANTS]
+
+    prompt_options = dict(
+        base_prompt=base_prompt,
+        include_hashtags=include_hashtags,
+        num_hashtags=num_hashtags,
+        include_emojis=include_emojis,
+        num_emojis=num_emojis,
+        keywords_csv=keywords_csv,
+        audience=audience,
+        call_to_action=call_to_action,
     )
+    composed_prompt = compose_gemini_prompt(platform=platform, tone=tone, length=length, **prompt_options)
 
-    return "\n".join(instructions)
+    near_duplicate = find_near_duplicate_caption(
+        upload_fingerprint(file_id, image_bytes), composed_prompt
+    )
+    reuse_caption = near_duplicate is not None and st.checkbox(
+        f"♻️ Reuse the caption of a near-duplicate image for this prompt "
+        f"(Hamming distance {near_duplicate[1]}) instead of calling Gemini",
+        value=True, key="reuse_gemini_caption",
+    )
 
-def generate_caption(image_bytes, caption_source="local", custom_prompt=None, mood_type="Professional"):
-    """
-    Generate a caption for an image using either local analysis or Gemini.
-    
-    Args:
-        image_bytes: The binary image data
-        caption_source: "local" for offline processing, "gemini" for AI-generated captions
-        custom_prompt: Custom prompt for Gemini (ignored for local captions)
-        mood_type: Mood/style for caption generation
-        
-    Returns:
-        str: A descriptive caption for the image
-    """
-    # If Gemini is selected and available, use it
-    if caption_source == "gemini":
-        if GEMINI_AVAILABLE:
-            # Use mood-based prompts
-            mood_prompts = get_mood_prompts()
-            if mood_type in mood_prompts and mood_type != "Custom":
-                prompt = mood_prompts[mood_type]
-            elif custom_prompt:
-                prompt = custom_prompt
-            else:
-                prompt = mood_prompts["Professional"]
-            
-            return generate_caption_with_gemini(image_bytes, prompt)
+    col_generate, col_regenerate = st.columns(2)
+    with col_generate:
+        generate_clicked = st.button("Generate Caption", key="generate_gemini")
+    with col_regenerate:
+        regenerate_clicked = st.button(
+            "🔄 Regenerate", key="regenerate_gemini",
+            help="Skip the caption cache and ask Gemini for a new variant"
+        )
+    queue = get_job_queue()
+    # Streaming needs the live connection, so it's off when jobs run in the background
+    stream_caption = queue is None and st.toggle(
+        "Stream response", value=True, key="stream_gemini",
+        help="Show the caption word by word as Gemini writes it"
+    )
+
+    # What a result was generated from, to tell when the options have moved on
+    request = repr((prompt_options, variants)) if fan_out and variants else composed_prompt
+
+    def on_upload(stats):
+        result['upload_stats'] = stats
+
+    streamed = False
+    result = gemini_result(file_id)
+    if fan_out and variants and (generate_clicked or regenerate_clicked):
+        result = st.session_state['gemini_result'] = {'file_id': file_id, 'request': request}
+        if queue is not None:
+            result['job'] = queue.submit("variants", image_bytes, {
+                "variants": variants, "prompt_options": prompt_options, "use_cache": not regenerate_clicked,
+            }, owner=client_id())
         else:
-            st.warning("Google Generative AI package not installed. Run 'pip install google-generativeai'")
-            st.info("Falling back to local caption generation.")
-    
-    # Local caption generation (enhanced)
-    try:
-        # Get detailed analysis
-        analysis = analyze_image_detailed(image_bytes)
-        
-        if "error" in analysis:
-            return f"Error analyzing image: {analysis['error']}"
-        
-        basic_info = analysis["basic_info"]
-        color_analysis = analysis["color_analysis"]
-        complexity = analysis["complexity"]
-        
-        # Build comprehensive description
-        description_parts = []
-        
-        # Basic info
-        description_parts.append(f"📐 **Image Dimensions**: {basic_info['dimensions']} ({basic_info['orientation']})")
-        description_parts.append(f"📊 **Aspect Ratio**: {basic_info['aspect_ratio']} ({basic_info['aspect_class']})")
-        description_parts.append(f"🎨 **Format**: {basic_info['file_format']} • **Mode**: {basic_info['color_mode']}")
-        description_parts.append(f"💾 **File Size**: {basic_info['file_size']} • **Pixels**: {basic_info['total_pixels']}")
-        
-        # Color analysis
-        if color_analysis.get("is_color", False):
-            description_parts.append(f"🌈 **Color Analysis**:")
-            description_parts.append(f"   • Brightness: {color_analysis['brightness']}% ({color_analysis['brightness_level']})")
-            description_parts.append(f"   • Contrast: {color_analysis['contrast']}% ({color_analysis['contrast_level']})")
-            
-            if color_analysis.get('dominant_colors'):
-                color_list = []
-                for color in color_analysis['dominant_colors'][:3]:
-                    color_list.append(f"{color['name']} ({color['percentage']}%)")
-                description_parts.append(f"   • Dominant Colors: {', '.join(color_list)}")
+            with st.spinner(f"Generating {len(variants)} caption variants with Gemini AI..."):
+                result['variants'] = generate_caption_variants(
+                    image_bytes,
+                    variants,
+                    prompt_options,
+                    use_cache=not regenerate_clicked,
+                    on_upload=on_upload,
+                    notify=st_notify,
+                    upload=upload,
+                )
+    elif generate_clicked and reuse_caption:
+        result = st.session_state['gemini_result'] = {'file_id': file_id, 'request': request}
+        result['caption'] = near_duplicate[0]
+    elif generate_clicked or regenerate_clicked:
+        result = st.session_state['gemini_result'] = {'file_id': file_id, 'request': request}
+        if queue is not None:
+            result['job'] = queue.submit("caption", image_bytes, {
+                "prompt": composed_prompt, "use_cache": not regenerate_clicked,
+            }, owner=client_id())
+        elif stream_caption:
+            st.markdown("### 🎨 Generated Caption")
+            result['caption'] = st.write_stream(generate_caption_stream(
+                image_bytes,
+                composed_prompt,
+                use_cache=not regenerate_clicked,
+                on_upload=on_upload,
+                notify=st_notify,
+                upload=upload,
+            )).strip()
+            streamed = True
         else:
-            description_parts.append("🎭 **Color Mode**: Black & White/Grayscale")
-        
-        # Complexity
-        description_parts.append(f"🔍 **Visual Complexity**: {complexity['level']} (Edge Density: {complexity['edge_density']})")
-        
-        # Generate a simple caption
-        descriptors = ["striking", "captivating", "interesting", "compelling", "eye-catching", "engaging"]
-        descriptor = random.choice(descriptors)
-        
-        if color_analysis.get("is_color", False):
-            primary_color = color_analysis['dominant_colors'][0]['name'].lower() if color_analysis.get('dominant_colors') else "balanced"
-            caption = f"A {descriptor} {basic_info['orientation'].lower()} image with {primary_color} tones. This {complexity['level'].lower()} composition shows careful visual balance and {color_analysis['brightness_level'].lower()} lighting."
+            with st.spinner(f"Generating {mood_type.lower()} caption with Gemini AI..."):
+                result['caption'] = generate_caption(
+                    image_bytes,
+                    caption_source="gemini",
+                    custom_prompt=composed_prompt,
+                    mood_type="Custom",
+                    use_cache=not regenerate_clicked,
+                    on_upload=on_upload,
+                    notify=st_notify,
+                    upload=upload,
+                )
+
+    if result is None:
+        return
+    if 'job' in result:
+        job = finished_job(result['job'])
+        if job is None:
+            return
+        del result['job']
+        if job.status == "failed":
+            result['error'] = job.error
         else:
-            caption = f"A {descriptor} {basic_info['orientation'].lower()} black and white image. This {complexity['level'].lower()} composition demonstrates strong contrast and timeless appeal."
-        
-        description_parts.append(f"\n📝 **Generated Caption**:\n{caption}")
-        
-        return "\n".join(description_parts)
-    
-    except Exception as e:
-        # Handle any errors gracefully
-        st.error(f"Error generating caption: {str(e)}")
-        return f"An image was uploaded. (Error during analysis: {str(e)})"
+            result.update(job.result)
+    if 'error' in result:
+        st.error(result['error'])
+        return
+    if not streamed and result['request'] != request:
+        st.caption("✏️ The options have changed since this was generated; generate again to apply them.")
+
+    if 'variants' in result:
+        st.markdown("### 🎨 Generated Captions")
+        for variant in result['variants']:
+            st.markdown(f"**{variant['platform']} · {variant['tone']} · {variant['length']}**")
+            st.success(variant['caption'])
+        fallbacks = sum(variant['fallback'] for variant in result['variants'])
+        st.caption(
+            "🤖 Captions generated using Google's Gemini AI in one request"
+            + (f" ({fallbacks} retried individually)" if fallbacks else "")
+        )
+
+    if 'caption' in result:
+        if not streamed:
+            # A streamed caption is already on the page
+            st.markdown("### 🎨 Generated Caption")
+            st.success(result['caption'])
+        st.caption("🤖 Caption generated using Google's Gemini AI")
+        upload_stats = result.get('upload_stats')
+        if upload_stats:
+            keyframes = upload_stats.get('keyframes')
+            st.caption(
+                f"📦 Sent {upload_stats['sent_bytes'] / 1024:.1f} KB "
+                f"({upload_stats['sent_size'][0]} × {upload_stats['sent_size'][1]}"
+                f"{f', a montage of {keyframes} keyframes' if keyframes else ''}) "
+                f"instead of the original {upload_stats['original_bytes'] / 1024:.1f} KB"
+            )
+        if st.button("📋 Copy Caption", key="copy_ai"):
+            st.write("Caption copied to clipboard! (Use Ctrl+C to copy manually)")
+
+def render_search_tab(results_index):
+    """Search past analyses and captions (see results_index.py)."""
+    st.subheader("🔎 Search Past Results")
+    st.caption(
+        f"{len(results_index):,} images indexed. Separate terms with commas: orientation, brightness, "
+        "contrast or complexity levels, colors, #hashtags and caption words."
+    )
+    query = st.text_input("Search", key="results_query", placeholder="portrait, dark, vibrant blue, contains #travel")
+    if not query.strip():
+        return
+    started = time.perf_counter()
+    with stage_timer("search", pipeline="results_index"):
+        results = results_index.search(query, limit=SEARCH_LIMIT)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    more = "+" if len(results) == SEARCH_LIMIT else ""
+    st.caption(f"{len(results)}{more} matches in {elapsed_ms:.0f} ms, most recent first")
+    if results:
+        st.dataframe([
+            {
+                "file": result.name or result.sha256[:12],
+                "dimensions": f"{result.width} × {result.height}" if result.width else "",
+                "orientation": result.orientation or "",
+                "brightness": result.brightness_level or "",
+                "complexity": result.complexity_level or "",
+                "colors": result.colors or "",
+                "caption": result.caption or "",
+            }
+            for result in results
+        ], use_container_width=True)
+
+def render_metrics_panel():
+    """Sidebar admin panel with this server process's metrics (METRICS_ADMIN_PANEL=1)."""
+    registry = get_metrics()
+    snapshot = registry.snapshot()
+    with st.sidebar:
+        st.header("📈 Metrics")
+
+        stage_rows = []
+        for (name, labels), histogram in sorted(snapshot["histograms"].items(), key=lambda item: item[0]):
+            if name != "stage_seconds" or not histogram.count:
+                continue
+            labels = dict(labels)
+            stage_rows.append({
+                "pipeline": labels.get("pipeline", ""),
+                "stage": labels["stage"],
+                "count": histogram.count,
+                "mean ms": round(histogram.sum / histogram.count * 1000, 1),
+                "p95 ms ≤": histogram.quantile(0.95) * 1000,
+            })
+        if stage_rows:
+            st.dataframe(stage_rows, hide_index=True, use_container_width=True)
+        else:
+            st.caption("No stages recorded yet.")
+
+        counters = {}
+        for (name, labels), value in snapshot["counters"].items():
+            counters.setdefault(name, {})[labels] = value
+
+        caches = {}
+        for labels, value in counters.get("cache_requests_total", {}).items():
+            labels = dict(labels)
+            caches.setdefault(labels["cache"], {})[labels["result"]] = value
+        for cache, results in sorted(caches.items()):
+            lookups = results.get("hit", 0) + results.get("miss", 0)
+            st.metric(f"{cache.title()} cache hit rate", f"{results.get('hit', 0) / lookups:.0%}", f"{lookups} lookups",
+                      delta_color="off")
+
+        for (name, labels), histogram in sorted(snapshot["histograms"].items(), key=lambda item: item[0]):
+            if name == "payload_bytes" and histogram.count:
+                labels = dict(labels)
+                st.caption(f"{labels['pipeline']} {labels['kind']} payload: "
+                           f"{histogram.sum / histogram.count / 1024:.1f} KB avg over {histogram.count}")
+
+        tokens = {dict(labels)["kind"]: value for labels, value in counters.get("tokens_total", {}).items()}
+        if tokens:
+            st.caption("Tokens: " + ", ".join(f"{kind} {value:,}" for kind, value in sorted(tokens.items())))
+        errors = {dict(labels)["type"]: value for labels, value in counters.get("api_errors_total", {}).items()}
+        if errors:
+            st.caption("API errors: " + ", ".join(f"{kind} ×{value}" for kind, value in sorted(errors.items())))
+
+        st.download_button("⬇️ Prometheus text", render_prometheus(registry), "metrics.prom", "text/plain")
 
 def main():
     # Set page config
@@ -477,32 +478,71 @@ def main():
     st.markdown("Choose your mode: **Local Offline Reader** for detailed image analysis or **Gemini AI** for mood-based caption generation")
     
     # Create tabs for different modes
-    tab1, tab2 = st.tabs(["📊 Local Offline Reader", "🤖 Gemini AI Caption Generator"])
+    results_index = get_results_index()
+    tab_names = ["📊 Local Offline Reader", "🤖 Gemini AI Caption Generator", "📦 Batch Captioning"]
+    tabs = st.tabs(tab_names + (["🔎 Search"] if results_index is not None else []))
+    tab1, tab2, tab3 = tabs[:3]
 
     # Tab 1: Local Offline Reader
     with tab1:
         uploader_local = st.file_uploader(
-            "Upload an image", type=["jpg", "jpeg", "png"], accept_multiple_files=False, key="file_uploader_local"
+            "Upload an image", type=UPLOAD_TYPES, accept_multiple_files=False, key="file_uploader_local"
         )
-        if uploader_local is not None:
-            image_bytes = uploader_local.read()
-            image = Image.open(io.BytesIO(image_bytes))
-            st.image(image, caption="", use_container_width=True)
+        upload_local = get_upload(uploader_local, "local")
+        if upload_local is not None:
+            image_bytes = upload_local.data
+            st.image(upload_local.preview(), caption=preview_caption(upload_local), use_container_width=True)
+            show_upload_memory()
             
             st.subheader("🔍 Detailed Image Analysis")
             st.info("This mode provides comprehensive offline image analysis including dimensions, colors, complexity, and more.")
 
-            progress_bar = st.progress(0)
-            for i in range(100):
-                progress_bar.progress(i + 1)
-                
-                with st.spinner("Analyzing image details..."):
-                    caption = generate_caption(image_bytes, caption_source="local")
+            near_duplicate = find_near_duplicate_analysis(upload_fingerprint(uploader_local.file_id, image_bytes))
+            reuse_analysis = near_duplicate is not None and st.checkbox(
+                f"♻️ Reuse the analysis of a near-duplicate image seen before (Hamming distance {near_duplicate[1]})",
+                value=True, key="reuse_local_analysis",
+            )
+
+            # Memoize the report for this upload so widget reruns don't redo the analysis
+            upload_key = (uploader_local.file_id, reuse_analysis)
+            queue = get_job_queue()
+            cached = st.session_state.get('local_report')
+            job_id = None
+            if cached is not None and cached[0] == upload_key:
+                caption, job_id = cached[1], cached[2]
+            elif reuse_analysis:
+                caption = format_local_report(near_duplicate[0])
+                st.session_state['local_report'] = (upload_key, caption, None)
+            elif queue is not None:
+                caption = None
+                job_id = queue.submit("analysis", image_bytes, owner=client_id())
+                st.session_state['local_report'] = (upload_key, None, job_id)
+            else:
+                stage_labels = dict(LOCAL_ANALYSIS_STAGES)
+                progress_bar = st.progress(0, text="Analyzing image details...")
+
+                def on_stage(stage_name, completed, total):
+                    progress_bar.progress(completed / total, text=f"{stage_labels[stage_name]} ✓")
+
+                caption = generate_caption(
+                    image_bytes, caption_source="local", on_stage=on_stage, notify=st_notify, upload=upload_local
+                )
+                progress_bar.empty()
+                st.session_state['local_report'] = (upload_key, caption, None)
+
+            if job_id is not None:
+                job = finished_job(job_id)
+                if job is not None:
+                    caption = (
+                        job.result["report"] if job.status == "done" else f"Error analyzing image: {job.error}"
+                    )
+                    st.session_state['local_report'] = (upload_key, caption, None)
 
+            if caption is not None:
                 st.markdown("### 📋 Image Analysis Report")
                 st.markdown(caption)
                 st.caption("✅ Analysis completed locally - no data sent to external servers")
-        else:
+        elif uploader_local is None:
             st.info("Upload an image to analyze it locally.")
 
     # Tab 2: Gemini AI Caption Generator
@@ -511,97 +551,103 @@ def main():
 
         if GEMINI_AVAILABLE:
             uploader_gemini = st.file_uploader(
-                "Upload an image", type=["jpg", "jpeg", "png"], accept_multiple_files=False, key="file_uploader_gemini"
+                "Upload an image", type=UPLOAD_TYPES, accept_multiple_files=False, key="file_uploader_gemini"
             )
-            if uploader_gemini is not None:
-                image_bytes = uploader_gemini.read()
-                image = Image.open(io.BytesIO(image_bytes))
-                st.image(image, caption="", use_container_width=True)
-                if 'ai_caption' in st.session_state:
-                    del st.session_state['ai_caption']
-
-                mood_options = list(get_mood_prompts().keys())
-                mood_type = st.selectbox(
-                    "Choose caption style/mood:",
-                    mood_options,
-                    index=0,
-                    help="Select the style that best matches your intended use for the caption"
-                )
-
-                mood_prompts = get_mood_prompts()
-                base_prompt = (
-                    st.text_area(
-                        "Custom Prompt:",
-                        value="Generate a detailed, creative caption for this image that would work well on social media.",
-                        height=100,
-                        help="Write your own custom prompt to guide the AI caption generation"
-                    )
-                    if mood_type == "Custom" else mood_prompts[mood_type]
-                )
-
-                with st.expander("Caption options", expanded=True):
-                    colA, colB = st.columns(2)
-                    with colA:
-                        platform = st.selectbox(
-                            "Platform",
-                            ["Instagram", "Twitter/X", "LinkedIn", "Facebook", "TikTok", "Pinterest", "YouTube", "Generic"],
-                            index=0
-                        )
-                        tone = st.selectbox(
-                            "Tone",
-                            ["Professional", "Friendly", "Humorous", "Inspirational", "Bold", "Elegant", "Playful", "Minimal"],
-                            index=0
-                        )
-                        length = st.selectbox("Length", ["Short", "Medium", "Long"], index=0)
-                        audience = st.text_input("Target audience (optional)")
-                    with colB:
-                        include_hashtags = st.checkbox("Include hashtags", value=True)
-                        num_hashtags = st.slider("Number of hashtags", 0, 8, 3)
-                        include_emojis = st.checkbox("Include emojis", value=True)
-                        num_emojis = st.slider("Number of emojis", 0, 5, 2)
-                        keywords_csv = st.text_input("Keywords (comma-separated)")
-                        call_to_action = st.text_input("Call-to-action (optional)")
-
-                composed_prompt = compose_gemini_prompt(
-                    base_prompt=base_prompt,
-                    platform=platform,
-                    tone=tone,
-                    length=length,
-                    include_hashtags=include_hashtags,
-                    num_hashtags=num_hashtags,
-                    include_emojis=include_emojis,
-                    num_emojis=num_emojis,
-                    keywords_csv=keywords_csv,
-                    audience=audience,
-                    call_to_action=call_to_action,
-                )
-
-                if st.button("Generate Caption", key="generate_gemini"):
-                    with st.spinner(f"Generating {mood_type.lower()} caption with Gemini AI..."):
-                        st.session_state['ai_caption'] = generate_caption(
-                            image_bytes,
-                            caption_source="gemini",
-                            custom_prompt=composed_prompt,
-                            mood_type="Custom",
-                        )
-
-                if 'ai_caption' in st.session_state:
-                    st.markdown("### 🎨 Generated Caption")
-                    st.success(st.session_state['ai_caption'])
-                    st.caption("🤖 Caption generated using Google's Gemini AI")
-                    if st.button("📋 Copy Caption", key="copy_ai"):
-                        st.write("Caption copied to clipboard! (Use Ctrl+C to copy manually)")
-            else:
+            upload_gemini = get_upload(uploader_gemini, "gemini")
+            if upload_gemini is not None:
+                # A caption request is likely next; get the SDK import out of its way
+                preload_gemini()
+                st.image(upload_gemini.preview(), caption=preview_caption(upload_gemini), use_container_width=True)
+                show_upload_memory()
+                gemini_caption_panel(uploader_gemini.file_id, upload_gemini)
+            elif uploader_gemini is None:
                 st.info("Upload an image to configure options and generate a caption.")
         else:
             st.warning("⚠️ Gemini AI not available. Please install the required package:")
             st.code("pip install google-generativeai")
             st.info("Make sure to also add your Google Gemini API key to the .env file.")
     
+    # Tab 3: Batch Captioning
+    with tab3:
+        st.subheader("📦 Caption a Whole Shoot")
+        st.info("Upload many images or a zip archive. Images are analyzed in parallel and results appear as each one finishes.")
+
+        uploaders_batch = st.file_uploader(
+            "Upload images or zip archives", type=UPLOAD_TYPES + ["zip"],
+            accept_multiple_files=True, key="file_uploader_batch"
+        )
+
+        batch_sources = ["Local analysis"] + (["Gemini AI"] if GEMINI_AVAILABLE else [])
+        colA, colB = st.columns(2)
+        with colA:
+            batch_source = st.radio("Caption source", batch_sources, horizontal=True)
+            batch_mood = (
+                st.selectbox("Caption style/mood", [m for m in get_mood_prompts() if m != "Custom"], key="batch_mood")
+                if batch_source == "Gemini AI" else None
+            )
+        with colB:
+            analysis_workers = st.slider("Analysis processes", 1, max(2, os.cpu_count() or 1), min(4, os.cpu_count() or 1))
+            caption_workers = (
+                st.slider("Concurrent Gemini requests", 1, 16, 4)
+                if batch_source == "Gemini AI" else 1
+            )
+
+        ran_batch = False
+        if uploaders_batch and st.button("Start Batch", key="start_batch"):
+            ran_batch = True
+            uploads = [(uploaded.name, uploaded.getvalue()) for uploaded in uploaders_batch]
+            items = list(iter_batch_items(uploads))
+
+            if batch_source == "Gemini AI":
+                prompt = get_mood_prompts()[batch_mood]
+
+                # Raises on failure, so run_batch() marks the row as an error;
+                # run_batch() also bulk-inserts the results index records
+                def caption_fn(image_bytes):
+                    return caption_with_gemini(image_bytes, prompt, searchable=False)
+            else:
+                caption_fn = None
+
+            progress_bar = st.progress(0, text=f"Processing {len(items)} images...")
+            table = st.empty()
+            rows = []
+            for row in run_batch(
+                items,
+                caption_fn=caption_fn,
+                local_caption_fn=local_caption,
+                analysis_workers=analysis_workers,
+                caption_workers=caption_workers,
+                results_index=results_index,
+            ):
+                rows.append(row)
+                progress_bar.progress(len(rows) / len(items), text=f"{len(rows)} / {len(items)} images done")
+                table.dataframe(rows, use_container_width=True)
+            st.session_state['batch_rows'] = rows
+
+        if st.session_state.get('batch_rows'):
+            rows = st.session_state['batch_rows']
+            if not ran_batch:
+                st.dataframe(rows, use_container_width=True)
+            colCsv, colJsonl = st.columns(2)
+            with colCsv:
+                st.download_button("⬇️ Download CSV", rows_to_csv(rows), "captions.csv", "text/csv")
+            with colJsonl:
+                st.download_button("⬇️ Download JSONL", rows_to_jsonl(rows), "captions.jsonl", "application/jsonl")
+
+    if results_index is not None:
+        with tabs[3]:
+            render_search_tab(results_index)
+
+    if get_job_queue() is not None:
+        render_jobs_panel()
+    if METRICS_ADMIN_PANEL:
+        render_metrics_panel()
+
     # Footer
     st.markdown("---")
     st.caption("🖼️ Image Caption Creator - Local analysis meets AI creativity")
     st.caption("Developed with ♥ | Images processed securely | Never stored")
 
 if __name__ == "__main__":
-    main()
+    with stage_timer("script_run", pipeline="ui"):
+        main()
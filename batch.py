@@ -0,0 +1,215 @@
+"""Batch captioning: many uploads (or zip archives) processed concurrently.
+
+Local analysis is CPU-bound and runs in a process pool; Gemini captioning is
+I/O-bound and runs in a bounded thread pool. Rows are yielded as soon as
+each image is finished, so callers can stream them into a table.
+"""
+
+import concurrent.futures
+import csv
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import zipfile
+
+from analysis_cache import content_key
+from image_analysis import analyze_image_detailed, analysis_cache_version, get_analysis_cache, image_statistics
+from results_index import IndexRecord
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".apng", ".gif", ".webp")
+
+# Column order for table display and CSV export
+BATCH_COLUMNS = [
+    "file", "status", "dimensions", "orientation", "aspect_class",
+    "brightness", "contrast", "dominant_colors", "complexity",
+    "laplacian_variance", "noise_sigma", "clipped_shadows", "clipped_highlights", "caption", "error",
+]
+
+# Finished rows written to the results index per transaction
+RESULTS_INDEX_BATCH = 500
+
+
+def iter_batch_items(uploads):
+    """Yield (name, image_bytes) for every image in a list of uploads.
+
+    Args:
+        uploads: Iterable of (name, data) pairs; zip archives are expanded
+            and only their image members are yielded
+
+    Yields:
+        tuple: (name, image_bytes)
+    """
+    for name, data in uploads:
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for member in archive.infolist():
+                    member_name = member.filename
+                    if member.is_dir() or member_name.startswith("__MACOSX/"):
+                        continue
+                    if os.path.basename(member_name).startswith("."):
+                        continue
+                    if member_name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield f"{name}/{member_name}", archive.read(member)
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            yield name, data
+
+
+def _analysis_columns(analysis):
+    """Flatten an analyze_image_detailed() result into table columns."""
+    if "error" in analysis:
+        return {"error": analysis["error"]}
+    basic_info = analysis["basic_info"]
+    color_analysis = analysis["color_analysis"]
+    stats = image_statistics(analysis)
+    columns = {
+        "dimensions": f"{basic_info['width']} × {basic_info['height']}",
+        "orientation": basic_info["orientation"],
+        "aspect_class": basic_info["aspect_class"],
+        "complexity": analysis["complexity"]["level"],
+        "laplacian_variance": stats.laplacian_variance,
+        "noise_sigma": stats.noise_sigma,
+        "clipped_shadows": stats.luma.clipped_shadows,
+        "clipped_highlights": stats.luma.clipped_highlights,
+    }
+    if color_analysis.get("is_color"):
+        columns["brightness"] = color_analysis["brightness"]
+        columns["contrast"] = color_analysis["contrast"]
+        columns["dominant_colors"] = ", ".join(c["name"] for c in color_analysis["dominant_colors"][:3])
+    return columns
+
+
+def run_batch(items, caption_fn=None, local_caption_fn=None, analysis_workers=None, caption_workers=4,
+              results_index=None):
+    """Analyze and caption many images concurrently, yielding rows as they finish.
+
+    Args:
+        items: Iterable of (name, image_bytes), e.g. from iter_batch_items()
+        caption_fn: Optional callable(image_bytes) -> str run in the thread
+            pool for every image, e.g. a Gemini captioner
+        local_caption_fn: Optional callable(analysis) -> str used for the
+            caption column when caption_fn is not given
+        analysis_workers: Process pool size, defaults to the CPU count
+        caption_workers: Upper bound on concurrent caption_fn calls
+        results_index: Optional results_index.ResultsIndex; successful rows
+            are bulk-inserted RESULTS_INDEX_BATCH at a time
+
+    Yields:
+        dict: One row per image with keys from BATCH_COLUMNS
+    """
+    cache = get_analysis_cache()
+    version = analysis_cache_version()
+    rows = {}
+    pending = {}
+    outstanding = {}
+    digests = {}
+    records = []
+    caption_source = "gemini" if caption_fn is not None else "local"
+
+    def finish(index):
+        row = rows.pop(index)
+        analysis = row.get("_analysis")
+        finished = _finish_row(row, local_caption_fn)
+        digest = digests.pop(index, None)
+        if digest is not None and finished["status"] == "ok":
+            captions = [(caption_source, None, finished["caption"])] if finished["caption"] else []
+            records.append(IndexRecord(digest, finished["file"], analysis, captions))
+            if len(records) >= RESULTS_INDEX_BATCH:
+                _flush_records(results_index, records)
+        return finished
+
+    # Spawn rather than fork: the Streamlit server process is multi-threaded
+    process_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=analysis_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=caption_workers)
+    try:
+        for index, (name, image_bytes) in enumerate(items):
+            rows[index] = {"file": name, "status": "ok"}
+            outstanding[index] = 0
+            if results_index is not None:
+                digests[index] = hashlib.sha256(image_bytes).hexdigest()
+
+            key = content_key(image_bytes, version)
+            cached = cache.get(key)
+            if cached is not None:
+                rows[index]["_analysis"] = cached
+            else:
+                future = process_pool.submit(analyze_image_detailed, image_bytes, None, False)
+                pending[future] = (index, "analysis", key)
+                outstanding[index] += 1
+
+            if caption_fn is not None:
+                future = thread_pool.submit(caption_fn, image_bytes)
+                pending[future] = (index, "caption", None)
+                outstanding[index] += 1
+
+            if outstanding[index] == 0:
+                yield finish(index)
+
+        for future in concurrent.futures.as_completed(list(pending)):
+            index, kind, key = pending.pop(future)
+            row = rows[index]
+            try:
+                result = future.result()
+            except Exception as e:
+                row["status"] = "error"
+                row["error"] = f"{kind} failed: {e}"
+            else:
+                if kind == "analysis":
+                    row["_analysis"] = result
+                    if "error" not in result:
+                        cache.put(key, result)
+                else:
+                    row["caption"] = result
+
+            outstanding[index] -= 1
+            if outstanding[index] == 0:
+                yield finish(index)
+    finally:
+        # Cancel queued work if the consumer stops early
+        process_pool.shutdown(wait=False, cancel_futures=True)
+        thread_pool.shutdown(wait=False, cancel_futures=True)
+        if records:
+            _flush_records(results_index, records)
+
+
+def _flush_records(results_index, records):
+    """Bulk-insert and clear buffered IndexRecords; failures are only logged."""
+    try:
+        results_index.add_many(records)
+    except Exception:
+        logger.warning("Could not update the results index", exc_info=True)
+    records.clear()
+
+
+def _finish_row(row, local_caption_fn):
+    """Merge analysis columns into a completed row."""
+    analysis = row.pop("_analysis", None)
+    if analysis is not None:
+        columns = _analysis_columns(analysis)
+        if "error" in columns:
+            row["status"] = "error"
+        row.update(columns)
+        # A failed caption_fn leaves the caption empty rather than falling back
+        if "caption" not in row and local_caption_fn is not None and row["status"] == "ok":
+            row["caption"] = local_caption_fn(analysis)
+    return {column: row.get(column, "") for column in BATCH_COLUMNS}
+
+
+def rows_to_csv(rows):
+    """Serialize batch rows as CSV text."""
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=BATCH_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def rows_to_jsonl(rows):
+    """Serialize batch rows as JSON Lines text."""
+    return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
@@ -0,0 +1,331 @@
+"""Benchmarks for local analysis, local captions and the Gemini request path.
+
+Synthetic images are generated deterministically (seeded) across sizes,
+formats and content types and cached on disk. Each case runs in a fresh
+process so its peak RSS is its own, and reports median per-stage wall time,
+peak RSS and images per second. The Gemini path is timed end to end against
+the local fake server (fake_gemini_server.py) through the async engine.
+
+    python benchmark.py --quick                      # 0.3 and 2 MP only
+    python benchmark.py --save-baseline              # record this machine's numbers
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.25
+
+With --baseline, the run exits with status 1 if any case is slower (or uses
+more memory) than the stored baseline by more than the tolerance. Each case
+process also times a fixed calibration workload (Pillow and NumPy work that
+doesn't depend on the app's code) next to every run, and timings are
+compared relative to it. A baseline recorded on another machine, or while
+this one was busier, therefore still gates meaningfully; regenerate it when
+the CPU architecture or the Pillow/NumPy versions change.
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import math
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from fake_gemini_server import FakeGeminiConfig, FakeGeminiServer
+
+SIZES_MP = [0.3, 2, 12, 50]
+QUICK_SIZES_MP = [0.3, 2]
+# Format name -> (Pillow mode, file format)
+FORMATS = {
+    "JPEG": ("RGB", "JPEG"),
+    "PNG": ("RGB", "PNG"),
+    "RGBA": ("RGBA", "PNG"),
+    "L": ("L", "JPEG"),
+    "CMYK": ("CMYK", "JPEG"),
+}
+CONTENTS = ["flat", "noisy", "high-edge"]
+
+# Metrics compared against the baseline; timings are medians over --repeat runs
+GATED_METRICS = ["local_s", "gemini_prepare_s", "gemini_total_s", "peak_rss_mb"]
+# Timing differences smaller than this are treated as noise, whatever the ratio
+MIN_TIME_DELTA = 0.005
+MIN_RSS_DELTA_MB = 16
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Size of the calibration workload's image
+CALIBRATION_MP = 0.5
+
+
+def case_id(megapixels, image_format, content):
+    return f"{megapixels:g}MP-{image_format}-{content}"
+
+
+def synthetic_pixels(megapixels, content, seed=0):
+    """Deterministic 4:3 RGB pixels of the given size and content type."""
+    width = round(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = round(width * 3 / 4)
+    rng = np.random.default_rng(seed)
+    if content == "flat":
+        return np.broadcast_to(rng.integers(0, 256, 3, dtype=np.uint8), (height, width, 3)).copy()
+    if content == "noisy":
+        return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    if content == "high-edge":
+        # 4 px checkerboard between two colors: an edge every few pixels
+        colors = rng.integers(0, 256, (2, 3), dtype=np.uint8)
+        cells = ((np.arange(height) // 4 % 2).astype(np.uint8)[:, None]
+                 ^ (np.arange(width) // 4 % 2).astype(np.uint8)[None, :])
+        return colors[cells]
+    raise ValueError(f"Unknown content type: {content!r}")
+
+
+def synthetic_image(megapixels, image_format, content, cache_dir):
+    """Return the path of the synthetic image, generating it on first use."""
+    mode, file_format = FORMATS[image_format]
+    path = os.path.join(cache_dir, f"{case_id(megapixels, image_format, content)}.{file_format.lower()}")
+    if os.path.exists(path):
+        return path
+
+    img = Image.fromarray(synthetic_pixels(megapixels, content))
+    if mode == "RGBA":
+        # Horizontal alpha ramp, so the alpha channel is not trivially opaque
+        alpha = np.broadcast_to(np.linspace(0, 255, img.width, dtype=np.uint8), (img.height, img.width))
+        img.putalpha(Image.fromarray(np.ascontiguousarray(alpha)))
+    elif mode != "RGB":
+        img = img.convert(mode)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + ".tmp"
+    img.save(tmp_path, format=file_format, **({"quality": 90} if file_format == "JPEG" else {}))
+    os.replace(tmp_path, path)
+    return path
+
+
+def calibration_workload(pixels):
+    """Fixed decode, resample, filter and array work; its time measures the machine."""
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    img = Image.open(io.BytesIO(buffer.getvalue())).convert("L")
+    img.resize((img.width // 2, img.height // 2), Image.Resampling.LANCZOS)
+    gray = np.asarray(img).astype(np.int16)
+    laplacian = gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+    np.histogram(pixels, bins=256, range=(0, 256))
+    return float((laplacian.astype(np.int32) ** 2).mean())
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(path, repeat, gemini):
+    """Benchmark one image in the current (fresh) process."""
+    from captioning import caption_with_gemini, generate_caption, prepare_image_for_gemini
+
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+
+    runs = {}
+    calibration_pixels = synthetic_pixels(CALIBRATION_MP, "noisy", seed=1)
+
+    def record(name, seconds):
+        runs.setdefault(name, []).append(seconds)
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        calibration_workload(calibration_pixels)
+        record("calibration_s", time.perf_counter() - started)
+
+        last = started = time.perf_counter()
+
+        def on_stage(stage_name, completed, total):
+            nonlocal last
+            now = time.perf_counter()
+            record(f"{stage_name}_s", now - last)
+            last = now
+
+        report = generate_caption(image_bytes, caption_source="local", on_stage=on_stage, use_cache=False)
+        record("local_s", time.perf_counter() - started)
+        if "decode_s" not in runs:
+            # An analysis error returns early; don't time (or gate) the error path
+            raise RuntimeError(f"Local analysis of {path} failed: {report}")
+
+        if gemini:
+            started = time.perf_counter()
+            prepare_image_for_gemini(image_bytes)
+            record("gemini_prepare_s", time.perf_counter() - started)
+
+            started = time.perf_counter()
+            caption_with_gemini(image_bytes, use_cache=False)
+            record("gemini_total_s", time.perf_counter() - started)
+
+    result = {name: statistics.median(values) for name, values in runs.items()}
+    # Each run relative to the calibration timed just before it, which
+    # cancels out both the machine's speed and load that varies over time
+    calibration = runs["calibration_s"]
+    result["relative"] = {
+        name: statistics.median(value / reference for value, reference in zip(values, calibration))
+        for name, values in runs.items() if name != "calibration_s" and len(values) == len(calibration)
+    }
+    result["images_per_s"] = 1 / result["local_s"] if result["local_s"] else float("inf")
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["bytes"] = len(image_bytes)
+    return result
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return a list of human-readable regressions past the tolerance.
+
+    Timings are compared as multiples of the calibration time, converted to
+    seconds at this run's calibration, so a run on a machine twice as slow
+    as the baseline's may take twice as long. Baselines without relative
+    timings are compared in absolute seconds. Cases the baseline has no
+    numbers for are reported as well, so they can't pass ungated.
+    """
+    regressions = []
+    for case, metrics in results.items():
+        reference = baseline.get(case)
+        if reference is None:
+            regressions.append(f"{case}: not in the baseline; record it with --save-baseline")
+            continue
+        relative, reference_relative = metrics.get("relative", {}), reference.get("relative", {})
+        for metric in GATED_METRICS:
+            if metric not in metrics or metric not in reference:
+                continue
+            old, new = reference[metric], metrics[metric]
+            min_delta = MIN_RSS_DELTA_MB if metric == "peak_rss_mb" else MIN_TIME_DELTA
+            if metric in relative and metric in reference_relative:
+                scale = metrics["calibration_s"]
+                old, new = reference_relative[metric] * scale, relative[metric] * scale
+            if new > old * (1 + tolerance) and new - old > min_delta:
+                regressions.append(f"{case} {metric}: {old:.4g} -> {new:.4g} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def stale_metrics(results, baseline):
+    """Metrics only the current run or only the baseline has, e.g. after stages change.
+
+    Returns:
+        tuple: (missing, obsolete) sorted metric names
+    """
+    current = {metric for metrics in results.values() for metric in metrics}
+    stored = {metric for reference in baseline.values() for metric in reference}
+    return sorted(current - stored), sorted(stored - current)
+
+
+def format_table(results):
+    columns = ["decode_s", "statistics_s", "quantize_s", "report_s", "local_s",
+               "images_per_s", "gemini_prepare_s", "gemini_total_s", "peak_rss_mb", "calibration_s"]
+    timings = [c for c in columns if c.endswith("_s") and c != "images_per_s"]
+    labels = [c[:-2] + " ms" if c in timings else c.replace("_", " ") for c in columns]
+    lines = [f"{'case':<22}" + "".join(f"{label:>19}" for label in labels)]
+    for case, metrics in results.items():
+        cells = []
+        for column in columns:
+            value = metrics.get(column)
+            if value is None:
+                cells.append(f"{'-':>19}")
+            elif column in timings:
+                cells.append(f"{value * 1000:>19.1f}")
+            else:
+                cells.append(f"{value:>19.1f}")
+        lines.append(f"{case:<22}" + "".join(cells))
+    return "\n".join(lines)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark local analysis and the Gemini request path.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=SIZES_MP, help="Image sizes in megapixels")
+    parser.add_argument("--quick", action="store_true", help=f"Only run {QUICK_SIZES_MP} MP images")
+    parser.add_argument("--formats", nargs="+", choices=list(FORMATS), default=list(FORMATS))
+    parser.add_argument("--contents", nargs="+", choices=CONTENTS, default=CONTENTS)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per case; medians are reported (default: 5)")
+    parser.add_argument("--no-gemini", action="store_true", help="Skip the Gemini path")
+    parser.add_argument("--image-dir", default=os.path.join(tempfile.gettempdir(), "caption-benchmark-images"),
+                        help="Where generated images are cached")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Fail if any case regresses past this stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown vs. the baseline as a fraction (default: 0.25)")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE,
+                        help=f"Store results as the new baseline (default file: {DEFAULT_BASELINE})")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sizes = QUICK_SIZES_MP if args.quick else args.sizes
+    cases = [(mp, fmt, content) for mp in sizes for fmt in args.formats for content in args.contents]
+
+    print(f"Generating {len(cases)} synthetic images in {args.image_dir}", file=sys.stderr)
+    paths = {case_id(*case): synthetic_image(*case, args.image_dir) for case in cases}
+
+    server = None
+    if not args.no_gemini:
+        # No latency: measure our own request building and transport overhead
+        server = FakeGeminiServer(config=FakeGeminiConfig(latency=0, jitter=0, seed=0)).start()
+        # Inherited by the spawned case processes before they import captioning
+        os.environ.update({
+            "GEMINI_ENGINE": "async",
+            "GEMINI_API_BASE": server.base_url,
+            "GOOGLE_GEMINI_API_KEY": "benchmark",
+            "GEMINI_RPM": "1000000",
+        })
+
+    # The large cases are bigger than the upload ceilings (a 50 MP noisy PNG
+    # is over 100 MB); measure the pipeline rather than the rejection
+    os.environ.update({"UPLOAD_MAX_BYTES": "0", "UPLOAD_MAX_PIXELS": "0"})
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    try:
+        for name, path in paths.items():
+            # A fresh process per case keeps peak RSS attributable to that case
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                results[name] = pool.submit(run_case, path, args.repeat, server is not None).result()
+            print(f"{name}: {results[name]['local_s'] * 1000:.1f}ms local", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(format_table(results))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        # Cases this run didn't measure (e.g. the large sizes under --quick) keep their numbers
+        stored = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline, encoding="utf-8") as f:
+                stored = json.load(f)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({**stored, **results}, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.save_baseline}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        missing, obsolete = stale_metrics(results, baseline)
+        if missing or obsolete:
+            print(f"Baseline is stale (missing {', '.join(missing) or '-'}; no longer measured "
+                  f"{', '.join(obsolete) or '-'}); regenerate it with --save-baseline", file=sys.stderr)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) past {args.tolerance:.0%} or missing from the baseline:",
+                  file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            return 1
+        print(f"No regressions past {args.tolerance:.0%} vs. {args.baseline}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""Lookup latency of the near-duplicate index as it grows.
+
+Fills a NearDuplicateIndex with random 64-bit hashes in steps up to
+--entries, plants a near-duplicate (a few flipped bits) for every query and
+reports p50/p95/p99 lookup latency and recall at each size. The same queries
+are run as a NumPy linear scan for comparison.
+
+    python benchmark_dedup.py --entries 1000000 --distance 6
+
+Random hashes spread evenly over the chunk buckets; real image hashes
+cluster more, so expect somewhat more candidates per probe in production.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from dedup_index import Fingerprint, NearDuplicateIndex
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def random_hashes(rng, count):
+    return [int(h) for h in rng.integers(0, 1 << 64, size=count, dtype=np.uint64)]
+
+
+def flip_bits(rng, value, bits):
+    for bit in rng.choice(64, size=bits, replace=False):
+        value ^= 1 << int(bit)
+    return value
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark near-duplicate index lookups.")
+    parser.add_argument("--entries", type=int, default=1_000_000, help="Final index size (default: 1,000,000)")
+    parser.add_argument("--steps", type=int, default=3, help="Measure at this many sizes, 10x apart (default: 3)")
+    parser.add_argument("--queries", type=int, default=200, help="Lookups per size (default: 200)")
+    parser.add_argument("--distance", type=int, default=6, help="Hamming distance threshold (default: 6)")
+    parser.add_argument("--path", help="SQLite file to build (default: a temporary file)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    rng = np.random.default_rng(args.seed)
+    sizes = sorted({max(1, args.entries // 10 ** i) for i in range(args.steps)})
+
+    tmp_dir = None
+    path = args.path
+    if path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "dedup_benchmark.sqlite3")
+    index = NearDuplicateIndex(path, max_distance=args.distance)
+
+    stored = np.empty(0, dtype=np.uint64)
+    print(f"{'entries':>10} {'insert/s':>10} {'load ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'recall':>7} {'scan p50 ms':>12}")
+    for size in sizes:
+        new = random_hashes(rng, size - len(stored))
+        started = time.perf_counter()
+        for start in range(0, len(new), 50_000):
+            index.add_many(
+                Fingerprint(f"bench-{len(stored) + start + i}", h)
+                for i, h in enumerate(new[start:start + 50_000])
+            )
+        insert_rate = len(new) / (time.perf_counter() - started) if new else float("inf")
+        stored = np.concatenate([stored, np.array(new, dtype=np.uint64)])
+
+        # The first lookup after a bulk insert rebuilds the in-memory tables
+        started = time.perf_counter()
+        index.find(0)
+        load_time = time.perf_counter() - started
+
+        # Each query is a stored hash with up to --distance bits flipped
+        targets = rng.choice(len(stored), size=args.queries)
+        queries = [flip_bits(rng, int(stored[t]), int(rng.integers(0, args.distance + 1))) for t in targets]
+
+        latencies = []
+        found = 0
+        for target, query in zip(targets, queries):
+            started = time.perf_counter()
+            matches = index.find(query)
+            latencies.append(time.perf_counter() - started)
+            found += any(m.sha256 == f"bench-{target}" for m in matches)
+
+        scan = []
+        for query in queries[:20]:
+            started = time.perf_counter()
+            xor = stored ^ np.uint64(query)
+            distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            np.flatnonzero(distances <= args.distance)
+            scan.append(time.perf_counter() - started)
+
+        print(f"{size:>10,} {insert_rate:>10,.0f} {load_time * 1000:>8.0f} {percentile(latencies, 0.5) * 1000:>8.2f} "
+              f"{percentile(latencies, 0.95) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f} "
+              f"{found / len(queries):>7.1%} {statistics.median(scan) * 1000:>12.1f}")
+        sys.stdout.flush()
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
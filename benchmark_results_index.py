@@ -0,0 +1,139 @@
+"""Ingest rate and query latency of the results index at scale.
+
+Bulk-inserts --entries synthetic images (random levels, three dominant
+colors and a caption of random words with a few hashtags each) into a
+ResultsIndex, then runs each QUERIES entry --repeat times and reports
+p50/p95/p99 latency and the number of results returned.
+
+    python benchmark_results_index.py --entries 300000
+    python benchmark_results_index.py --entries 100000 --query "square, gray, #food"
+
+Synthetic values are spread evenly over every level and color, so each
+filter is about as selective as its vocabulary size allows; real archives
+are skewed (many "Balanced" landscapes), which makes common terms match more
+rows and rare ones fewer.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from color_engine import NAME_TABLE
+from results_index import IndexRecord, ResultsIndex
+
+QUERIES = [
+    "portrait, dark, vibrant blue, contains #travel",
+    "landscape, bright",
+    "#sunset",
+    "mountain lake",
+    "square, minimalist, gray",
+    "detailed, red, #food",
+    "grayscale, blurry",
+]
+
+ORIENTATIONS = {
+    "Landscape": ["Ultra-wide/Panoramic", "Wide", "Standard Landscape"],
+    "Portrait": ["Standard Portrait", "Tall Portrait", "Ultra-tall"],
+    "Square": ["Square"],
+}
+BRIGHTNESS_LEVELS = ["Dark", "Balanced", "Bright"]
+CONTRAST_LEVELS = ["Low", "Medium", "High"]
+COMPLEXITY_LEVELS = ["Simple/Minimalist", "Well-Composed", "Detailed/Complex"]
+HASHTAGS = ["travel", "sunset", "food", "nature", "city", "portrait", "beach", "night"] + [f"tag{i}" for i in range(192)]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def synthetic_record(rng, number, words):
+    orientation = rng.choice(list(ORIENTATIONS))
+    is_color = rng.random() > 0.1
+    colors = rng.sample(list(NAME_TABLE), 3) if is_color else [rng.choice(["Black", "Gray", "White"])]
+    analysis = {
+        "version": "bench",
+        "basic_info": {
+            "width": rng.randint(300, 6000),
+            "height": rng.randint(300, 6000),
+            "orientation": orientation,
+            "aspect_class": rng.choice(ORIENTATIONS[orientation]),
+        },
+        "color_analysis": {
+            "is_color": is_color,
+            "brightness": rng.random(),
+            "contrast": rng.random() / 2,
+            "brightness_level": rng.choice(BRIGHTNESS_LEVELS),
+            "contrast_level": rng.choice(CONTRAST_LEVELS),
+            "dominant_colors": [{"name": str(name), "percentage": 100 / len(colors)} for name in colors],
+        },
+        "complexity": {"level": rng.choice(COMPLEXITY_LEVELS), "edge_density": rng.random() * 40},
+        "statistics": {"laplacian_variance": rng.random() * 1000, "noise_sigma": rng.random() * 10},
+    }
+    caption = " ".join(rng.choices(words, k=12)) + " " + " ".join(
+        "#" + tag for tag in rng.sample(HASHTAGS, rng.randint(0, 3))
+    )
+    return IndexRecord(f"bench-{number}", f"image_{number:07d}.jpg", analysis, [("gemini", None, caption)])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark results index ingestion and search.")
+    parser.add_argument("--entries", type=int, default=300_000, help="Images to index (default: 300,000)")
+    parser.add_argument("--batch", type=int, default=10_000, help="Records per add_many() call (default: 10,000)")
+    parser.add_argument("--repeat", type=int, default=50, help="Runs per query (default: 50)")
+    parser.add_argument("--limit", type=int, default=50, help="Results per query (default: 50)")
+    parser.add_argument("--query", action="append", help="Query to run instead of the built-in QUERIES (repeatable)")
+    parser.add_argument("--path", help="SQLite file to build (default: a temporary file)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    rng = random.Random(args.seed)
+    # A 2,000-word vocabulary with a few real words so text queries match
+    words = ["mountain", "lake", "street", "coffee", "market", "forest"] + [f"word{i}" for i in range(1994)]
+
+    tmp_dir = None
+    path = args.path
+    if path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "results_benchmark.sqlite3")
+    index = ResultsIndex(path)
+
+    ingest_time = 0.0
+    for start in range(0, args.entries, args.batch):
+        stop = min(start + args.batch, args.entries)
+        records = [synthetic_record(rng, number, words) for number in range(start, stop)]
+        started = time.perf_counter()
+        index.add_many(records)
+        ingest_time += time.perf_counter() - started
+    started = time.perf_counter()
+    index.optimize()
+    optimize_time = time.perf_counter() - started
+    size_mb = os.path.getsize(path) / (1 << 20)
+    print(f"Indexed {args.entries:,} images in {ingest_time:.1f}s ({args.entries / ingest_time:,.0f}/s), "
+          f"optimize {optimize_time:.1f}s, {size_mb:.0f} MB")
+
+    print(f"\n{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'results':>8}  query")
+    for query in args.query or QUERIES:
+        latencies = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = index.search(query, limit=args.limit)
+            latencies.append(time.perf_counter() - started)
+        print(f"{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.95) * 1000:>8.2f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.2f} {len(results):>8}  {query}")
+        sys.stdout.flush()
+
+    index.close()
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
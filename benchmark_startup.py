@@ -0,0 +1,99 @@
+"""Cold-start import cost of the app's own modules.
+
+Imports STARTUP_MODULES (everything app.py imports except Streamlit itself)
+in fresh interpreters under `python -X importtime` and reports the median
+time, the slowest imports, and whether any module that should load lazily
+was imported at startup.
+
+    python benchmark_startup.py
+    python benchmark_startup.py --budget-ms 400 --top 15
+
+Exits with status 1 if a LAZY_MODULES entry shows up at startup or the
+median import time exceeds --budget-ms.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# What app.py imports besides streamlit
+STARTUP_MODULES = ["captioning", "batch", "image_analysis", "job_queue", "metrics", "uploads"]
+
+# Must only be imported on first use, never at startup
+LAZY_MODULES = ["google.generativeai", "grpc", "google.protobuf", "requests", "gemini_async", "http.server"]
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s*)(?P<name>\S+)")
+
+DEFAULT_BUDGET_MS = 500
+
+
+def measure(modules):
+    """Import modules in a fresh interpreter.
+
+    Returns:
+        list: (name, self_us, cumulative_us, depth) per imported module, in
+        the order -X importtime reports them
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {modules} failed:\n{result.stderr[-2000:]}")
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            depth = (len(match.group("indent")) - 1) // 2
+            entries.append((match.group("name"), int(match.group("self")), int(match.group("cumulative")), depth))
+    return entries
+
+
+def startup_ms(entries, modules):
+    """Total import time of the requested modules (top-level entries only)."""
+    return sum(cumulative for name, _, cumulative, depth in entries if depth == 0 and name in modules) / 1000
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Measure the app's cold-start import time.")
+    parser.add_argument("--modules", nargs="+", default=STARTUP_MODULES, help="Modules to import")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to run (default: 5)")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list (default: 10)")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help=f"Fail if the median exceeds this (default: {DEFAULT_BUDGET_MS})")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # One warm-up run so bytecode compilation isn't measured
+    measure(args.modules)
+    runs = [measure(args.modules) for _ in range(args.repeat)]
+    timings = [startup_ms(entries, args.modules) for entries in runs]
+    median = statistics.median(timings)
+
+    last = runs[-1]
+    print(f"Importing {', '.join(args.modules)}: median {median:.0f} ms over {args.repeat} runs "
+          f"(min {min(timings):.0f}, max {max(timings):.0f})")
+    print(f"\n{'cumulative ms':>14} {'self ms':>8}  module")
+    for name, self_us, cumulative, _ in sorted(last, key=lambda entry: -entry[2])[:args.top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>8.1f}  {name}")
+
+    imported = {name for name, _, _, _ in last}
+    eager = [name for name in LAZY_MODULES if name in imported]
+    failures = []
+    if eager:
+        failures.append(f"imported at startup but should load lazily: {', '.join(eager)}")
+    if median > args.budget_ms:
+        failures.append(f"median {median:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Response cache for Gemini captions.
+
+A caption is keyed on a hash of the image bytes, the composed prompt and the
+generation config, so re-clicking Generate with identical inputs is served
+locally instead of spending API latency and quota. Entries expire after a
+TTL and the store is bounded by entry count. Storage is pluggable: an
+in-process dict (default) or a local SQLite file shared between processes
+and restarts.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def caption_key(image_bytes, prompt, generation_config):
+    """Build the cache key for one Gemini request's inputs."""
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(image_bytes).digest())
+    h.update(prompt.encode("utf-8"))
+    h.update(json.dumps(generation_config, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+class MemoryCaptionBackend:
+    """Insertion-ordered in-memory store; oldest entries are evicted first."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, caption, expires_at):
+        self._entries.pop(key, None)
+        self._entries[key] = (caption, expires_at)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def trim(self, max_entries, now):
+        for key in [k for k, (_, exp) in self._entries.items() if exp <= now]:
+            del self._entries[key]
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCaptionBackend:
+    """SQLite-file store that survives restarts and can be shared by processes."""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key):
+        row = self._db.execute(
+            "SELECT caption, expires_at FROM captions WHERE key = ?", (key,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, key, caption, expires_at):
+        self._db.execute(
+            "INSERT OR REPLACE INTO captions (key, caption, expires_at, created_at) VALUES (?, ?, ?, ?)",
+            (key, caption, expires_at, time.time()),
+        )
+        self._db.commit()
+
+    def delete(self, key):
+        self._db.execute("DELETE FROM captions WHERE key = ?", (key,))
+        self._db.commit()
+
+    def trim(self, max_entries, now):
+        self._db.execute("DELETE FROM captions WHERE expires_at <= ?", (now,))
+        self._db.execute(
+            "DELETE FROM captions WHERE key NOT IN "
+            "(SELECT key FROM captions ORDER BY created_at DESC LIMIT ?)",
+            (max_entries,),
+        )
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+
+class CaptionCache:
+    """TTL- and size-bounded caption cache over a pluggable backend. Thread-safe."""
+
+    def __init__(self, backend=None, ttl_seconds=24 * 3600, max_entries=1000):
+        self.backend = backend if backend is not None else MemoryCaptionBackend()
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+
+    @classmethod
+    def from_env(cls):
+        """Create a cache configured from CAPTION_CACHE_* environment variables."""
+        backend_name = os.getenv("CAPTION_CACHE_BACKEND", "memory").lower()
+        if backend_name == "sqlite":
+            backend = SQLiteCaptionBackend(os.getenv("CAPTION_CACHE_PATH", "caption_cache.db"))
+        elif backend_name == "memory":
+            backend = MemoryCaptionBackend()
+        else:
+            raise ValueError(f"Unknown CAPTION_CACHE_BACKEND: {backend_name!r} (expected 'memory' or 'sqlite')")
+        return cls(
+            backend=backend,
+            ttl_seconds=float(os.getenv("CAPTION_CACHE_TTL", str(24 * 3600))),
+            max_entries=int(os.getenv("CAPTION_CACHE_MAX_ENTRIES", "1000")),
+        )
+
+    def get(self, key):
+        """Return the cached caption for key, or None if missing or expired."""
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None:
+                caption, expires_at = entry
+                if expires_at > time.time():
+                    self._counters["hits"] += 1
+                    return caption
+                self.backend.delete(key)
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key, caption):
+        """Store a caption, replacing any previous one for the same key."""
+        with self._lock:
+            now = time.time()
+            self.backend.set(key, caption, now + self.ttl_seconds)
+            self.backend.trim(self.max_entries, now)
+
+    def discard(self, key):
+        """Remove a cached caption, e.g. a response that turned out unusable."""
+        with self._lock:
+            self.backend.delete(key)
+
+    def stats(self):
+        """Return hit/miss counters and the current number of entries."""
+        with self._lock:
+            return {**self._counters, "entries": len(self.backend)}
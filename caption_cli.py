@@ -0,0 +1,229 @@
+"""Headless bulk captioning over directory trees.
+
+Walks one or more directories, captions every image and appends one JSON
+object per line to the output file as results arrive. Example:
+
+    python caption_cli.py ~/archive -o captions.jsonl --source local --workers 8
+    python caption_cli.py ~/archive -o captions.jsonl --source gemini --resume
+
+With --exact, local analysis runs at full resolution in bounded memory (see
+image_analysis.analyze_image_tiled), for archival scans and panoramas
+beyond the upload size limits:
+
+    python caption_cli.py ~/scans -o captions.jsonl --exact --workers 2
+
+Paths are written resolved (absolute, symlinks followed), so --resume
+recognizes an image however the directories were named on the command line
+or whatever the working directory. With --resume, images that already have
+a successful line in the output file are skipped; failed images are retried
+and their new line supersedes the old.
+Successful results are also bulk-inserted into the searchable results index
+(see results_index.py) when --index or RESULTS_INDEX_PATH is given.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+from batch import IMAGE_EXTENSIONS, RESULTS_INDEX_BATCH
+from captioning import caption_with_gemini, get_mood_prompts, local_caption
+from image_analysis import analyze_image_detailed, analyze_image_tiled
+from results_index import IndexRecord, ResultsIndex
+
+
+# Archival scans are commonly uncompressed TIFF, which --exact reads strip by strip
+EXACT_EXTENSIONS = IMAGE_EXTENSIONS + (".tif", ".tiff", ".bmp", ".ppm", ".pgm")
+# Read size when hashing files too large to load whole (--exact)
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def iter_image_paths(roots, extensions=IMAGE_EXTENSIONS):
+    """Lazily yield image paths under the given files/directories, in sorted order."""
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.startswith("."):
+                    continue
+                if filename.lower().endswith(extensions):
+                    yield os.path.join(dirpath, filename)
+
+
+def load_done_paths(output_path):
+    """Return the resolved paths that already have a successful result line."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line
+                continue
+            if not record.get("error"):
+                # Relative paths only appear in files written by older versions
+                done.add(os.path.realpath(record["path"]))
+    return done
+
+
+def caption_file_local(path):
+    """Worker: analyze one file offline and build its local caption."""
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    analysis = analyze_image_detailed(image_bytes)
+    if "error" in analysis:
+        return {"path": path, "source": "local", "error": analysis["error"]}
+    return {
+        "path": path, "source": "local", "sha256": hashlib.sha256(image_bytes).hexdigest(),
+        "caption": local_caption(analysis), "analysis": analysis,
+    }
+
+
+def caption_file_exact(path):
+    """Worker: analyze one file at full resolution, strip by strip."""
+    analysis = analyze_image_tiled(path)
+    if "error" in analysis:
+        return {"path": path, "source": "local", "error": analysis["error"]}
+    # Hashed in chunks; the file is never read into memory whole
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return {
+        "path": path, "source": "local", "sha256": digest.hexdigest(),
+        "caption": local_caption(analysis), "analysis": analysis,
+    }
+
+
+def caption_file_gemini(path, prompt):
+    """Worker: caption one file with Gemini; failures raise."""
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    return {
+        "path": path, "source": "gemini", "sha256": hashlib.sha256(image_bytes).hexdigest(),
+        # main() bulk-inserts the results itself
+        "caption": caption_with_gemini(image_bytes, prompt, searchable=False),
+    }
+
+
+def run_bounded(executor, worker, paths, max_in_flight):
+    """Yield (path, record) as work finishes, never queueing more than max_in_flight.
+
+    Keeping the window bounded means the directory walk and file reads stay
+    lazy, so memory use does not grow with the size of the tree.
+    """
+    paths = iter(paths)
+    pending = {}
+    for path in itertools.islice(paths, max_in_flight):
+        pending[executor.submit(worker, path)] = path
+
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            path = pending.pop(future)
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"path": path, "error": f"{type(e).__name__}: {e}"}
+            yield path, record
+            for next_path in itertools.islice(paths, 1):
+                pending[executor.submit(worker, next_path)] = next_path
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Caption every image under one or more directories.")
+    parser.add_argument("roots", nargs="+", help="Image files or directories to walk recursively")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to append results to")
+    parser.add_argument("--source", choices=["local", "gemini"], default="local", help="Caption source (default: local)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Parallel workers: processes for local, threads for gemini (default: CPU count)")
+    parser.add_argument("--exact", action="store_true",
+                        help="Local source only: exact full-resolution analysis in bounded memory, without the "
+                             "upload size limits")
+    parser.add_argument("--resume", action="store_true", help="Skip images already captioned in the output file")
+    parser.add_argument("--mood", default="Professional", choices=[m for m in get_mood_prompts() if m != "Custom"],
+                        help="Gemini caption style (default: Professional)")
+    parser.add_argument("--prompt", help="Custom Gemini prompt; overrides --mood")
+    parser.add_argument("--index", default=os.getenv("RESULTS_INDEX_PATH"),
+                        help="Results index to add successful results to (default: RESULTS_INDEX_PATH)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    done = load_done_paths(args.output) if args.resume else set()
+    skipped = 0
+
+    def pending_paths():
+        nonlocal skipped
+        for path in iter_image_paths(args.roots, EXACT_EXTENSIONS if args.exact else IMAGE_EXTENSIONS):
+            path = os.path.realpath(path)
+            if path in done:
+                skipped += 1
+                continue
+            yield path
+
+    if args.exact and args.source != "local":
+        build_parser().error("--exact applies to --source local only")
+
+    if args.source == "local":
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+        worker = caption_file_exact if args.exact else caption_file_local
+    else:
+        prompt = args.prompt or get_mood_prompts()[args.mood]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+        worker = lambda path: caption_file_gemini(path, prompt)
+
+    results_index = ResultsIndex(args.index) if args.index else None
+    records = []
+    processed = errors = 0
+    started = last_report = time.monotonic()
+    try:
+        with executor, open(args.output, "a", encoding="utf-8") as out:
+            for _, record in run_bounded(executor, worker, pending_paths(), max_in_flight=args.workers * 2):
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                processed += 1
+                errors += bool(record.get("error"))
+
+                if results_index is not None and not record.get("error"):
+                    records.append(IndexRecord(
+                        record["sha256"], record["path"], record.get("analysis"),
+                        [(record["source"], None if args.source == "local" else prompt, record["caption"])],
+                    ))
+                    if len(records) >= RESULTS_INDEX_BATCH:
+                        results_index.add_many(records)
+                        records.clear()
+
+                now = time.monotonic()
+                if now - last_report >= 5:
+                    last_report = now
+                    print(f"{processed} done ({errors} errors), {processed / (now - started):.1f} images/s",
+                          file=sys.stderr)
+    finally:
+        if results_index is not None:
+            if records:
+                results_index.add_many(records)
+            results_index.optimize()
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Captioned {processed - errors} images, {errors} errors, {skipped} skipped "
+        f"in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.1f} images/s)",
+        file=sys.stderr,
+    )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
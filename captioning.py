@@ -0,0 +1,955 @@
+"""Caption generation shared by the Streamlit app and headless tools.
+
+Nothing in here talks to Streamlit directly: user-facing problems are passed
+to a notify(level, message) callback, which defaults to logging.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+from animation import ANIMATION_KEYFRAMES, is_animated, keyframe_montage
+from caption_cache import CaptionCache, caption_key
+from dedup_index import NearDuplicateIndex, prompt_key
+from gemini_client import GeminiModelRegistry, GeminiModelUnavailable, preload_sdk, sdk_available
+from image_analysis import LOCAL_ANALYSIS_STAGES, analysis_cache_version, analyze_image_detailed, image_statistics
+from metrics import get_metrics, record_cache, record_payload, record_tokens, stage_timer
+from results_index import IndexRecord, ResultsIndex
+from singleton import process_singleton
+from uploads import open_image
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Optional Google Gemini support. Only checks that the package is installed:
+# importing it pulls in gRPC and protobuf, so that waits for the first request
+GEMINI_AVAILABLE = sdk_available()
+
+class GeminiNotConfigured(RuntimeError):
+    """Raised when no Gemini API key is configured."""
+
+NOTIFY_LEVELS = {"error": logging.ERROR, "warning": logging.WARNING, "info": logging.INFO}
+
+def log_notify(level, message):
+    """Default notifier: route user-facing messages to the module logger."""
+    logger.log(NOTIFY_LEVELS[level], message)
+
+@process_singleton
+def get_gemini_registry(api_key):
+    """Process-wide Gemini model registry, one per API key (see gemini_client.py)."""
+    return GeminiModelRegistry(api_key)
+
+@process_singleton
+def get_async_engine(api_key):
+    """Process-wide async Gemini engine, one per API key (see gemini_async.py)."""
+    # Imported on first use, so the HTTP stack stays out of cold starts
+    from gemini_async import AsyncGeminiEngine
+    return AsyncGeminiEngine.from_env(api_key)
+
+# "sdk" uses google-generativeai directly; "async" routes requests through the
+# rate-limited, retrying, coalescing engine in gemini_async.py
+GEMINI_ENGINE = os.getenv("GEMINI_ENGINE", "sdk").lower()
+
+def preload_gemini():
+    """Start loading the Gemini SDK in the background ahead of a likely request."""
+    if GEMINI_AVAILABLE and GEMINI_ENGINE == "sdk":
+        preload_sdk()
+
+@process_singleton
+def get_caption_cache():
+    """Process-wide Gemini caption cache (see caption_cache.py)."""
+    return CaptionCache.from_env()
+
+@process_singleton
+def get_dedup_index():
+    """Process-wide near-duplicate index, or None unless DEDUP_INDEX_PATH is set (see dedup_index.py)."""
+    return NearDuplicateIndex.from_env()
+
+@process_singleton
+def get_results_index():
+    """Process-wide searchable results store, or None unless RESULTS_INDEX_PATH is set (see results_index.py)."""
+    return ResultsIndex.from_env()
+
+# Sampling settings sent with every Gemini request; part of the caption cache key
+GEMINI_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 1024,
+}
+
+# Images are downscaled and re-encoded before being sent to Gemini; the model
+# gains nothing from camera-resolution pixels or EXIF blocks
+GEMINI_UPLOAD_SETTINGS = {
+    "max_edge": int(os.getenv("GEMINI_UPLOAD_MAX_EDGE", "1536")),
+    "format": os.getenv("GEMINI_UPLOAD_FORMAT", "JPEG").upper(),
+    "quality": int(os.getenv("GEMINI_UPLOAD_QUALITY", "85")),
+}
+
+# compose_gemini_prompt() options a fan-out request varies per caption
+VARIANT_FIELDS = ("platform", "tone", "length")
+# Output budget of one fan-out request (max_output_tokens per variant, capped)
+FANOUT_MAX_OUTPUT_TOKENS = 8192
+
+GEMINI_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+]
+
+UPLOAD_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# Color changes listed in the local report of an animation
+ANIMATION_REPORT_COLORS = 6
+
+# Appended to the prompt when an animation is sent as a keyframe montage
+ANIMATION_PROMPT_NOTE = (
+    "\n\nThe image is a grid of frames taken in order (left to right, top to bottom) from an "
+    "animated image. Caption the animation as a whole; don't describe it as a grid of pictures."
+)
+
+def prepare_image_for_gemini(image_bytes, max_edge=None, image_format=None, quality=None, upload=None):
+    """
+    Downscale and re-encode an image for upload, stripping all metadata.
+    
+    Animated images are sent as one montage of ANIMATION_KEYFRAMES frames
+    (see animation.keyframe_montage), the same size as a still upload,
+    rather than as every frame.
+    
+    Args:
+        image_bytes: The binary image data as uploaded
+        max_edge: Longest edge to send, defaults to GEMINI_UPLOAD_SETTINGS
+        image_format: "JPEG" or "WEBP", defaults to GEMINI_UPLOAD_SETTINGS
+        quality: Encoder quality (1-100), defaults to GEMINI_UPLOAD_SETTINGS
+        upload: Optional uploads.ImageUpload of image_bytes whose shared
+            working image is encoded instead of decoding again
+        
+    Returns:
+        tuple: (payload_bytes, mime_type, stats) where stats holds the
+        original and sent sizes in bytes, and the number of keyframes for
+        animations
+    """
+    max_edge = max_edge or GEMINI_UPLOAD_SETTINGS["max_edge"]
+    image_format = (image_format or GEMINI_UPLOAD_SETTINGS["format"]).upper()
+    quality = quality or GEMINI_UPLOAD_SETTINGS["quality"]
+    if image_format not in ("JPEG", "WEBP"):
+        raise ValueError(f"Unsupported upload format: {image_format} (expected JPEG or WEBP)")
+    
+    keyframe_count = None
+    if upload is not None and upload.can_serve(max_edge) and not upload.animated:
+        original_format = upload.format
+        with stage_timer("decode", pipeline="gemini_upload"):
+            img = upload.fit(max_edge)
+    else:
+        img = open_image(image_bytes)
+        original_format = img.format
+        
+        # Draft-mode decode and downscale happen together in thumbnail()
+        with stage_timer("decode", pipeline="gemini_upload"):
+            if is_animated(img):
+                img, keyframe_count = keyframe_montage(img, max_edge)
+            else:
+                img.thumbnail((max_edge, max_edge), reducing_gap=2.0)
+    with stage_timer("resize", pipeline="gemini_upload"):
+        # Bake in the EXIF rotation, since the EXIF block itself is dropped
+        img = ImageOps.exif_transpose(img)
+    
+    with stage_timer("convert", pipeline="gemini_upload"):
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if image_format == "WEBP" and has_alpha:
+            img = img.convert("RGBA")
+        elif has_alpha:
+            # JPEG has no alpha channel; flatten onto white like most viewers do
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+    
+    out = io.BytesIO()
+    with stage_timer("encode", pipeline="gemini_upload"):
+        # No exif/icc_profile arguments are passed, so no metadata is written
+        img.save(out, format=image_format, quality=quality, optimize=image_format == "JPEG")
+    payload = out.getvalue()
+    record_payload("original", len(image_bytes), pipeline="gemini_upload")
+    record_payload("sent", len(payload), pipeline="gemini_upload")
+    
+    stats = {
+        "original_bytes": len(image_bytes),
+        "original_format": original_format,
+        "sent_bytes": len(payload),
+        "sent_size": img.size,
+    }
+    if keyframe_count is not None:
+        stats["keyframes"] = keyframe_count
+    return payload, UPLOAD_MIME_TYPES[image_format], stats
+
+def fingerprint_image(image_bytes):
+    """Perceptual fingerprint for near-duplicate lookups, or None if the index is disabled."""
+    index = get_dedup_index()
+    return index.fingerprint(image_bytes) if index is not None else None
+
+def _gemini_prompt_key(prompt):
+    return prompt_key(prompt, {**GEMINI_GENERATION_CONFIG, "upload": GEMINI_UPLOAD_SETTINGS})
+
+def find_near_duplicate_analysis(fingerprint):
+    """
+    Find the analysis of an earlier, perceptually near-identical image.
+    
+    Args:
+        fingerprint: From fingerprint_image(); None disables the lookup
+        
+    Returns:
+        tuple: (analysis, hamming_distance), or None if there is no match
+    """
+    index = get_dedup_index()
+    if index is None or fingerprint is None:
+        return None
+    return index.find_analysis(fingerprint, analysis_cache_version())
+
+def find_near_duplicate_caption(fingerprint, prompt):
+    """
+    Find a Gemini caption of an earlier near-identical image for the same prompt.
+    
+    Args:
+        fingerprint: From fingerprint_image(); None disables the lookup
+        prompt: The prompt the caption must have been generated with
+        
+    Returns:
+        tuple: (caption, hamming_distance), or None if there is no match
+    """
+    index = get_dedup_index()
+    if index is None or fingerprint is None:
+        return None
+    return index.find_caption(fingerprint, _gemini_prompt_key(prompt))
+
+def _remember_near_duplicate(image_bytes, analysis=None, prompt=None, caption=None):
+    """Record results in the near-duplicate index; failures are only logged."""
+    index = get_dedup_index()
+    if index is None:
+        return
+    try:
+        fingerprint = index.fingerprint(image_bytes)
+        if analysis is not None:
+            index.put_analysis(fingerprint, analysis, analysis_cache_version())
+        if caption is not None:
+            index.put_caption(fingerprint, _gemini_prompt_key(prompt), caption)
+    except Exception:
+        logger.warning("Could not update the near-duplicate index", exc_info=True)
+
+def _record_result(image_bytes, analysis=None, captions=()):
+    """Record an analysis and/or (source, prompt, caption) tuples in the results index; failures are only logged."""
+    index = get_results_index()
+    if index is None:
+        return
+    try:
+        index.add_many([IndexRecord(hashlib.sha256(image_bytes).hexdigest(), None, analysis, captions)])
+    except Exception:
+        logger.warning("Could not update the results index", exc_info=True)
+
+def caption_with_gemini(image_bytes, prompt=None, use_cache=True, on_upload=None, generation_config=None, upload=None,
+                        searchable=True):
+    """
+    Generate a caption for an image using Google's Gemini multimodal model.
+    
+    Unlike generate_caption_with_gemini(), failures are raised rather than
+    turned into user-facing text, which is what batch tools want.
+    
+    Args:
+        image_bytes: The binary image data
+        prompt: Custom prompt to guide the caption generation
+        use_cache: Serve identical requests (same image, prompt and generation
+            config) from the caption cache. Pass False to force a fresh
+            variant; the new caption still replaces the cached one.
+        on_upload: Optional callable receiving the stats dict from
+            prepare_image_for_gemini() when an image is actually sent
+        generation_config: Overrides GEMINI_GENERATION_CONFIG, e.g. to ask
+            for a JSON response schema
+        upload: Optional uploads.ImageUpload of image_bytes, see
+            prepare_image_for_gemini()
+        searchable: Record a new caption in the results index. Batch tools
+            that bulk-insert their own records pass False.
+        
+    Returns:
+        str: A caption for the image generated by Gemini
+        
+    Raises:
+        GeminiNotConfigured: If GOOGLE_GEMINI_API_KEY is not set
+        GeminiModelUnavailable: If no candidate model could be initialized
+    """
+    generation_config = generation_config or GEMINI_GENERATION_CONFIG
+    api_key, prompt, model_prompt, cache_key = _resolve_gemini_request(image_bytes, prompt, generation_config)
+    # Structured (JSON) responses aren't captions; callers index what they parse out of them
+    searchable = searchable and "response_mime_type" not in generation_config
+    
+    caption_cache = get_caption_cache()
+    if use_cache:
+        cached_caption = caption_cache.get(cache_key)
+        record_cache("caption", cached_caption is not None)
+        if cached_caption is not None:
+            return cached_caption
+    
+    # Shrink and re-encode, then convert to mime-encoded format for the API
+    payload, mime_type, upload_stats = prepare_image_for_gemini(image_bytes, upload=upload)
+    if on_upload is not None:
+        on_upload(upload_stats)
+    
+    if GEMINI_ENGINE == "async":
+        # Identical in-flight requests are coalesced unless a fresh variant was asked for
+        caption = get_async_engine(api_key).caption(
+            model_prompt, payload, mime_type, generation_config, GEMINI_SAFETY_SETTINGS,
+            key=cache_key if use_cache else None,
+        )
+        _store_caption(image_bytes, prompt, cache_key, caption, searchable=searchable)
+        return caption
+    
+    # Shared, already-configured client; model probing happens once per process
+    registry = get_gemini_registry(api_key)
+    
+    # Generate the caption
+    response = registry.generate_content(
+        [model_prompt, _sdk_image_part(payload, mime_type)],
+        generation_config=generation_config,
+        safety_settings=GEMINI_SAFETY_SETTINGS,
+    )
+    
+    # Extract and return the caption
+    if hasattr(response, 'text'):
+        caption = response.text.strip()
+    elif hasattr(response, 'parts'):
+        caption = ''.join(part.text for part in response.parts)
+    else:
+        caption = str(response)
+    _store_caption(image_bytes, prompt, cache_key, caption, searchable=searchable)
+    return caption
+
+def stream_caption_with_gemini(image_bytes, prompt=None, use_cache=True, on_upload=None, upload=None):
+    """
+    Generate a Gemini caption, yielding text chunks as the model produces them.
+    
+    Same inputs, caching and failure behavior as caption_with_gemini(); a
+    cached caption is yielded as a single chunk. Once the stream completes,
+    the full caption is stored in the caption cache.
+    
+    Yields:
+        str: Successive pieces of the caption
+    """
+    api_key, prompt, model_prompt, cache_key = _resolve_gemini_request(image_bytes, prompt, GEMINI_GENERATION_CONFIG)
+    
+    caption_cache = get_caption_cache()
+    if use_cache:
+        cached_caption = caption_cache.get(cache_key)
+        record_cache("caption", cached_caption is not None)
+        if cached_caption is not None:
+            yield cached_caption
+            return
+    
+    payload, mime_type, upload_stats = prepare_image_for_gemini(image_bytes, upload=upload)
+    if on_upload is not None:
+        on_upload(upload_stats)
+    
+    started = time.perf_counter()
+    if GEMINI_ENGINE == "async":
+        chunks = get_async_engine(api_key).stream(
+            model_prompt, payload, mime_type, GEMINI_GENERATION_CONFIG, GEMINI_SAFETY_SETTINGS
+        )
+    else:
+        chunks = _sdk_stream(get_gemini_registry(api_key), model_prompt, payload, mime_type)
+    
+    parts = []
+    for chunk in chunks:
+        if not parts:
+            get_metrics().observe("stage_seconds", time.perf_counter() - started, stage="first_token", pipeline="gemini")
+        parts.append(chunk)
+        yield chunk
+    _store_caption(image_bytes, prompt, cache_key, "".join(parts).strip())
+
+def _resolve_gemini_request(image_bytes, prompt, generation_config):
+    """Return (api_key, prompt, model_prompt, cache_key) for a caption request, applying the default prompt.
+
+    model_prompt is the text sent to Gemini: the prompt plus, for an
+    animation, ANIMATION_PROMPT_NOTE. Captions are indexed and looked up
+    under the user's prompt.
+    """
+    api_key = os.getenv("GOOGLE_GEMINI_API_KEY")
+    if not api_key:
+        raise GeminiNotConfigured("Gemini API key not configured. Please add your API key to the .env file.")
+    
+    # Default prompt if none provided
+    if not prompt:
+        prompt = "Generate a detailed, creative caption for this image that would work well on social media."
+    
+    model_prompt = prompt
+    upload_settings = GEMINI_UPLOAD_SETTINGS
+    if _is_animation(image_bytes):
+        model_prompt += ANIMATION_PROMPT_NOTE
+        upload_settings = {**upload_settings, "keyframes": ANIMATION_KEYFRAMES}
+    cache_key = caption_key(
+        image_bytes, model_prompt, {**generation_config, "upload": upload_settings}
+    )
+    return api_key, prompt, model_prompt, cache_key
+
+def _is_animation(image_bytes):
+    """Whether the bytes hold an animation; unreadable data is left for the upload to reject."""
+    try:
+        return is_animated(open_image(image_bytes, max_bytes=0))
+    except Exception:
+        return False
+
+def _sdk_image_part(payload, mime_type):
+    """Inline image part in the shape google-generativeai expects."""
+    with stage_timer("base64_encode", pipeline="gemini"):
+        encoded = base64.b64encode(payload).decode("utf-8")
+    return {
+        "inline_data": {
+            "mime_type": mime_type,
+            "data": encoded
+        }
+    }
+
+def _sdk_stream(registry, prompt, payload, mime_type):
+    """Yield caption text chunks from the SDK's streaming generate_content."""
+    response = registry.generate_content(
+        [prompt, _sdk_image_part(payload, mime_type)],
+        generation_config=GEMINI_GENERATION_CONFIG,
+        safety_settings=GEMINI_SAFETY_SETTINGS,
+        stream=True,
+    )
+    received = False
+    for chunk in response:
+        # chunk.text raises on chunks without parts (e.g. a bare finish reason)
+        text = "".join(part.text for part in chunk.parts) if chunk.candidates else ""
+        if text:
+            received = True
+            yield text
+    if not received:
+        # Surfaces the SDK's explanation for a blocked or empty response
+        yield response.text
+    # Usage metadata is only complete once the stream has been consumed
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        record_tokens(
+            getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None),
+            getattr(usage, "total_token_count", None),
+        )
+
+def _store_caption(image_bytes, prompt, cache_key, caption, searchable=True):
+    """Save a finished caption to the caption cache, near-duplicate index and, if searchable, results index."""
+    get_caption_cache().put(cache_key, caption)
+    _remember_near_duplicate(image_bytes, prompt=prompt, caption=caption)
+    if searchable:
+        _record_result(image_bytes, captions=[("gemini", prompt, caption)])
+
+def generate_caption_with_gemini(image_bytes, prompt=None, use_cache=True, on_upload=None, notify=None, upload=None):
+    """
+    Generate a Gemini caption, reporting failures as readable text.
+    
+    Args:
+        image_bytes: The binary image data
+        prompt: Custom prompt to guide the caption generation
+        use_cache: See caption_with_gemini()
+        on_upload: See caption_with_gemini()
+        upload: See caption_with_gemini()
+        notify: Optional callable(level, message) for error details, with
+            level one of "error", "warning" or "info"; defaults to logging
+        
+    Returns:
+        str: A caption for the image generated by Gemini, or an explanation
+        of why none could be generated
+    """
+    try:
+        return caption_with_gemini(image_bytes, prompt, use_cache=use_cache, on_upload=on_upload, upload=upload)
+    except Exception as e:
+        return _gemini_error_text(e, notify or log_notify)
+
+def generate_caption_stream(image_bytes, prompt=None, use_cache=True, on_upload=None, notify=None, upload=None):
+    """
+    Streaming counterpart of generate_caption_with_gemini().
+    
+    Yields caption chunks as they arrive; if the request fails, the readable
+    explanation is yielded instead (after any text already received).
+    
+    Yields:
+        str: Successive pieces of the caption or error text
+    """
+    try:
+        yield from stream_caption_with_gemini(
+            image_bytes, prompt, use_cache=use_cache, on_upload=on_upload, upload=upload
+        )
+    except Exception as e:
+        yield _gemini_error_text(e, notify or log_notify)
+
+def _gemini_error_text(error, notify):
+    """Report a Gemini failure through notify and return text to show instead of a caption."""
+    if isinstance(error, GeminiNotConfigured):
+        return f"⚠️ {error}"
+    if isinstance(error, GeminiModelUnavailable):
+        notify("error", str(error))
+        return "Gemini model initialization failed. Please check your API access and model availability."
+    # Log the detailed error for debugging
+    logger.error("Gemini caption generation failed", exc_info=error)
+    notify("error", f"Error generating caption with Gemini: {str(error)}")
+    return f"Unable to generate caption with Gemini. Error: {str(error)}"
+
+def get_mood_prompts():
+    """Get mood-based prompt templates for caption generation."""
+    return {
+        "Professional": "Generate a professional, business-appropriate caption for this image that would work well for corporate social media.",
+        "Casual/Friendly": "Create a casual, friendly caption that feels personal and relatable for everyday social media posts.",
+        "Creative/Artistic": "Write an artistic, creative caption that focuses on the aesthetic and emotional aspects of this image.",
+        "Humorous/Funny": "Generate a humorous, light-hearted caption that could make people smile or laugh.",
+        "Inspirational": "Create an uplifting, motivational caption that inspires and encourages viewers.",
+        "Travel/Adventure": "Write a travel-focused caption that captures the sense of adventure and wanderlust.",
+        "Food/Culinary": "Generate a mouth-watering caption perfect for food photography and culinary content.",
+        "Fashion/Style": "Create a stylish, fashion-forward caption that highlights the aesthetic and trendiness.",
+        "Nature/Outdoor": "Write a caption that celebrates nature, outdoor beauty, and environmental appreciation.",
+        "Minimalist": "Generate a clean, simple caption that matches a minimalist aesthetic.",
+        "Gen Z/Social Media": "Create a trendy, Gen Z style caption with relevant hashtags and social media language.",
+        "Custom": "Custom prompt"
+    }
+
+def compose_gemini_prompt(
+    base_prompt: str,
+    platform: str,
+    tone: str,
+    length: str,
+    include_hashtags: bool,
+    num_hashtags: int,
+    include_emojis: bool,
+    num_emojis: int,
+    keywords_csv: str,
+    audience: str,
+    call_to_action: str
+) -> str:
+    """Compose a detailed prompt for Gemini based on user-selected options.
+
+    The function appends clear, actionable instructions so the model tailors
+    its caption output to the desired platform, tone, and formatting.
+    """
+    instructions = [base_prompt]
+    instructions += _style_instructions(platform, tone, length)
+    instructions += _content_instructions(
+        include_hashtags, num_hashtags, include_emojis, num_emojis, keywords_csv, audience, call_to_action
+    )
+
+    # Safety and output format guidance
+    instructions.append(
+        "Return only the final caption text without explanations. Keep it readable and persuasive."
+    )
+
+    return "\n".join(instructions)
+
+def _style_instructions(platform, tone, length):
+    """Platform, tone and length constraints; the parts a fan-out varies."""
+    instructions = []
+    if platform and platform != "Generic":
+        instructions.append(f"Target the '{platform}' platform and follow its best practices.")
+    if tone:
+        instructions.append(f"Use a {tone.lower()} tone.")
+    if length:
+        instructions.append(f"Keep the caption {length.lower()} in length.")
+    return instructions
+
+def _content_instructions(include_hashtags, num_hashtags, include_emojis, num_emojis,
+                          keywords_csv, audience, call_to_action):
+    """Formatting and content constraints shared by every variant."""
+    instructions = []
+
+    # Formatting controls
+    if include_hashtags:
+        instructions.append(
+            f"Include up to {num_hashtags} concise, relevant hashtags at the end (no spaces inside hashtags)."
+        )
+    else:
+        instructions.append("Do not include any hashtags.")
+
+    if include_emojis:
+        instructions.append(f"Use up to {num_emojis} relevant emojis for tone and emphasis.")
+    else:
+        instructions.append("Do not include any emojis.")
+
+    # Content constraints
+    if keywords_csv.strip():
+        instructions.append(
+            "Naturally incorporate these keywords if appropriate: " + keywords_csv.strip()
+        )
+    if audience.strip():
+        instructions.append(f"Write for this audience: {audience.strip()}.")
+    if call_to_action.strip():
+        instructions.append(f"End with a subtle call-to-action: {call_to_action.strip()}.")
+    return instructions
+
+def compose_variants_prompt(variants, base_prompt, include_hashtags, num_hashtags, include_emojis,
+                            num_emojis, keywords_csv, audience, call_to_action):
+    """Compose one prompt asking Gemini for a caption per variant, as JSON.
+
+    Args:
+        variants: List of {"platform", "tone", "length"} dicts
+        base_prompt, include_hashtags, ...: As for compose_gemini_prompt(),
+            shared by every variant
+
+    Returns:
+        str: A prompt to send with variants_generation_config()
+    """
+    instructions = [base_prompt]
+    instructions += _content_instructions(
+        include_hashtags, num_hashtags, include_emojis, num_emojis, keywords_csv, audience, call_to_action
+    )
+    instructions.append(f"Write {len(variants)} separate captions, one for each of these variants:")
+    for number, variant in enumerate(variants, 1):
+        style = _style_instructions(variant.get("platform"), variant.get("tone"), variant.get("length"))
+        instructions.append(f"Variant {number}: " + (" ".join(style) or "No specific platform, tone or length."))
+    instructions.append(
+        'Respond with JSON of the form {"captions": [{"variant": 1, "caption": "..."}]}, exactly one '
+        "entry per variant. Each caption is the final caption text without explanations, "
+        "readable and persuasive."
+    )
+    return "\n".join(instructions)
+
+def variants_generation_config(count):
+    """GEMINI_GENERATION_CONFIG with a JSON schema for count variant captions."""
+    return {
+        **GEMINI_GENERATION_CONFIG,
+        "max_output_tokens": min(FANOUT_MAX_OUTPUT_TOKENS, GEMINI_GENERATION_CONFIG["max_output_tokens"] * count),
+        "response_mime_type": "application/json",
+        "response_schema": {
+            "type": "OBJECT",
+            "properties": {
+                "captions": {
+                    "type": "ARRAY",
+                    "min_items": count,
+                    "max_items": count,
+                    "items": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "variant": {"type": "INTEGER"},
+                            "caption": {"type": "STRING"},
+                        },
+                        "required": ["variant", "caption"],
+                    },
+                },
+            },
+            "required": ["captions"],
+        },
+    }
+
+def parse_variant_captions(text, count):
+    """Validate a fan-out response and return {variant_index: caption}.
+
+    Entries that are malformed, out of range, duplicated or empty are left
+    out, so the caller can re-request just those variants.
+
+    Raises:
+        ValueError: If the response is not JSON with a "captions" list
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Fan-out response is not valid JSON: {e}") from e
+    entries = data.get("captions") if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        raise ValueError('Fan-out response has no "captions" list')
+
+    captions = {}
+    duplicates = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        number, caption = entry.get("variant"), entry.get("caption")
+        if not isinstance(number, int) or not 1 <= number <= count:
+            continue
+        if not isinstance(caption, str) or not caption.strip():
+            continue
+        if number - 1 in captions:
+            duplicates.add(number - 1)
+        captions[number - 1] = caption.strip()
+    for index in duplicates:
+        del captions[index]
+    return captions
+
+def caption_variants(image_bytes, variants, prompt_options, use_cache=True, on_upload=None, upload=None):
+    """
+    Generate one caption per platform/tone/length variant in a single request.
+    
+    The image is uploaded once and Gemini answers with JSON matching
+    variants_generation_config(). Variants missing from (or invalid in) the
+    response are generated one by one with compose_gemini_prompt(), as is
+    every variant if the response can't be parsed at all.
+    
+    Args:
+        image_bytes: The binary image data
+        variants: List of {"platform", "tone", "length"} dicts
+        prompt_options: The remaining compose_gemini_prompt() arguments
+            (base_prompt, include_hashtags, ...), shared by every variant
+        use_cache, on_upload, upload: As for caption_with_gemini()
+    
+    Returns:
+        list: One {"platform", "tone", "length", "caption", "fallback"} dict
+        per variant, in order; fallback is True for per-variant calls
+        
+    Raises:
+        GeminiNotConfigured: If GOOGLE_GEMINI_API_KEY is not set
+        GeminiModelUnavailable: If no candidate model could be initialized
+    """
+    if not variants:
+        return []
+    
+    captions = {}
+    if len(variants) > 1:
+        prompt = compose_variants_prompt(variants, **prompt_options)
+        generation_config = variants_generation_config(len(variants))
+        response = caption_with_gemini(
+            image_bytes, prompt, use_cache=use_cache, on_upload=on_upload,
+            generation_config=generation_config, upload=upload,
+        )
+        try:
+            captions = parse_variant_captions(response, len(variants))
+        except ValueError as e:
+            logger.warning("Falling back to one request per variant: %s", e)
+            # Don't serve the unparseable response from the cache next time
+            get_caption_cache().discard(_resolve_gemini_request(image_bytes, prompt, generation_config)[3])
+        get_metrics().inc("fanout_variants_total", len(captions), result="structured")
+        _record_result(image_bytes, captions=[
+            ("gemini", compose_gemini_prompt(**{field: variants[index].get(field) for field in VARIANT_FIELDS},
+                                             **prompt_options), caption)
+            for index, caption in captions.items()
+        ])
+    
+    results = []
+    for index, variant in enumerate(variants):
+        variant = {field: variant.get(field) for field in VARIANT_FIELDS}
+        # A single variant needs no fan-out, so it isn't a fallback either
+        fallback = len(variants) > 1 and index not in captions
+        if index not in captions:
+            if fallback:
+                get_metrics().inc("fanout_variants_total", result="fallback")
+            caption = caption_with_gemini(
+                image_bytes,
+                compose_gemini_prompt(**variant, **prompt_options),
+                use_cache=use_cache,
+                on_upload=on_upload,
+                upload=upload,
+            )
+        else:
+            caption = captions[index]
+        results.append({**variant, "caption": caption, "fallback": fallback})
+    return results
+
+def generate_caption_variants(image_bytes, variants, prompt_options, use_cache=True, on_upload=None, notify=None,
+                              upload=None):
+    """
+    Fan-out counterpart of generate_caption_with_gemini().
+    
+    Returns:
+        list: As caption_variants(); on failure every variant's caption is
+        the readable explanation instead
+    """
+    try:
+        return caption_variants(
+            image_bytes, variants, prompt_options, use_cache=use_cache, on_upload=on_upload, upload=upload
+        )
+    except Exception as e:
+        message = _gemini_error_text(e, notify or log_notify)
+        return [
+            {**{field: variant.get(field) for field in VARIANT_FIELDS}, "caption": message, "fallback": False}
+            for variant in variants
+        ]
+
+def local_caption(analysis):
+    """Build the one-paragraph caption for a successful local analysis."""
+    basic_info = analysis["basic_info"]
+    color_analysis = analysis["color_analysis"]
+    complexity = analysis["complexity"]
+    
+    descriptors = ["striking", "captivating", "interesting", "compelling", "eye-catching", "engaging"]
+    descriptor = random.choice(descriptors)
+    kind = "animation" if analysis.get("animation") else "image"
+    
+    if color_analysis.get("is_color", False):
+        primary_color = color_analysis['dominant_colors'][0]['name'].lower() if color_analysis.get('dominant_colors') else "balanced"
+        return f"A {descriptor} {basic_info['orientation'].lower()} {kind} with {primary_color} tones. This {complexity['level'].lower()} composition shows careful visual balance and {color_analysis['brightness_level'].lower()} lighting."
+    return f"A {descriptor} {basic_info['orientation'].lower()} black and white {kind}. This {complexity['level'].lower()} composition demonstrates strong contrast and timeless appeal."
+
+def format_local_report(analysis, caption=None):
+    """
+    Render a local analysis result as a Markdown report with a short caption.
+    
+    Args:
+        analysis: A successful result of analyze_image_detailed()
+        caption: The short caption to include, defaults to a new
+            local_caption(analysis)
+    
+    Returns:
+        str: The Markdown report
+    """
+    basic_info = analysis["basic_info"]
+    color_analysis = analysis["color_analysis"]
+    complexity = analysis["complexity"]
+    
+    # Build comprehensive description
+    description_parts = []
+    
+    # Basic info
+    description_parts.append(f"📐 **Image Dimensions**: {basic_info['width']} × {basic_info['height']} pixels ({basic_info['orientation']})")
+    description_parts.append(f"📊 **Aspect Ratio**: {basic_info['aspect_ratio']} ({basic_info['aspect_class']})")
+    description_parts.append(f"🎨 **Format**: {basic_info['file_format']} • **Mode**: {basic_info['color_mode']}")
+    description_parts.append(f"💾 **File Size**: {basic_info['file_size_bytes'] / 1024:.1f} KB • **Pixels**: {basic_info['total_pixels']:,}")
+    
+    # Animation, summarized over the sampled frames
+    animation = analysis.get("animation")
+    if animation:
+        description_parts.extend(_animation_report(animation))
+    
+    # Color analysis
+    if color_analysis.get("is_color", False):
+        description_parts.append(f"🌈 **Color Analysis**:")
+        description_parts.append(f"   • Brightness: {color_analysis['brightness']}% ({color_analysis['brightness_level']})")
+        description_parts.append(f"   • Contrast: {color_analysis['contrast']}% ({color_analysis['contrast_level']})")
+            
+        if color_analysis.get('dominant_colors'):
+            color_list = []
+            for color in color_analysis['dominant_colors'][:3]:
+                color_list.append(f"{color['name']} ({color['percentage']}%)")
+            description_parts.append(f"   • Dominant Colors: {', '.join(color_list)}")
+    else:
+        description_parts.append("🎭 **Color Mode**: Black & White/Grayscale")
+    
+    # Complexity
+    description_parts.append(f"🔍 **Visual Complexity**: {complexity['level']} (Edge Density: {complexity['edge_density']})")
+    
+    # Quality
+    stats = image_statistics(analysis)
+    luma = stats.luma
+    description_parts.append("🔬 **Image Quality**:")
+    description_parts.append(
+        f"   • Sharpness: {'Blurry' if stats.is_blurry else 'Sharp'} (Laplacian variance {stats.laplacian_variance:.0f})"
+    )
+    description_parts.append(f"   • Noise: σ ≈ {stats.noise_sigma:.1f}")
+    description_parts.append(
+        f"   • Tonal range: {luma.percentiles[5]}–{luma.percentiles[95]} (5th–95th percentile of 0–255)"
+    )
+    description_parts.append(
+        f"   • Clipping: {luma.clipped_shadows:.1%} shadows, {luma.clipped_highlights:.1%} highlights"
+    )
+    
+    # Generate a simple caption
+    if caption is None:
+        caption = local_caption(analysis)
+    
+    description_parts.append(f"\n📝 **Generated Caption**:\n{caption}")
+    
+    return "\n".join(description_parts)
+
+def _animation_report(animation):
+    """Report lines for the "animation" entry of an analysis."""
+    timeline = animation["timeline"]
+    loop = animation["loop"]
+    looping = "plays once" if loop is None else "loops forever" if loop == 0 else f"loops {loop}×"
+    lines = [
+        f"🎞️ **Animation**: {animation['frame_count']} frames, {animation['duration_ms'] / 1000:.1f} s, {looping}",
+        f"   • Sampled every {animation['sample_interval_ms'] / 1000:.2f} s ({animation['sampled_frames']} distinct frames); "
+        f"the colors, brightness and complexity below are pooled over the samples",
+    ]
+    brightness = [entry["brightness"] for entry in timeline]
+    edges = [entry["edge_density"] for entry in timeline]
+    lines.append(f"   • Brightness over time: {min(brightness)}–{max(brightness)}%")
+    lines.append(f"   • Edge density over time: {min(edges)}–{max(edges)}")
+    colors = [entry["dominant_color"] for entry in timeline if "dominant_color" in entry]
+    if colors:
+        # Consecutive repeats collapse, so this reads as the color changes
+        changes = [color for i, color in enumerate(colors) if i == 0 or color != colors[i - 1]]
+        shown = changes[:ANIMATION_REPORT_COLORS] + (["…"] if len(changes) > ANIMATION_REPORT_COLORS else [])
+        lines.append(f"   • Dominant color over time: {' → '.join(shown)}")
+    return lines
+
+def generate_caption(image_bytes, caption_source="local", custom_prompt=None, mood_type="Professional", on_stage=None, use_cache=True, on_upload=None, notify=None, upload=None):
+    """
+    Generate a caption for an image using either local analysis or Gemini.
+    
+    Args:
+        image_bytes: The binary image data
+        caption_source: "local" for offline processing, "gemini" for AI-generated captions
+        custom_prompt: Custom prompt for Gemini (ignored for local captions)
+        mood_type: Mood/style for caption generation
+        on_stage: Optional progress callback for local analysis, see
+            analyze_image_detailed()
+        use_cache: Whether cached results may be reused; pass False to
+            request a fresh Gemini variant
+        on_upload: Optional callback receiving Gemini upload size stats
+        notify: Optional callable(level, message) for warnings and errors,
+            see generate_caption_with_gemini()
+        upload: Optional uploads.ImageUpload of image_bytes, so the image
+            is decoded only once across display, analysis and upload
+        
+    Returns:
+        str: A descriptive caption for the image
+    """
+    notify = notify or log_notify
+
+    # If Gemini is selected and available, use it
+    if caption_source == "gemini":
+        if GEMINI_AVAILABLE:
+            # Use mood-based prompts
+            mood_prompts = get_mood_prompts()
+            if mood_type in mood_prompts and mood_type != "Custom":
+                prompt = mood_prompts[mood_type]
+            elif custom_prompt:
+                prompt = custom_prompt
+            else:
+                prompt = mood_prompts["Professional"]
+            
+            return generate_caption_with_gemini(image_bytes, prompt, use_cache=use_cache, on_upload=on_upload, notify=notify, upload=upload)
+        else:
+            notify("warning", "Google Generative AI package not installed. Run 'pip install google-generativeai'")
+            notify("info", "Falling back to local caption generation.")
+    
+    # Local caption generation (enhanced)
+    try:
+        # Get detailed analysis
+        cache_hits = []
+        analysis = analyze_image_detailed(
+            image_bytes, on_stage=on_stage, use_cache=use_cache, upload=upload, on_cache=cache_hits.append
+        )
+        
+        if "error" in analysis:
+            return f"Error analyzing image: {analysis['error']}"
+        _remember_near_duplicate(image_bytes, analysis=analysis)
+        
+        caption = local_caption(analysis)
+        report = format_local_report(analysis, caption)
+        # A cached analysis was indexed when it was first computed; like the
+        # batch and CLI paths, only the short caption is searchable
+        if not any(cache_hits):
+            _record_result(image_bytes, analysis=analysis, captions=[("local", None, caption)])
+        if on_stage is not None:
+            on_stage("report", len(LOCAL_ANALYSIS_STAGES), len(LOCAL_ANALYSIS_STAGES))
+        return report
+    
+    except Exception as e:
+        # Handle any errors gracefully
+        notify("error", f"Error generating caption: {str(e)}")
+        return f"An image was uploaded. (Error during analysis: {str(e)})"
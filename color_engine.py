@@ -0,0 +1,305 @@
+"""Vectorized color naming and dominant-color extraction with NumPy.
+
+Color naming converts whole pixel arrays to HSV at once and maps them
+through a lookup table of bins instead of a per-pixel if/elif ladder. The
+names match the original scalar rules exactly:
+
+* saturation < 0.1 is achromatic: Black (v < 0.3), White (v > 0.8) or Gray
+* otherwise the hue picks Red/Orange/Yellow/Green/Teal/Blue/Purple/Pink,
+  saturation adds "Pale" (< 0.4) or "Vibrant" (> 0.8), and value < 0.4
+  adds "Dark"
+
+Dominant colors come from k-means (default) or Pillow's median cut. The
+k-means implementation is batched, so palettes for N images are fitted in
+one set of array operations (see dominant_colors_batch). StreamingPalette
+fits the same k-means palette from an image fed in strips, for images too
+large to hold as one pixel array.
+"""
+
+import numpy as np
+from PIL import Image
+
+# Upper hue edges of Red, Orange, Yellow, Green, Teal, Blue, Purple; Pink
+# runs to 0.95 and anything above wraps around to Red again
+HUE_EDGES = np.array([0.05, 0.15, 0.22, 0.41, 0.55, 0.75, 0.82])
+HUE_NAMES = ["Red", "Orange", "Yellow", "Green", "Teal", "Blue", "Purple", "Pink"]
+SATURATION_PREFIXES = ["Pale ", "", "Vibrant "]
+
+
+def _build_name_table():
+    """Lookup table indexed by hue_bin * 6 + saturation_bin * 2 + is_dark."""
+    table = []
+    for hue_name in HUE_NAMES:
+        for prefix in SATURATION_PREFIXES:
+            table.append(f"{prefix}{hue_name}")
+            table.append(f"Dark {prefix}{hue_name}")
+    return np.array(table + ["Black", "Gray", "White"])
+
+
+NAME_TABLE = _build_name_table()
+ACHROMATIC_OFFSET = len(HUE_NAMES) * 6
+
+# Samples used to fit k-means; assignment still covers every pixel
+KMEANS_SAMPLE_SIZE = 16384
+KMEANS_ITERATIONS = 12
+# Images fitted together per vectorized k-means call, bounding memory
+KMEANS_BATCH_CHUNK = 32
+# Pixels assigned to centers per array operation (~45 bytes each at k=8)
+KMEANS_ASSIGN_CHUNK = 1 << 20
+
+
+def rgb_to_hsv(rgb):
+    """Convert an (..., 3) array of 0-255 RGB values to H, S, V arrays in [0, 1].
+
+    Equivalent to colorsys.rgb_to_hsv applied element-wise.
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = rgb.max(axis=-1)
+    minc = rgb.min(axis=-1)
+    delta = maxc - minc
+    v = maxc
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = np.where(maxc > 0, delta / maxc, 0.0)
+        safe_delta = np.where(delta > 0, delta, 1.0)
+        rc = (maxc - r) / safe_delta
+        gc = (maxc - g) / safe_delta
+        bc = (maxc - b) / safe_delta
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(delta > 0, (h / 6.0) % 1.0, 0.0)
+    return h, s, v
+
+
+def name_colors(rgb):
+    """Name every color in an (..., 3) RGB array; returns an array of str."""
+    h, s, v = rgb_to_hsv(rgb)
+    hue_bin = np.where(h > 0.95, 0, np.digitize(h, HUE_EDGES))
+    saturation_bin = np.where(s < 0.4, 0, np.where(s > 0.8, 2, 1))
+    is_dark = (v < 0.4).astype(np.intp)
+    index = hue_bin * 6 + saturation_bin * 2 + is_dark
+
+    achromatic = s < 0.1
+    gray_index = ACHROMATIC_OFFSET + np.where(v < 0.3, 0, np.where(v > 0.8, 2, 1))
+    index = np.where(achromatic, gray_index, index)
+    return NAME_TABLE[index]
+
+
+def image_pixels(img):
+    """Return an RGB image's pixels as an (N, 3) uint8 array."""
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img, dtype=np.uint8).reshape(-1, 3)
+
+
+def _sample(pixels, size, rng):
+    """Pick exactly size rows (with replacement only if there are fewer)."""
+    replace = len(pixels) < size
+    return pixels[rng.choice(len(pixels), size=size, replace=replace)]
+
+
+def _kmeans_batch(samples, k, draws):
+    """Batched Lloyd's k-means with k-means++ init.
+
+    Args:
+        samples: float32 array of shape (N, P, 3)
+        k: Number of clusters
+        draws: Uniform [0, 1) array of shape (N, k) driving the seeding, so
+            each image's result does not depend on the rest of the batch
+
+    Returns:
+        float32 array of centers, shape (N, k, 3)
+    """
+    n, p, _ = samples.shape
+    rows = np.arange(n)
+    squared_norms = (samples ** 2).sum(-1)
+
+    # k-means++ seeding, vectorized across the batch
+    centers = np.empty((n, k, 3), dtype=np.float32)
+    centers[:, 0] = samples[rows, (draws[:, 0] * p).astype(np.intp)]
+    closest = ((samples - centers[:, :1]) ** 2).sum(-1)
+    for j in range(1, k):
+        weights = closest / np.maximum(closest.sum(axis=1, keepdims=True), 1e-12)
+        cumulative = weights.cumsum(axis=1)
+        picks = (cumulative < draws[:, j:j + 1]).sum(axis=1).clip(0, p - 1)
+        centers[:, j] = samples[rows, picks]
+        closest = np.minimum(closest, ((samples - centers[:, j:j + 1]) ** 2).sum(-1))
+
+    active = np.ones(n, dtype=bool)
+    for _ in range(KMEANS_ITERATIONS):
+        # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2 keeps memory at (N, P, k)
+        distances = (
+            squared_norms[:, :, None]
+            - 2 * (samples @ centers.transpose(0, 2, 1))
+            + (centers ** 2).sum(-1)[:, None, :]
+        )
+        labels = distances.argmin(axis=2)
+        one_hot = labels[:, :, None] == np.arange(k)
+        counts = one_hot.sum(axis=1)
+        sums = one_hot.astype(np.float32).transpose(0, 2, 1) @ samples
+        # Empty clusters keep their previous center
+        updated = np.where(counts[:, :, None] > 0, sums / np.maximum(counts, 1)[:, :, None], centers)
+        # Images stop moving once they converge, independently of the batch
+        updated = np.where(active[:, None, None], updated, centers).astype(np.float32)
+        active &= ~np.all(np.abs(updated - centers) <= 0.5, axis=(1, 2))
+        centers = updated
+        if not active.any():
+            break
+    return centers
+
+
+def _palette_from_counts(centers, counts, total, top):
+    """Build the dominant_colors list from cluster centers and pixel counts."""
+    order = np.argsort(-counts, kind="stable")
+    order = order[counts[order] > 0][:top]
+    rgb = np.clip(np.rint(centers[order]), 0, 255).astype(int)
+    names = name_colors(rgb)
+    return [
+        {
+            "name": str(name),
+            "percentage": round(float(counts[i]) / total * 100, 1),
+            "rgb": [int(c) for c in color],
+        }
+        for i, name, color in zip(order, names, rgb)
+    ]
+
+
+def dominant_colors_batch(images, k=8, method="kmeans", top=5, seed=0):
+    """Return one dominant-color palette per image.
+
+    Args:
+        images: Sequence of PIL images (any mode; converted to RGB)
+        k: Number of clusters / palette entries to fit
+        method: "kmeans" (batched NumPy) or "median_cut" (Pillow quantize)
+        top: Number of colors to return per image
+        seed: RNG seed for sampling and k-means++ init
+
+    Returns:
+        list: For each image, a list of {"name", "percentage", "rgb"} dicts
+        sorted by coverage
+    """
+    if method == "median_cut":
+        return [_median_cut_palette(img, k, top) for img in images]
+    if method != "kmeans":
+        raise ValueError(f"Unknown color method: {method!r} (expected 'kmeans' or 'median_cut')")
+    if not images:
+        return []
+
+    palettes = []
+    for start in range(0, len(images), KMEANS_BATCH_CHUNK):
+        palettes.extend(_kmeans_palettes(images[start:start + KMEANS_BATCH_CHUNK], k, top, seed))
+    return palettes
+
+
+def _kmeans_palettes(images, k, top, seed):
+    """Fit k-means for a chunk of images in one batched call."""
+    pixel_sets = [image_pixels(img) for img in images]
+    samples = []
+    draws = []
+    for pixels in pixel_sets:
+        # A fresh generator per image keeps results independent of batching
+        rng = np.random.default_rng(seed)
+        samples.append(_sample(pixels, KMEANS_SAMPLE_SIZE, rng))
+        draws.append(rng.random(k))
+    all_centers = _kmeans_batch(np.stack(samples).astype(np.float32), k, np.stack(draws))
+
+    palettes = []
+    for pixels, centers in zip(pixel_sets, all_centers):
+        # Assign every pixel (not just the sample) so percentages are exact
+        counts = _assign_counts(pixels, centers)
+        palettes.append(_palette_from_counts(centers, counts, len(pixels), top))
+    return palettes
+
+
+def _assign_counts(pixels, centers):
+    """Count the (N, 3) uint8 pixels nearest to each of the k centers."""
+    k = len(centers)
+    counts = np.zeros(k, dtype=np.int64)
+    center_norms = (centers ** 2).sum(-1)[None, :]
+    for start in range(0, len(pixels), KMEANS_ASSIGN_CHUNK):
+        px = pixels[start:start + KMEANS_ASSIGN_CHUNK].astype(np.float32)
+        # ||x - c||^2 minus the ||x||^2 term, which is the same for every center
+        distances = center_norms - 2 * px @ centers.T
+        counts += np.bincount(distances.argmin(axis=1), minlength=k)
+    return counts
+
+
+class StreamingPalette:
+    """k-means dominant colors of an image that arrives in strips.
+
+    Makes two passes over the pixels: sample() gathers exactly the pixels
+    dominant_colors() would sample from the whole image (same seed, same
+    indices), fit() clusters them, and assign() counts every pixel against
+    the fitted centers. Only the sample and one strip are held in memory,
+    and the palette equals dominant_colors(img, method="kmeans") for the
+    same k, top and seed.
+
+    Example:
+        palette = StreamingPalette(width * height, k=8)
+        for strip in strips():
+            palette.sample(image_pixels(strip))
+        palette.fit()
+        for strip in strips():
+            palette.assign(image_pixels(strip))
+        colors = palette.palette()
+    """
+
+    def __init__(self, total_pixels, k=8, top=5, seed=0):
+        self.total_pixels = total_pixels
+        self.k = k
+        self.top = top
+        rng = np.random.default_rng(seed)
+        indices = rng.choice(total_pixels, size=KMEANS_SAMPLE_SIZE, replace=total_pixels < KMEANS_SAMPLE_SIZE)
+        self._draws = rng.random(k)
+        # Sample slots sorted by pixel index so each strip picks a contiguous run
+        self._order = np.argsort(indices, kind="stable")
+        self._indices = indices[self._order]
+        self._samples = np.zeros((KMEANS_SAMPLE_SIZE, 3), dtype=np.uint8)
+        self._sampled = 0
+        self._assigned = 0
+        self.centers = None
+        self.counts = np.zeros(k, dtype=np.int64)
+
+    def sample(self, pixels):
+        """First pass: take the sampled pixels out of the next (N, 3) strip."""
+        start, stop = self._sampled, self._sampled + len(pixels)
+        lo, hi = np.searchsorted(self._indices, [start, stop])
+        self._samples[self._order[lo:hi]] = pixels[self._indices[lo:hi] - start]
+        self._sampled = stop
+
+    def fit(self):
+        """Cluster the gathered sample once every strip has been sampled."""
+        if self._sampled != self.total_pixels:
+            raise ValueError(f"Sampled {self._sampled} of {self.total_pixels} pixels")
+        self.centers = _kmeans_batch(self._samples[None].astype(np.float32), self.k, self._draws[None])[0]
+
+    def assign(self, pixels):
+        """Second pass: count the next (N, 3) strip against the centers.
+
+        Returns:
+            numpy.ndarray: The strip's pixel count per center
+        """
+        counts = _assign_counts(pixels, self.centers)
+        self.counts += counts
+        self._assigned += len(pixels)
+        return counts
+
+    def palette(self):
+        """The dominant_colors() list once every strip has been assigned."""
+        if self._assigned != self.total_pixels:
+            raise ValueError(f"Assigned {self._assigned} of {self.total_pixels} pixels")
+        return _palette_from_counts(self.centers, self.counts, self.total_pixels, self.top)
+
+
+def dominant_colors(img, k=8, method="kmeans", top=5, seed=0):
+    """Single-image convenience wrapper around dominant_colors_batch()."""
+    return dominant_colors_batch([img], k=k, method=method, top=top, seed=seed)[0]
+
+
+def _median_cut_palette(img, k, top):
+    """Pillow median-cut quantization, the pre-NumPy behavior."""
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    quantized = img.quantize(colors=k, method=Image.Quantize.MEDIANCUT)
+    palette = np.array(quantized.getpalette()[:k * 3], dtype=np.float32).reshape(-1, 3)
+    counts = np.bincount(np.asarray(quantized).ravel(), minlength=len(palette))[:len(palette)]
+    return _palette_from_counts(palette, counts, img.width * img.height, top)
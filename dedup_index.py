@@ -0,0 +1,342 @@
+"""Perceptual-hash index of previously processed images.
+
+Re-exports, recompressed copies and resized versions of an image decode to
+almost the same pixels, so their 64-bit perceptual hashes differ in only a
+few bits. pHash (the default) usually gives them identical hashes, while
+dHash is cheaper but drifts by a few bits. The index remembers each image's
+hash together with its analysis and Gemini captions, and finds earlier
+images within a Hamming distance so their results can be reused. Crops of
+more than a few percent and real edits change the hash too much to match.
+
+Everything is persisted in a SQLite file; lookups run against an in-memory
+multi-index built from it on first use. Each hash is split into four 16-bit
+chunks, and for each chunk the index keeps the stored chunk values sorted. By
+the pigeonhole principle, two hashes within distance r agree to within r // 4
+bits on at least one chunk. A query therefore binary-searches each chunk's
+neighbors within that radius (1 probe per chunk for r < 4, 17 for r < 8,
+137 for r < 12) and verifies only those candidates. The candidate count is
+roughly probes * N / 65536, a small fraction of the index, instead of a scan
+of all N hashes; see benchmark_dedup.py for latencies at millions of entries.
+"""
+
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from animation import is_animated, keyframe_montage
+from uploads import open_image
+
+HASH_ALGORITHMS = ("dhash", "phash")
+# Longest edge of the keyframe montage an animation is hashed by
+FINGERPRINT_MONTAGE_EDGE = 256
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+# Inserts are scanned linearly until this many are merged into the sorted tables
+PENDING_MERGE_SIZE = 4096
+
+Fingerprint = namedtuple("Fingerprint", ["sha256", "hash"])
+Match = namedtuple("Match", ["id", "sha256", "distance"])
+
+
+def _hash_input(img, size):
+    """Grayscale, EXIF-upright copy of img resized to size, as a float array."""
+    # Let JPEG decode at a reduced scale; nothing near full size is needed
+    img.draft("L", (size[0] * 8, size[1] * 8))
+    img = ImageOps.exif_transpose(img)
+    gray = img.convert("L").resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return np.asarray(gray, dtype=np.float64)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(img):
+    """64-bit difference hash: is each pixel brighter than its right neighbor?"""
+    pixels = _hash_input(img, (9, 8))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+@functools.lru_cache(maxsize=None)
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def phash(img):
+    """64-bit DCT hash: low-frequency 8x8 coefficients above their median."""
+    pixels = _hash_input(img, (32, 32))
+    dct = _dct_matrix(32)
+    low = (dct @ pixels @ dct.T)[:8, :8]
+    # The DC term only measures overall brightness; leave it out of the median
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def image_fingerprint(image_bytes, algorithm="phash"):
+    """Return the (sha256, perceptual hash) fingerprint of an encoded image.
+
+    Animations are hashed by their keyframe montage, so they match other
+    encodings of the same clip rather than stills of their first frame.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm: {algorithm!r} (expected one of {HASH_ALGORITHMS})")
+    img = open_image(image_bytes, max_bytes=0)
+    if is_animated(img):
+        img, _ = keyframe_montage(img, FINGERPRINT_MONTAGE_EDGE)
+    image_hash = dhash(img) if algorithm == "dhash" else phash(img)
+    return Fingerprint(hashlib.sha256(image_bytes).hexdigest(), image_hash)
+
+
+def prompt_key(prompt, generation_config):
+    """Key for captions produced by one prompt and generation config."""
+    payload = json.dumps([prompt, generation_config], sort_keys=True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _chunk_values(hashes, i):
+    """The i-th CHUNK_BITS-bit chunk (most significant first) of a uint64 array."""
+    shift = np.uint64(CHUNK_BITS * (CHUNKS - 1 - i))
+    return ((hashes >> shift) & np.uint64((1 << CHUNK_BITS) - 1)).astype(np.uint16)
+
+
+def _to_signed(image_hash):
+    # SQLite integers are signed 64-bit
+    return image_hash - (1 << 64) if image_hash >= 1 << 63 else image_hash
+
+
+@functools.lru_cache(maxsize=None)
+def _flip_masks(radius):
+    """All CHUNK_BITS-bit masks with at most radius bits set."""
+    masks = []
+    for r in range(radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), r):
+            masks.append(sum(1 << b for b in bits))
+    return np.array(masks, dtype=np.uint16)
+
+
+class _MultiIndex:
+    """Sorted per-chunk tables over a uint64 hash array, plus unsorted recent inserts."""
+
+    def __init__(self, ids, hashes):
+        self.ids = ids
+        self.hashes = hashes
+        self.chunk_order = []
+        self.chunk_sorted = []
+        for i in range(CHUNKS):
+            values = _chunk_values(hashes, i)
+            order = np.argsort(values, kind="stable")
+            self.chunk_order.append(order)
+            self.chunk_sorted.append(values[order])
+        self.pending = []
+
+    def merged(self):
+        """Return a new index with the pending inserts sorted into the tables."""
+        ids, hashes = zip(*self.pending)
+        return _MultiIndex(
+            np.concatenate([self.ids, np.array(ids, dtype=np.int64)]),
+            np.concatenate([self.hashes, np.array(hashes, dtype=np.uint64)]),
+        )
+
+    def search(self, image_hash, max_distance):
+        """Return {row_id: distance} for every stored hash within max_distance."""
+        masks = _flip_masks(max_distance // CHUNKS)
+        query = np.array([image_hash], dtype=np.uint64)
+        positions = []
+        for i in range(CHUNKS):
+            probes = np.sort(_chunk_values(query, i)[0] ^ masks)
+            values = self.chunk_sorted[i]
+            lo = np.searchsorted(values, probes, side="left")
+            hi = np.searchsorted(values, probes, side="right")
+            for start, stop in zip(lo[hi > lo], hi[hi > lo]):
+                positions.append(self.chunk_order[i][start:stop])
+
+        found = {}
+        if positions:
+            candidates = np.unique(np.concatenate(positions))
+            distances = np.unpackbits(
+                (self.hashes[candidates] ^ query).view(np.uint8).reshape(-1, 8), axis=1
+            ).sum(axis=1)
+            near = distances <= max_distance
+            found = dict(zip(self.ids[candidates[near]].tolist(), distances[near].tolist()))
+        for row_id, stored in self.pending:
+            distance = (stored ^ image_hash).bit_count()
+            if distance <= max_distance:
+                found[row_id] = distance
+        return found
+
+
+class NearDuplicateIndex:
+    """SQLite-backed perceptual-hash index with stored analyses and captions.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, path=":memory:", max_distance=6, algorithm="phash"):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm: {algorithm!r} (expected one of {HASH_ALGORITHMS})")
+        self.path = path
+        self.max_distance = max_distance
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        self._tables = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY,
+                sha256 TEXT NOT NULL UNIQUE,
+                hash INTEGER NOT NULL,
+                analysis TEXT,
+                analysis_version TEXT,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS captions (
+                image_id INTEGER NOT NULL REFERENCES images(id),
+                prompt_key TEXT NOT NULL,
+                caption TEXT NOT NULL,
+                PRIMARY KEY (image_id, prompt_key)
+            );
+        """)
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+        if row is None:
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('algorithm', ?)", (algorithm,))
+        elif row[0] != algorithm:
+            raise ValueError(f"{path} holds {row[0]} hashes; cannot open it with algorithm={algorithm!r}")
+        self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """Create an index from DEDUP_* environment variables, or None if disabled."""
+        path = os.getenv("DEDUP_INDEX_PATH")
+        if not path:
+            return None
+        return cls(
+            path,
+            max_distance=int(os.getenv("DEDUP_MAX_DISTANCE", "6")),
+            algorithm=os.getenv("DEDUP_HASH", "phash").lower(),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def fingerprint(self, image_bytes):
+        """Fingerprint image_bytes with this index's hash algorithm."""
+        return image_fingerprint(image_bytes, self.algorithm)
+
+    def add(self, fingerprint):
+        """Insert an image if it is new; return its row id."""
+        with self._lock:
+            image_id = self._add(fingerprint)
+            self._db.commit()
+            return image_id
+
+    def add_many(self, fingerprints):
+        """Bulk-insert fingerprints in one transaction (existing ones are skipped)."""
+        now = time.time()
+        rows = ((fp.sha256, _to_signed(fp.hash), now) for fp in fingerprints)
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO images (sha256, hash, created) VALUES (?, ?, ?)", rows
+            )
+            self._db.commit()
+            # Rebuilt from the database on the next lookup
+            self._tables = None
+
+    def find(self, image_hash, max_distance=None, limit=5):
+        """Return up to limit Matches within max_distance bits, nearest first."""
+        if max_distance is None:
+            max_distance = self.max_distance
+        with self._lock:
+            found = self._load_tables().search(image_hash, max_distance)
+            nearest = sorted(found.items(), key=lambda item: (item[1], item[0]))[:limit]
+            if not nearest:
+                return []
+            placeholders = ",".join("?" * len(nearest))
+            sha256s = dict(self._db.execute(
+                f"SELECT id, sha256 FROM images WHERE id IN ({placeholders})", [row_id for row_id, _ in nearest]
+            ))
+        return [Match(row_id, sha256s[row_id], distance) for row_id, distance in nearest]
+
+    def put_analysis(self, fingerprint, analysis, version):
+        """Remember the analysis of an image (added to the index if needed)."""
+        blob = json.dumps(analysis, ensure_ascii=False)
+        with self._lock:
+            image_id = self._add(fingerprint)
+            self._db.execute(
+                "UPDATE images SET analysis = ?, analysis_version = ? WHERE id = ?", (blob, version, image_id)
+            )
+            self._db.commit()
+
+    def put_caption(self, fingerprint, key, caption):
+        """Remember a caption of an image for one prompt key (see prompt_key())."""
+        with self._lock:
+            image_id = self._add(fingerprint)
+            self._db.execute(
+                "INSERT OR REPLACE INTO captions (image_id, prompt_key, caption) VALUES (?, ?, ?)",
+                (image_id, key, caption),
+            )
+            self._db.commit()
+
+    def find_analysis(self, fingerprint, version):
+        """Return (analysis, distance) of the nearest other image analyzed with
+        version, or None. The image itself (same bytes) is never returned."""
+        for match in self.find(fingerprint.hash, limit=20):
+            if match.sha256 == fingerprint.sha256:
+                continue
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT analysis FROM images WHERE id = ? AND analysis_version = ?", (match.id, version)
+                ).fetchone()
+            if row is not None and row[0] is not None:
+                return json.loads(row[0]), match.distance
+        return None
+
+    def find_caption(self, fingerprint, key):
+        """Return (caption, distance) of the nearest other image captioned with
+        key, or None. The image itself (same bytes) is never returned."""
+        for match in self.find(fingerprint.hash, limit=20):
+            if match.sha256 == fingerprint.sha256:
+                continue
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT caption FROM captions WHERE image_id = ? AND prompt_key = ?", (match.id, key)
+                ).fetchone()
+            if row is not None:
+                return row[0], match.distance
+        return None
+
+    def _load_tables(self):
+        """Build the in-memory multi-index from the database; the caller holds the lock."""
+        if self._tables is None:
+            rows = self._db.execute("SELECT id, hash FROM images").fetchall()
+            ids = np.array([row[0] for row in rows], dtype=np.int64)
+            # Reinterpret the signed SQLite values as the original unsigned hashes
+            hashes = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64)
+            self._tables = _MultiIndex(ids, hashes)
+        return self._tables
+
+    def _add(self, fingerprint):
+        """Insert without committing; the caller holds the lock."""
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO images (sha256, hash, created) VALUES (?, ?, ?)",
+            (fingerprint.sha256, _to_signed(fingerprint.hash), time.time()),
+        )
+        if cursor.rowcount:
+            if self._tables is not None:
+                self._tables.pending.append((cursor.lastrowid, fingerprint.hash))
+                if len(self._tables.pending) >= PENDING_MERGE_SIZE:
+                    self._tables = self._tables.merged()
+            return cursor.lastrowid
+        return self._db.execute("SELECT id FROM images WHERE sha256 = ?", (fingerprint.sha256,)).fetchone()[0]
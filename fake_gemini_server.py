@@ -0,0 +1,255 @@
+"""Local stand-in for the Gemini REST API, for tests, benchmarks and load tests.
+
+Implements POST /v1beta/models/{model}:generateContent and
+:streamGenerateContent?alt=sse with the same request and response shape as
+the real service, plus configurable latency, random 5xx errors and 429 rate
+limiting. Requests with a JSON responseSchema get a JSON answer with
+maxItems fake variant captions. GET /stats returns request counters.
+
+    python fake_gemini_server.py --port 8765 --latency 0.4 --error-rate 0.02 --rpm-limit 120
+
+Point the app at it with GEMINI_API_BASE=http://127.0.0.1:8765.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENERATE_PATH = re.compile(r"^/v1beta/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$")
+
+# Words per server-sent event on the streaming endpoint
+STREAM_CHUNK_WORDS = 2
+
+
+class FakeGeminiConfig:
+    """Behavior knobs; attributes may be changed while the server runs."""
+
+    def __init__(self, latency=0.2, jitter=0.1, error_rate=0.0, rate_limit_rate=0.0,
+                 rpm_limit=0, models=None, seed=None, chunk_delay=0.05, invalid_json_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm_limit = rpm_limit
+        self.models = models
+        # Pause between streamed chunks, after the initial latency
+        self.chunk_delay = chunk_delay
+        # Fraction of JSON-mode responses that are deliberately truncated
+        self.invalid_json_rate = invalid_json_rate
+        self.random = random.Random(seed)
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    server_version = "FakeGemini/1.0"
+    # Keep-alive and chunked transfer encoding, as the real API uses for streams
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; on a kept-alive connection Nagle's
+    # algorithm would hold the body back until the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # Keep benchmark and test output clean
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, headers=None):
+        self.server.counters[f"status_{status}"] += 1
+        self._send_json(status, {"error": {"code": status, "message": message}}, headers)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, dict(self.server.counters))
+        else:
+            self._send_error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        server = self.server
+        config = server.config
+        match = GENERATE_PATH.match(self.path.split("?", 1)[0])
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        server.counters["requests"] += 1
+
+        if match is None:
+            return self._send_error(404, f"Unknown path {self.path}")
+        model = match.group("model")
+        if config.models is not None and model not in config.models:
+            return self._send_error(404, f"models/{model} is not found for API version v1beta")
+
+        with server.lock:
+            now = time.monotonic()
+            while server.recent and server.recent[0] < now - 60:
+                server.recent.popleft()
+            over_limit = bool(config.rpm_limit) and len(server.recent) >= config.rpm_limit
+            if not over_limit:
+                server.recent.append(now)
+            roll = config.random.random()
+            delay = max(0.0, config.latency + config.random.uniform(-config.jitter, config.jitter))
+            invalid_json = config.random.random() < config.invalid_json_rate
+
+        if over_limit or roll < config.rate_limit_rate:
+            return self._send_error(429, "Resource has been exhausted (e.g. check quota).", {"Retry-After": "1"})
+
+        time.sleep(delay)
+        if roll < config.rate_limit_rate + config.error_rate:
+            return self._send_error(500, "An internal error has occurred.")
+
+        text, prompt_tokens = self._fake_caption(request)
+        generation_config = request.get("generationConfig") or {}
+        if generation_config.get("responseMimeType") == "application/json":
+            text = self._fake_json(text, generation_config.get("responseSchema") or {}, invalid_json)
+        output_tokens = len(text.split())
+        usage = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        }
+        server.counters["status_200"] += 1
+        if match.group("method") == "streamGenerateContent":
+            return self._send_stream(model, text, usage, config.chunk_delay)
+        self._send_json(200, {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": text}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": usage,
+            "modelVersion": model,
+        })
+
+    def _send_stream(self, model, text, usage, chunk_delay):
+        """Send text as server-sent events, a few words per event."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = text.split(" ")
+        for start in range(0, len(words), STREAM_CHUNK_WORDS):
+            last = start + STREAM_CHUNK_WORDS >= len(words)
+            piece = " ".join(words[start:start + STREAM_CHUNK_WORDS]) + ("" if last else " ")
+            event = {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": piece}]},
+                    "index": 0,
+                    **({"finishReason": "STOP"} if last else {}),
+                }],
+                "modelVersion": model,
+            }
+            if last:
+                event["usageMetadata"] = usage
+            data = f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+            if not last:
+                time.sleep(chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _fake_caption(self, request):
+        """Deterministic caption derived from the request contents."""
+        digest = hashlib.sha256()
+        prompt_tokens = 0
+        for content in request.get("contents", []):
+            for part in content.get("parts", []):
+                if "text" in part:
+                    digest.update(part["text"].encode("utf-8"))
+                    prompt_tokens += len(part["text"]) // 4
+                elif "inline_data" in part or "inlineData" in part:
+                    blob = part.get("inline_data") or part.get("inlineData")
+                    digest.update(blob.get("data", "").encode("ascii"))
+                    prompt_tokens += 258
+        tag = digest.hexdigest()[:8]
+        return f"A fake caption for image {tag}. #fake #caption", prompt_tokens
+
+
+    @staticmethod
+    def _fake_json(text, schema, invalid):
+        """A {"captions": [...]} answer with one entry per requested variant."""
+        captions = schema.get("properties", {}).get("captions", {})
+        count = captions.get("max_items") or captions.get("maxItems") or 1
+        body = json.dumps({
+            "captions": [{"variant": number, "caption": f"{text} (variant {number})"} for number in range(1, count + 1)]
+        })
+        return body[:len(body) // 2] if invalid else body
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """Threaded fake Gemini server; use start()/stop() or as a context manager."""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, config=None):
+        super().__init__((host, port), FakeGeminiHandler)
+        self.config = config or FakeGeminiConfig()
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local fake Gemini API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Uniform latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests failing with 429")
+    parser.add_argument("--rpm-limit", type=int, default=0, help="Return 429 above this many requests per minute")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="Pause between streamed chunks in seconds")
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0,
+                        help="Fraction of JSON-mode responses that are truncated")
+    parser.add_argument("--models", nargs="*", help="Models to serve; others get 404 (default: all)")
+    args = parser.parse_args(argv)
+
+    config = FakeGeminiConfig(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, rpm_limit=args.rpm_limit, models=args.models,
+        chunk_delay=args.chunk_delay, invalid_json_rate=args.invalid_json_rate,
+    )
+    server = FakeGeminiServer(args.host, args.port, config)
+    print(f"Fake Gemini API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
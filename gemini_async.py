@@ -0,0 +1,390 @@
+"""Async Gemini captioning engine with quota-aware rate limiting.
+
+Talks to the Gemini REST API directly so it can be pointed at a local fake
+server (see fake_gemini_server.py) via GEMINI_API_BASE. On top of a plain
+generateContent call it adds:
+
+* token buckets sized to the requests-per-minute and tokens-per-minute quotas
+* jittered exponential backoff on 429/5xx and connection errors, honoring
+  Retry-After when the server sends it
+* coalescing of identical in-flight requests, so concurrent sessions asking
+  for the same image and prompt share one API call
+* fallback through MODEL_CANDIDATES on model-not-found errors
+* streaming through streamGenerateContent (server-sent events) with stream()
+
+The engine runs on its own event loop thread; synchronous callers (Streamlit
+sessions, thread pools) use caption() and block only their own thread.
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from gemini_client import MODEL_CANDIDATES, GeminiModelUnavailable
+from metrics import record_api_error, record_tokens, stage_timer
+
+DEFAULT_API_BASE = "https://generativelanguage.googleapis.com"
+
+# Gemini bills a fixed number of tokens per inline image
+IMAGE_TOKEN_COST = 258
+
+
+class GeminiAPIError(Exception):
+    """An HTTP-level Gemini failure. status is 0 for connection errors."""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"{status}: {message}" if status else message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status in (0, 408, 429) or self.status >= 500
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at per_minute / 60 tokens per second.
+
+    Only used from the engine's event loop, so no locking is needed.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """Wait until amount tokens are available, then take them."""
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def refund(self, amount):
+        """Return tokens that were reserved but not used."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def estimate_tokens(prompt, generation_config):
+    """Upper-bound token cost of one captioning request, for the TPM bucket."""
+    return len(prompt) // 4 + IMAGE_TOKEN_COST + generation_config.get("max_output_tokens", 1024)
+
+
+def build_request_body(prompt, payload, mime_type, generation_config, safety_settings):
+    """Translate SDK-style settings into a REST generateContent body."""
+    with stage_timer("base64_encode", pipeline="gemini"):
+        encoded = base64.b64encode(payload).decode("ascii")
+    body = {
+        "contents": [{
+            "role": "user",
+            "parts": [
+                {"text": prompt},
+                {"inline_data": {"mime_type": mime_type, "data": encoded}},
+            ],
+        }],
+        "generationConfig": {
+            "temperature": generation_config.get("temperature"),
+            "topP": generation_config.get("top_p"),
+            "topK": generation_config.get("top_k"),
+            "maxOutputTokens": generation_config.get("max_output_tokens"),
+        },
+        "safetySettings": safety_settings,
+    }
+    # Structured output; the schema's snake_case field names are accepted as-is
+    if "response_mime_type" in generation_config:
+        body["generationConfig"]["responseMimeType"] = generation_config["response_mime_type"]
+    if "response_schema" in generation_config:
+        body["generationConfig"]["responseSchema"] = generation_config["response_schema"]
+    return body
+
+
+def parse_response(data):
+    """Return (text, total_tokens) from a generateContent JSON response."""
+    usage = data.get("usageMetadata", {})
+    record_tokens(usage.get("promptTokenCount"), usage.get("candidatesTokenCount"), usage.get("totalTokenCount"))
+    candidates = data.get("candidates") or []
+    if not candidates:
+        feedback = data.get("promptFeedback", {})
+        record_api_error("blocked")
+        raise GeminiAPIError(400, f"No caption returned (blocked: {feedback.get('blockReason', 'unknown')})")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    text = "".join(part.get("text", "") for part in parts).strip()
+    return text, usage.get("totalTokenCount")
+
+
+def parse_stream_chunk(data):
+    """Return (text, usage) from one streamGenerateContent event.
+
+    usage is the usageMetadata dict, or None on events that don't carry it.
+    """
+    candidates = data.get("candidates") or []
+    if not candidates:
+        block_reason = data.get("promptFeedback", {}).get("blockReason")
+        if block_reason:
+            record_api_error("blocked")
+            raise GeminiAPIError(400, f"No caption returned (blocked: {block_reason})")
+        return "", data.get("usageMetadata")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts), data.get("usageMetadata")
+
+
+def iter_stream_events(response):
+    """Yield the JSON payload of each "data:" line of a server-sent event stream."""
+    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+        if line and line.startswith("data:"):
+            yield json.loads(line[5:].strip())
+
+
+class AsyncGeminiEngine:
+    """Rate-limited, retrying, coalescing Gemini client on a private event loop."""
+
+    def __init__(self, api_key, base_url=None, models=None, rpm=60, tpm=1_000_000,
+                 max_retries=5, base_delay=1.0, max_delay=60.0, timeout=60.0, max_concurrency=32):
+        self.api_key = api_key
+        self.base_url = (base_url or DEFAULT_API_BASE).rstrip("/")
+        self.models = list(models or MODEL_CANDIDATES)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.counters = {"requests": 0, "retries": 0, "coalesced": 0, "errors": 0}
+
+        self._model_index = 0
+        self._session = requests.Session()
+        # requests pools 10 connections per host by default; beyond that, concurrent
+        # requests open throwaway connections (a new TLS handshake each)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        # Created on the loop thread in _ensure_loop()
+        self._request_bucket = None
+        self._token_bucket = None
+        self._semaphore = None
+        self._inflight = {}
+
+    @classmethod
+    def from_env(cls, api_key):
+        """Create an engine configured from GEMINI_* environment variables."""
+        return cls(
+            api_key,
+            base_url=os.getenv("GEMINI_API_BASE") or None,
+            rpm=int(os.getenv("GEMINI_RPM", "60")),
+            tpm=int(os.getenv("GEMINI_TPM", "1000000")),
+            max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "5")),
+            max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "32")),
+        )
+
+    @property
+    def model_name(self):
+        return self.models[self._model_index]
+
+    def _ensure_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                # Blocking requests run in the loop's default executor, which
+                # otherwise has only min(32, CPU count + 4) threads
+                loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_concurrency, thread_name_prefix="gemini-http"
+                ))
+                threading.Thread(target=loop.run_forever, name="gemini-engine", daemon=True).start()
+                self._loop = loop
+                asyncio.run_coroutine_threadsafe(self._init_primitives(), loop).result()
+            return self._loop
+
+    async def _init_primitives(self):
+        self._request_bucket = TokenBucket(self.rpm)
+        self._token_bucket = TokenBucket(self.tpm)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def caption(self, prompt, payload, mime_type, generation_config, safety_settings, key=None):
+        """Blocking entry point: run generate() on the engine loop and wait for it."""
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(
+            self.generate(prompt, payload, mime_type, generation_config, safety_settings, key), loop
+        )
+        return future.result()
+
+    def stream(self, prompt, payload, mime_type, generation_config, safety_settings):
+        """Blocking generator of caption text chunks from streamGenerateContent.
+
+        Requests count against the same RPM/TPM buckets as caption(), and are
+        retried and moved to the next model the same way, but only until the
+        stream opens; a failure mid-stream propagates. Streams are not
+        coalesced and do not take a max_concurrency slot.
+        """
+        loop = self._ensure_loop()
+        body = build_request_body(prompt, payload, mime_type, generation_config, safety_settings)
+        estimate = estimate_tokens(prompt, generation_config)
+        attempt = 0
+        while True:
+            asyncio.run_coroutine_threadsafe(self._reserve(estimate), loop).result()
+            model = self.model_name
+            try:
+                response = self._open_stream(model, body)
+            except GeminiAPIError as e:
+                if e.status == 404:
+                    self._next_model(model, e)
+                    continue
+                if not e.retryable or attempt >= self.max_retries:
+                    self.counters["errors"] += 1
+                    raise
+                delay = e.retry_after or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                self.counters["retries"] += 1
+                time.sleep(delay)
+            else:
+                break
+
+        usage = None
+        try:
+            for event in iter_stream_events(response):
+                text, event_usage = parse_stream_chunk(event)
+                usage = event_usage or usage
+                if text:
+                    yield text
+        except requests.RequestException as e:
+            record_api_error("connection")
+            raise GeminiAPIError(0, f"Connection error: {e}") from e
+        finally:
+            response.close()
+
+        usage = usage or {}
+        record_tokens(usage.get("promptTokenCount"), usage.get("candidatesTokenCount"), usage.get("totalTokenCount"))
+        used_tokens = usage.get("totalTokenCount")
+        if used_tokens is not None and used_tokens < estimate:
+            loop.call_soon_threadsafe(self._token_bucket.refund, estimate - used_tokens)
+
+    async def _reserve(self, estimate):
+        """Take one request and estimate tokens from the quota buckets."""
+        await self._request_bucket.acquire(1)
+        await self._token_bucket.acquire(estimate)
+        self.counters["requests"] += 1
+
+    async def generate(self, prompt, payload, mime_type, generation_config, safety_settings, key=None):
+        """Generate a caption; concurrent calls with the same key share one request.
+
+        Must run on the engine loop (use caption() from other threads).
+        """
+        if key is not None and key in self._inflight:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        task = asyncio.ensure_future(
+            self._generate_with_retries(prompt, payload, mime_type, generation_config, safety_settings)
+        )
+        if key is not None:
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _generate_with_retries(self, prompt, payload, mime_type, generation_config, safety_settings):
+        body = build_request_body(prompt, payload, mime_type, generation_config, safety_settings)
+        estimate = estimate_tokens(prompt, generation_config)
+        attempt = 0
+        while True:
+            await self._request_bucket.acquire(1)
+            await self._token_bucket.acquire(estimate)
+            model = self.model_name
+            try:
+                async with self._semaphore:
+                    self.counters["requests"] += 1
+                    text, used_tokens = await asyncio.to_thread(self._post, model, body)
+            except GeminiAPIError as e:
+                if e.status == 404:
+                    self._next_model(model, e)
+                    continue
+                if not e.retryable or attempt >= self.max_retries:
+                    self.counters["errors"] += 1
+                    raise
+                # Full jitter backoff, unless the server told us how long to wait
+                delay = e.retry_after or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+            else:
+                if used_tokens is not None and used_tokens < estimate:
+                    self._token_bucket.refund(estimate - used_tokens)
+                return text
+
+    def _next_model(self, failed_model, error):
+        """Move past a model the API doesn't know; raise once all are exhausted."""
+        if self.model_name != failed_model:
+            return  # another request already moved on
+        if self._model_index + 1 >= len(self.models):
+            self._model_index = 0
+            self.counters["errors"] += 1
+            raise GeminiModelUnavailable(f"Unable to initialize a Gemini vision model. Last error: {error}")
+        self._model_index += 1
+
+    def _post(self, model, body):
+        """Send one generateContent request (runs in a worker thread)."""
+        url = f"{self.base_url}/v1beta/models/{model}:generateContent"
+        try:
+            with stage_timer("generate_content", pipeline="gemini", engine="async"):
+                response = self._session.post(
+                    url, json=body, headers={"x-goog-api-key": self.api_key}, timeout=self.timeout
+                )
+        except requests.RequestException as e:
+            record_api_error("connection")
+            raise GeminiAPIError(0, f"Connection error: {e}") from e
+
+        _raise_for_status(response)
+        return parse_response(response.json())
+
+    def _open_stream(self, model, body):
+        """Start a streamGenerateContent request and return the open response."""
+        url = f"{self.base_url}/v1beta/models/{model}:streamGenerateContent?alt=sse"
+        try:
+            # Times until the response headers arrive, not the whole stream
+            with stage_timer("generate_content", pipeline="gemini", engine="async_stream"):
+                response = self._session.post(
+                    url, json=body, headers={"x-goog-api-key": self.api_key}, timeout=self.timeout, stream=True
+                )
+        except requests.RequestException as e:
+            record_api_error("connection")
+            raise GeminiAPIError(0, f"Connection error: {e}") from e
+
+        if response.status_code != 200:
+            with response:
+                _raise_for_status(response)
+        return response
+
+
+def _raise_for_status(response):
+    """Raise GeminiAPIError for a non-200 Gemini response."""
+    if response.status_code == 200:
+        return
+    record_api_error(f"http_{response.status_code}")
+    try:
+        message = response.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = response.text[:200]
+    retry_after = response.headers.get("Retry-After")
+    raise GeminiAPIError(
+        response.status_code, message,
+        retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+    )
@@ -0,0 +1,164 @@
+"""Process-wide Gemini client and model handle.
+
+Configuring the SDK and resolving which vision model is usable happens once
+per API key rather than once per caption. The resolved model is reused by
+every caller until a request fails with a model-not-found style error, at
+which point the registry moves on to the next candidate.
+
+google.generativeai itself is only imported on first use (or by
+preload_sdk()): it brings in gRPC and protobuf, close to a second of
+startup that users of the local tools should not pay.
+"""
+
+import functools
+import importlib
+import importlib.util
+import logging
+import threading
+
+from metrics import record_api_error, record_tokens, stage_timer
+
+logger = logging.getLogger(__name__)
+
+SDK_MODULE = "google.generativeai"
+
+# Vision-capable models to try, in order of preference
+MODEL_CANDIDATES = [
+    'gemini-1.5-flash-latest',
+    'gemini-1.5-pro-latest',
+    'gemini-1.0-pro-vision-latest',
+    'gemini-pro-vision',
+]
+
+
+def sdk_available():
+    """Whether google-generativeai is installed, without importing it."""
+    try:
+        return importlib.util.find_spec(SDK_MODULE) is not None
+    except ImportError:
+        # No "google" namespace package at all
+        return False
+
+
+def _import_sdk():
+    try:
+        with stage_timer("sdk_import", pipeline="gemini", engine="sdk"):
+            importlib.import_module(SDK_MODULE)
+    except Exception:
+        logger.exception("Preloading %s failed", SDK_MODULE)
+
+
+@functools.lru_cache(maxsize=None)
+def preload_sdk():
+    """Start importing google-generativeai in a background thread, once per process.
+
+    For callers that know a Gemini request is likely soon; the request
+    itself then only waits for whatever is left of the import.
+    """
+    thread = threading.Thread(target=_import_sdk, name="gemini-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+class GeminiModelUnavailable(RuntimeError):
+    """Raised when none of the candidate models can be initialized."""
+
+
+def is_model_not_found(error):
+    """Return True if error means the requested model is unavailable to us."""
+    # google.api_core.exceptions.NotFound, without importing google.api_core
+    if type(error).__name__ == "NotFound" or getattr(error, "code", None) == 404:
+        return True
+    message = str(error).lower()
+    return "404" in message or ("model" in message and ("not found" in message or "not supported" in message))
+
+
+class GeminiModelRegistry:
+    """Configures the Gemini SDK once and caches the resolved model handle.
+
+    Thread-safe; a single instance is meant to be shared by every session.
+    """
+
+    def __init__(self, api_key, candidates=None):
+        self.api_key = api_key
+        self.candidates = list(candidates or MODEL_CANDIDATES)
+        self._lock = threading.Lock()
+        self._genai = None
+        self._model = None
+        self._model_name = None
+        self._failed = set()
+        self._last_error = None
+
+    @property
+    def model_name(self):
+        """Name of the currently resolved model, or None before first use."""
+        return self._model_name
+
+    def get_model(self):
+        """Return (name, model), configuring the SDK and probing on first use.
+
+        Raises:
+            GeminiModelUnavailable: If no candidate model could be initialized
+        """
+        with self._lock:
+            if self._model is not None:
+                return self._model_name, self._model
+
+            with stage_timer("model_init", pipeline="gemini", engine="sdk"):
+                if self._genai is None:
+                    genai = importlib.import_module(SDK_MODULE)
+                    genai.configure(api_key=self.api_key)
+                    self._genai = genai
+
+                for name in self.candidates:
+                    if name in self._failed:
+                        continue
+                    try:
+                        self._model = self._genai.GenerativeModel(name)
+                        self._model_name = name
+                        return name, self._model
+                    except Exception as e:
+                        self._last_error = e
+                        self._failed.add(name)
+
+            # Every candidate failed; start over on the next call in case the
+            # failures were transient
+            last_error, self._last_error = self._last_error, None
+            self._failed.clear()
+            raise GeminiModelUnavailable(f"Unable to initialize a Gemini vision model. Last error: {last_error}")
+
+    def invalidate(self, name, error=None):
+        """Drop the cached handle for name so the next call probes the next candidate."""
+        with self._lock:
+            self._failed.add(name)
+            self._last_error = error
+            if self._model_name == name:
+                self._model = None
+                self._model_name = None
+
+    def generate_content(self, contents, **kwargs):
+        """Call generate_content on the resolved model.
+
+        A model-not-found error marks that model as unusable and the request
+        is retried once per remaining candidate; any other error propagates.
+        """
+        while True:
+            name, model = self.get_model()
+            try:
+                with stage_timer("generate_content", pipeline="gemini", engine="sdk"):
+                    response = model.generate_content(contents=contents, **kwargs)
+            except Exception as e:
+                record_api_error(type(e).__name__)
+                if not is_model_not_found(e):
+                    raise
+                self.invalidate(name, e)
+            else:
+                # A streamed response only has complete usage once consumed
+                usage = None if kwargs.get("stream") else getattr(response, "usage_metadata", None)
+                if usage is not None:
+                    record_tokens(
+                        getattr(usage, "prompt_token_count", None),
+                        getattr(usage, "candidates_token_count", None),
+                        getattr(usage, "total_token_count", None),
+                    )
+                return response
@@ -0,0 +1,576 @@
+"""Offline image analysis used by the Local Offline Reader.
+
+Everything here is independent of the Streamlit UI so it can be imported by
+worker processes (batch mode) and headless tools.
+"""
+
+import logging
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+from analysis_cache import AnalysisCache, content_key
+from animation import ANIMATION_MAX_FRAMES, ANIMATION_SAMPLE_FPS, is_animated, sample_frames
+from color_engine import StreamingPalette, dominant_colors, image_pixels, name_colors
+from image_stats import STATS_VERSION, ImageStats, StatsAccumulator, compute_image_stats
+from metrics import record_cache, record_payload, stage_timer
+from singleton import process_singleton
+from uploads import open_image
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever analyze_image_detailed() output changes so cached results are invalidated
+ANALYSIS_VERSION = "6"
+
+# Longest edge of the shared working image used for all statistics. Large
+# uploads are decoded at reduced resolution (JPEG draft mode, then reduce()
+# and resampling) instead of being converted and edge-filtered at full size.
+# Set ANALYSIS_MAX_EDGE=0 for exact full-resolution analysis.
+#
+# Tolerance of the fast path vs. full resolution (12-48 MP JPEGs, edge 1024):
+#   brightness, contrast  within ±0.5 percentage points
+#   percentiles, clipping within a few levels / ±0.5 points, except clipping
+#                         of isolated specular pixels, which averaging hides
+#   blur, noise           scale-dependent like edge density: blur (Laplacian
+#                         variance) reads higher and noise lower on the
+#                         working image; compare values at one max_edge only
+#   dominant colors       usually identical; percentages within ±1 point, but
+#                         the clustering may split one cluster differently,
+#                         so the 4th/5th color can change name
+#   edge density          scale-dependent and NOT comparable: the working
+#                         image averages away sensor grain and JPEG noise, so
+#                         values read 20-80% lower on grainy photos and
+#                         complexity reflects structure rather than noise
+# Fast-path runs are cached separately from full-resolution runs. Large
+# full-resolution runs are tiled, see ANALYSIS_TILE_PIXELS.
+ANALYSIS_MAX_EDGE = int(os.getenv("ANALYSIS_MAX_EDGE", "1024"))
+
+# Dominant colors are clustered over every pixel of the working image with
+# "kmeans" (NumPy, see color_engine.py) or Pillow's "median_cut"
+ANALYSIS_COLOR_METHOD = os.getenv("ANALYSIS_COLOR_METHOD", "kmeans")
+ANALYSIS_COLOR_K = int(os.getenv("ANALYSIS_COLOR_K", "8"))
+
+# Exact (max_edge=0) k-means analysis of images above this many pixels runs
+# tiled: the image is measured in full-width strips of about this many
+# pixels (see analyze_image_tiled), so peak memory follows the strip size.
+ANALYSIS_TILE_PIXELS = int(os.getenv("ANALYSIS_TILE_PIXELS", str(4 * 1024 * 1024)))
+# Pixel ceiling of analyze_image_tiled() on files; bytes uploads keep the
+# upload ceilings of uploads.py
+ANALYSIS_TILED_MAX_PIXELS = int(os.getenv("ANALYSIS_TILED_MAX_PIXELS", "4000000000"))
+
+# Modes without color information. Every other mode (RGB, CMYK, palette,
+# YCbCr, ...) is a color image and is converted to RGB for analysis
+GRAYSCALE_MODES = frozenset({"1", "L", "LA", "La", "I", "I;16", "I;16B", "I;16L", "I;16N", "F"})
+
+def is_color_mode(mode):
+    """Whether images of a PIL mode get the color analysis."""
+    return mode not in GRAYSCALE_MODES
+
+# Bits per pixel of the uncompressed raw layouts that strips can be read
+# from directly, without decoding the whole image
+_RAW_BITS = {"L": 8, "LA": 16, "RGB": 24, "BGR": 24, "RGBX": 32, "RGBA": 32, "BGRX": 32, "BGRA": 32, "CMYK": 32}
+
+def analysis_cache_version(max_edge=None):
+    """Cache-key version covering the analysis code and its parameters."""
+    if max_edge is None:
+        max_edge = ANALYSIS_MAX_EDGE
+    return (f"{ANALYSIS_VERSION}/stats={STATS_VERSION}/edge={max_edge}"
+            f"/colors={ANALYSIS_COLOR_METHOD}:{ANALYSIS_COLOR_K}"
+            f"/frames={ANIMATION_SAMPLE_FPS:g}:{ANIMATION_MAX_FRAMES}")
+
+@process_singleton
+def get_analysis_cache():
+    """Process-wide analysis cache shared by all sessions (see analysis_cache.py)."""
+    return AnalysisCache.from_env()
+
+# Stages of the local analysis pipeline, in execution order. The report stage
+# is run by the caller (see format_local_report) once the analysis is ready.
+LOCAL_ANALYSIS_STAGES = [
+    ("decode", "Decoding image"),
+    ("statistics", "Measuring exposure, sharpness and noise"),
+    ("quantize", "Finding dominant colors"),
+    ("report", "Building analysis report"),
+]
+
+def name_color(r, g, b):
+    """Give a human-readable name to an RGB color (0-255 channels).
+    
+    Scalar convenience wrapper; see color_engine.name_colors() for arrays.
+    """
+    return str(name_colors([r, g, b]))
+
+def _basic_info(header, file_size):
+    """Basic properties of an opened (not necessarily decoded) image."""
+    width, height = header.size
+    format_name = header.format if header.format else "Unknown"
+    mode = header.mode
+    aspect_ratio = width / height
+    total_pixels = width * height
+    
+    # Determine orientation
+    if aspect_ratio > 1.2:
+        orientation = "Landscape"
+    elif aspect_ratio < 0.8:
+        orientation = "Portrait"
+    else:
+        orientation = "Square"
+    
+    # Aspect ratio classification
+    if aspect_ratio > 2.5:
+        aspect_class = "Ultra-wide/Panoramic"
+    elif aspect_ratio > 1.5:
+        aspect_class = "Wide"
+    elif aspect_ratio > 1.1:
+        aspect_class = "Standard Landscape"
+    elif aspect_ratio > 0.9:
+        aspect_class = "Square"
+    elif aspect_ratio > 0.7:
+        aspect_class = "Standard Portrait"
+    elif aspect_ratio > 0.4:
+        aspect_class = "Tall Portrait"
+    else:
+        aspect_class = "Ultra-tall"
+    
+    return {
+        "width": width,
+        "height": height,
+        "orientation": orientation,
+        "aspect_ratio": round(aspect_ratio, 2),
+        "aspect_class": aspect_class,
+        "total_pixels": total_pixels,
+        "file_format": format_name,
+        "color_mode": mode,
+        "file_size_bytes": file_size
+    }
+
+def _decode_stage(image_bytes, max_edge=0, upload=None, header=None):
+    """Open the image and extract its basic properties.
+    
+    Args:
+        image_bytes: The binary image data
+        max_edge: If non-zero, decode a working image no larger than this
+            on its longest edge instead of the full-resolution image
+        upload: Optional uploads.ImageUpload of image_bytes whose shared
+            working image is used instead of decoding again
+        header: Optional image already opened (not decoded) from image_bytes
+        
+    Returns:
+        tuple: (working_image, basic_info) where basic_info always describes
+        the original file
+    """
+    if upload is not None:
+        header = upload
+    else:
+        # Only the header is parsed here (after the upload ceilings are
+        # checked); pixels are decoded below
+        header = img = header or open_image(image_bytes)
+    record_payload("original", len(image_bytes), pipeline="analysis")
+    basic_info = _basic_info(header, len(image_bytes))
+    width, height = header.size
+    
+    # Shrink before any full-size decode happens: for JPEG, thumbnail() first
+    # uses draft mode to let the decoder skip DCT scales, then reduce() and
+    # a final resample, so the full-resolution bitmap is never materialized
+    with stage_timer("decode", pipeline="analysis"):
+        if upload is not None:
+            img = upload.fit(max_edge)
+        elif max_edge and max(width, height) > max_edge:
+            img.thumbnail((max_edge, max_edge), reducing_gap=2.0)
+        else:
+            img.load()
+    
+    return img, basic_info
+
+def _statistics_stage(img):
+    """Measure exposure, sharpness, noise and edges of the working image.
+    
+    Returns:
+        tuple: (img_rgb, stats, color_analysis, complexity) where img_rgb is
+        the working image in RGB, or None for grayscale images
+    """
+    is_color = is_color_mode(img.mode)
+    img_rgb = None
+    if is_color:
+        if img.mode != "RGB":
+            with stage_timer("convert", pipeline="analysis"):
+                img_rgb = img.convert("RGB")
+        else:
+            img_rgb = img
+    
+    with stage_timer("statistics", pipeline="analysis"):
+        stats = compute_image_stats(img_rgb if is_color else img)
+    
+    color_analysis, complexity = _classify(stats, is_color)
+    return img_rgb, stats, color_analysis, complexity
+
+def _classify(stats, is_color):
+    """Level names for the measured statistics.
+    
+    Returns:
+        tuple: (color_analysis, complexity) dicts; dominant_colors is left
+        empty for the quantize stage to fill in
+    """
+    if is_color:
+        brightness, contrast = stats.brightness, stats.contrast
+        color_analysis = {
+            "is_color": True,
+            "brightness": round(brightness * 100, 1),
+            "contrast": round(contrast * 100, 1),
+            "dominant_colors": [],
+            "brightness_level": "Dark" if brightness < 0.3 else "Bright" if brightness > 0.7 else "Balanced",
+            "contrast_level": "Low" if contrast < 0.2 else "High" if contrast > 0.5 else "Medium"
+        }
+    else:
+        color_analysis = {
+            "is_color": False,
+            "mode": "Grayscale/Black & White"
+        }
+    
+    edge_density = stats.edge_density
+    complexity = {
+        "level": "Simple/Minimalist" if edge_density < 20 else "Detailed/Complex" if edge_density > 50 else "Well-Composed",
+        "edge_density": round(edge_density, 1)
+    }
+    return color_analysis, complexity
+
+def _quantize_stage(img_rgb):
+    """Find up to five dominant colors of the working-resolution RGB image."""
+    with stage_timer("quantize", pipeline="analysis"):
+        return dominant_colors(img_rgb, k=ANALYSIS_COLOR_K, method=ANALYSIS_COLOR_METHOD)
+
+def _raw_layout(img):
+    """How to read strips of an uncompressed image straight from its file.
+    
+    Returns:
+        tuple: (offset, row_bytes, rawmode, ystep) of the image's single
+        raw tile, or None if the pixels are compressed, split over several
+        tiles or in a layout _RAW_BITS doesn't cover (those are decoded
+        whole)
+    """
+    if len(img.tile) != 1:
+        return None
+    codec, extents, offset, args = img.tile[0][:4]
+    if codec != "raw" or tuple(extents) != (0, 0, img.width, img.height) or img.mode == "P":
+        return None
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+    if rawmode not in _RAW_BITS:
+        return None
+    row_bytes = (img.width * _RAW_BITS[rawmode] + 7) // 8
+    if stride and stride < row_bytes:
+        return None
+    return offset, stride or row_bytes, rawmode, ystep
+
+def _iter_strips(img, read, rows):
+    """Yield img as full-width strips of at most rows rows, top to bottom.
+    
+    Args:
+        img: Opened, not yet decoded PIL image
+        read: callable(offset, size) returning bytes of the encoded file,
+            used to read uncompressed images strip by strip
+        rows: Rows per strip
+    """
+    width, height = img.size
+    layout = _raw_layout(img)
+    if layout is None:
+        # Compressed formats decode as one stream; decode once, then crop
+        img.load()
+        for top in range(0, height, rows):
+            yield img.crop((0, top, width, min(height, top + rows)))
+        return
+    
+    offset, row_bytes, rawmode, ystep = layout
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        # Bottom-up files (BMP) store the last row first
+        first_row = top if ystep > 0 else height - bottom
+        data = read(offset + first_row * row_bytes, (bottom - top) * row_bytes)
+        yield Image.frombytes(img.mode, (width, bottom - top), data, "raw", rawmode, row_bytes, ystep)
+
+def _tiled_stages(header, read, file_size, finished, tile_pixels=None):
+    """Run the statistics and quantize stages over strips of the image.
+    
+    Pass one feeds every strip to a StatsAccumulator and gathers the k-means
+    sample, pass two assigns every pixel to the fitted colors. Uncompressed
+    images are read strip by strip; compressed ones are decoded once and
+    cropped, which still avoids the full-size working arrays.
+    
+    Returns:
+        dict: The analysis, shaped like analyze_image_detailed() output
+    """
+    tile_pixels = tile_pixels or ANALYSIS_TILE_PIXELS
+    record_payload("original", file_size, pipeline="analysis")
+    basic_info = _basic_info(header, file_size)
+    width, height = header.size
+    rows = max(1, tile_pixels // width)
+    finished("decode")
+    
+    is_color = is_color_mode(header.mode)
+    
+    def strips():
+        for strip in _iter_strips(header, read, rows):
+            yield strip.convert("RGB") if is_color and strip.mode != "RGB" else strip
+    
+    accumulator = StatsAccumulator()
+    palette = StreamingPalette(width * height, k=ANALYSIS_COLOR_K) if is_color else None
+    with stage_timer("statistics", pipeline="analysis"):
+        for strip in strips():
+            accumulator.add(strip)
+            if palette is not None:
+                palette.sample(image_pixels(strip))
+    stats = accumulator.result()
+    color_analysis, complexity = _classify(stats, is_color)
+    finished("statistics")
+    
+    if palette is not None:
+        with stage_timer("quantize", pipeline="analysis"):
+            palette.fit()
+            for strip in strips():
+                palette.assign(image_pixels(strip))
+            color_analysis["dominant_colors"] = palette.palette()
+    finished("quantize")
+    
+    return {
+        "version": ANALYSIS_VERSION,
+        "basic_info": basic_info,
+        "color_analysis": color_analysis,
+        "complexity": complexity,
+        "statistics": stats.to_dict()
+    }
+
+def _animation_stages(header, file_size, max_edge, finished):
+    """Run the analysis over frames sampled from an animation.
+    
+    Statistics and dominant colors describe the samples pooled together.
+    Samples are evenly spaced in time, so a frame shown for longer weighs
+    more. Dominant colors use k-means regardless of ANALYSIS_COLOR_METHOD.
+    
+    Returns:
+        dict: The analysis, shaped like analyze_image_detailed() output plus
+        an "animation" entry with the per-sample timeline
+    """
+    record_payload("original", file_size, pipeline="analysis")
+    basic_info = _basic_info(header, file_size)
+    is_color = is_color_mode(header.mode)
+    frame_count = header.n_frames
+    loop = header.info.get("loop")
+    with stage_timer("decode", pipeline="analysis"):
+        samples, interval, duration = sample_frames(header, max_edge)
+    finished("decode")
+    
+    accumulator = StatsAccumulator()
+    frame_stats = {}
+    with stage_timer("statistics", pipeline="analysis"):
+        for sample in samples:
+            frame = sample.image if is_color else sample.image.convert("L")
+            accumulator.add(frame)
+            accumulator.end_image()
+            if sample.index not in frame_stats:
+                frame_stats[sample.index] = compute_image_stats(frame)
+    # Describe one frame's size, not the stacked samples'
+    stats = accumulator.result()._replace(height=samples[0].image.height)
+    color_analysis, complexity = _classify(stats, is_color)
+    finished("statistics")
+    
+    frame_colors = {}
+    if is_color:
+        with stage_timer("quantize", pipeline="analysis"):
+            palette = StreamingPalette(sum(s.image.width * s.image.height for s in samples), k=ANALYSIS_COLOR_K)
+            for sample in samples:
+                palette.sample(image_pixels(sample.image))
+            palette.fit()
+            center_names = name_colors(np.clip(np.rint(palette.centers), 0, 255).astype(int))
+            for sample in samples:
+                counts = palette.assign(image_pixels(sample.image))
+                frame_colors[sample.index] = str(center_names[counts.argmax()])
+            color_analysis["dominant_colors"] = palette.palette()
+    finished("quantize")
+    
+    timeline = []
+    for sample in samples:
+        frame = frame_stats[sample.index]
+        entry = {
+            "time_ms": sample.time_ms,
+            "frame": sample.index,
+            "brightness": round(frame.brightness * 100, 1),
+            "contrast": round(frame.contrast * 100, 1),
+            "edge_density": round(frame.edge_density, 1),
+        }
+        if is_color:
+            entry["dominant_color"] = frame_colors[sample.index]
+        timeline.append(entry)
+    
+    return {
+        "version": ANALYSIS_VERSION,
+        "basic_info": basic_info,
+        "color_analysis": color_analysis,
+        "complexity": complexity,
+        "statistics": stats.to_dict(),
+        "animation": {
+            "frame_count": frame_count,
+            "duration_ms": round(duration),
+            # 0 loops forever; None plays once
+            "loop": loop,
+            "sample_interval_ms": round(interval),
+            "sampled_frames": len(frame_stats),
+            "timeline": timeline,
+        },
+    }
+
+def analyze_image_tiled(path, on_stage=None, tile_pixels=None, max_pixels=None):
+    """Exact full-resolution analysis of an image file in bounded memory.
+    
+    For archival scans and panoramas too large to decode and filter in one
+    piece. The image is measured in full-width strips of about tile_pixels
+    pixels, with a two-row halo carried between strips for the 3x3 kernels,
+    and dominant colors use k-means regardless of ANALYSIS_COLOR_METHOD.
+    
+    Agreement with analyze_image_detailed(max_edge=0): histogram values
+    (brightness, contrast, percentiles, clipping) and the blur, noise and
+    edge sums are identical, being exact integer sums either way; dominant
+    colors sample and cluster identically, so they match too, barring a
+    float tie in assigning a pixel (well under 0.1 points).
+    
+    Peak memory: uncompressed TIFF, BMP and PPM/PGM files are read one strip
+    at a time, so memory follows tile_pixels whatever the image size (about
+    35 bytes per strip pixel). Compressed files (JPEG, PNG, compressed TIFF)
+    are decoded once in full (3 bytes per pixel for RGB) plus one strip of
+    working arrays.
+    
+    Args:
+        path: Path to the image file
+        on_stage: Optional callable(stage_name, completed, total), see
+            analyze_image_detailed()
+        tile_pixels: Pixels per strip, defaults to ANALYSIS_TILE_PIXELS
+        max_pixels: Pixel ceiling, defaults to ANALYSIS_TILED_MAX_PIXELS
+            (0 disables); there is no byte ceiling
+    
+    Returns:
+        dict: Same shape as analyze_image_detailed() output, or {"error": ...}
+    """
+    stage_names = [name for name, _ in LOCAL_ANALYSIS_STAGES]
+    
+    def finished(stage_name):
+        if on_stage is not None:
+            on_stage(stage_name, stage_names.index(stage_name) + 1, len(stage_names))
+    
+    if max_pixels is None:
+        max_pixels = ANALYSIS_TILED_MAX_PIXELS
+    try:
+        with open(path, "rb") as f:
+            def read(offset, size):
+                f.seek(offset)
+                return f.read(size)
+            
+            header = open_image(path, max_bytes=0, max_pixels=max_pixels)
+            try:
+                return _tiled_stages(header, read, os.path.getsize(path), finished, tile_pixels)
+            finally:
+                header.close()
+    except Exception as e:
+        return {"error": f"Error analyzing image: {str(e)}"}
+
+def image_statistics(analysis):
+    """The typed ImageStats of a successful analyze_image_detailed() result."""
+    return ImageStats.from_dict(analysis["statistics"])
+
+def analyze_image_detailed(image_bytes, on_stage=None, use_cache=True, max_edge=None, upload=None, on_cache=None):
+    """
+    Perform detailed offline image analysis for comprehensive image reading.
+    
+    Each stage in LOCAL_ANALYSIS_STAGES runs exactly once per call. Results
+    are looked up in the content-addressed analysis cache first, so repeat
+    uploads of the same bytes skip decoding entirely.
+    
+    Args:
+        image_bytes: The binary image data
+        on_stage: Optional callable(stage_name, completed, total) invoked as
+            each stage finishes, e.g. to drive a progress bar
+        use_cache: Whether to read from and write to the analysis cache
+        max_edge: Working-resolution limit, defaults to ANALYSIS_MAX_EDGE;
+            0 analyzes at full resolution
+        upload: Optional uploads.ImageUpload of image_bytes; its shared
+            working image is analyzed if it has enough resolution
+        on_cache: Optional callable(hit) told whether the analysis cache
+            served the result; not called when use_cache is False
+        
+    Returns:
+        dict: Detailed analysis results. Values are plain numbers and
+        strings (sizes in pixels and bytes, not formatted text); the
+        "statistics" entry is an ImageStats.to_dict(), see image_statistics().
+        Animated GIF, WebP and PNG images are analyzed over frames sampled
+        in time (see animation.py) and get an "animation" entry with frame
+        count, duration and the per-sample timeline.
+    """
+    if max_edge is None:
+        max_edge = ANALYSIS_MAX_EDGE
+    if upload is not None and (upload.animated or not upload.can_serve(max_edge)):
+        # An animation's working image holds only its first frame
+        upload = None
+    version = analysis_cache_version(max_edge)
+    if upload is not None and (upload.downscaled or (max_edge and max(upload.size) > max_edge)):
+        # Resampling the shared working image can differ by rounding from
+        # decoding straight to max_edge, so those results are kept apart
+        version += f"/working={upload.working_edge}"
+
+    stage_names = [name for name, _ in LOCAL_ANALYSIS_STAGES]
+    
+    def finished(stage_name):
+        if on_stage is not None:
+            on_stage(stage_name, stage_names.index(stage_name) + 1, len(stage_names))
+    
+    cache = get_analysis_cache() if use_cache else None
+    key = content_key(image_bytes, version) if cache is not None else None
+    if cache is not None:
+        cached = cache.get(key)
+        record_cache("analysis", cached is not None)
+        if on_cache is not None:
+            on_cache(cached is not None)
+        if cached is not None:
+            for stage_name in stage_names[:-1]:
+                finished(stage_name)
+            return cached
+    
+    try:
+        header = open_image(image_bytes) if upload is None else None
+        if header is not None and is_animated(header):
+            analysis = _animation_stages(header, len(image_bytes), max_edge, finished)
+        elif (header is not None and not max_edge and ANALYSIS_COLOR_METHOD == "kmeans"
+                and header.width * header.height > ANALYSIS_TILE_PIXELS):
+            # Same results as the in-memory stages below, in bounded memory
+            analysis = _tiled_stages(
+                header, lambda offset, size: image_bytes[offset:offset + size], len(image_bytes), finished
+            )
+        else:
+            img, basic_info = _decode_stage(image_bytes, max_edge, upload, header)
+            finished("decode")
+            
+            img_rgb, stats, color_analysis, complexity = _statistics_stage(img)
+            finished("statistics")
+            
+            if img_rgb is not None:
+                color_analysis["dominant_colors"] = _quantize_stage(img_rgb)
+            finished("quantize")
+            
+            analysis = {
+                "version": ANALYSIS_VERSION,
+                "basic_info": basic_info,
+                "color_analysis": color_analysis,
+                "complexity": complexity,
+                "statistics": stats.to_dict()
+            }
+    except Exception as e:
+        return {"error": f"Error analyzing image: {str(e)}"}
+
+    if cache is not None:
+        try:
+            cache.put(key, analysis)
+        except Exception:
+            # The analysis itself succeeded; it just won't be reused
+            logger.warning("Could not store the analysis in the cache", exc_info=True)
+    return analysis
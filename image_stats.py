@@ -0,0 +1,318 @@
+"""Single-pass exposure and quality statistics for the local analysis.
+
+compute_image_stats() measures one working image and returns an ImageStats
+record of plain numbers (no formatted strings):
+
+* brightness, contrast, per-channel mean/std/percentiles and highlight and
+  shadow clipping, all read from 256-bin histograms (one C pass per image)
+* blur as the variance of the 4-neighbour Laplacian: low values mean few
+  sharp transitions, i.e. a soft or out-of-focus image
+* noise as Immerkær's estimate of the noise standard deviation
+* edge density as the mean 8-neighbour edge response, identical to the
+  previous Pillow FIND_EDGES measurement
+
+The three kernel responses share the same two neighbourhood sums over the
+luma plane, so they cost a handful of vectorized array additions together
+rather than a filter pass each.
+
+StatsAccumulator produces the same record from an image fed in strips, so
+images too large to decode at once can be measured exactly (see
+image_analysis.analyze_image_tiled).
+
+Histogram values are exact for the image they are given. The kernel
+measurements are scale-dependent: blur and edge density read higher, and
+noise lower, on a downscaled working image than at full resolution.
+
+Results are versioned by STATS_VERSION; bump it whenever a definition
+changes so cached analyses are recomputed.
+"""
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+STATS_VERSION = 1
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+# Values at or below / at or above these count as clipped shadows / highlights
+SHADOW_CLIP = 2
+HIGHLIGHT_CLIP = 253
+
+# Laplacian variance below which an image reads as blurry (common rule of
+# thumb at ~1 MP; lower it for soft, low-detail subjects)
+BLUR_THRESHOLD = 100.0
+
+ChannelStats = namedtuple(
+    "ChannelStats", ["mean", "std", "percentiles", "clipped_shadows", "clipped_highlights"]
+)
+ChannelStats.__doc__ = """Statistics of one 0-255 channel.
+
+mean, std and percentiles ({percentile: value}) are in 0-255 units; the
+clipped fractions are shares of pixels in [0, 1].
+"""
+
+
+class ImageStats(namedtuple("ImageStats", [
+    "version", "width", "height", "luma", "channels",
+    "brightness", "contrast", "laplacian_variance", "noise_sigma", "edge_density",
+])):
+    """Statistics of one working image.
+
+    Attributes:
+        version: STATS_VERSION the record was computed with
+        width, height: Size of the image that was measured
+        luma: ChannelStats of the luma plane
+        channels: {band name: ChannelStats}, e.g. R, G, B or just L
+        brightness: Mean luma in [0, 1]
+        contrast: Largest channel standard deviation in [0, 1]
+        laplacian_variance: Blur measure; higher is sharper
+        noise_sigma: Estimated noise standard deviation in 0-255 units
+        edge_density: Mean edge response in 0-255 units
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_blurry(self):
+        return self.laplacian_variance < BLUR_THRESHOLD
+
+    def to_dict(self):
+        """JSON-ready nested dict; the inverse of from_dict()."""
+        data = self._asdict()
+        data["luma"] = _channel_to_dict(self.luma)
+        data["channels"] = {band: _channel_to_dict(stats) for band, stats in self.channels.items()}
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild an ImageStats from to_dict() output.
+
+        Raises:
+            ValueError: If the data was written by another STATS_VERSION
+        """
+        if data.get("version") != STATS_VERSION:
+            raise ValueError(f"Statistics version {data.get('version')!r} is not {STATS_VERSION}")
+        return cls(**{
+            **data,
+            "luma": _channel_from_dict(data["luma"]),
+            "channels": {band: _channel_from_dict(stats) for band, stats in data["channels"].items()},
+        })
+
+
+def _channel_to_dict(stats):
+    data = stats._asdict()
+    # JSON object keys are strings
+    data["percentiles"] = {str(p): value for p, value in stats.percentiles.items()}
+    return data
+
+
+def _channel_from_dict(data):
+    return ChannelStats(**{**data, "percentiles": {int(p): value for p, value in data["percentiles"].items()}})
+
+
+def channel_stats(histogram):
+    """ChannelStats from a 256-bin histogram of one channel."""
+    counts = np.asarray(histogram, dtype=np.float64)
+    total = counts.sum()
+    if not total:
+        return ChannelStats(0.0, 0.0, {p: 0 for p in PERCENTILES}, 0.0, 0.0)
+    values = np.arange(256)
+    mean = float(counts @ values / total)
+    variance = float(counts @ (values - mean) ** 2 / total)
+    cumulative = np.cumsum(counts)
+    # The smallest value whose cumulative share reaches p percent
+    ranks = np.searchsorted(cumulative, [p / 100 * total for p in PERCENTILES])
+    return ChannelStats(
+        mean=round(mean, 3),
+        std=round(math.sqrt(variance), 3),
+        percentiles={p: int(min(rank, 255)) for p, rank in zip(PERCENTILES, ranks)},
+        clipped_shadows=round(float(cumulative[SHADOW_CLIP] / total), 5),
+        clipped_highlights=round(float(counts[HIGHLIGHT_CLIP:].sum() / total), 5),
+    )
+
+
+def _kernel_sums(pixels):
+    """Integer sums behind the kernel measurements of a 2-D int16 luma block.
+
+    Only the block's interior (every pixel with all 8 neighbours inside the
+    block) is filtered.
+
+    Returns:
+        tuple: (interior, laplacian_sum, laplacian_squares, residual_sum,
+        edge_sum, center_sum) as Python ints
+    """
+    center = pixels[1:-1, 1:-1]
+    center4 = 4 * center
+    # Sums of the 4 edge neighbours and the 4 corner neighbours; every
+    # kernel below is a combination of these and the center (int16 holds
+    # all of them: |response| <= 16 * 255)
+    cross = pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+    cross += pixels[1:-1, :-2]
+    cross += pixels[1:-1, 2:]
+    corners = pixels[:-2, :-2] + pixels[:-2, 2:]
+    corners += pixels[2:, :-2]
+    corners += pixels[2:, 2:]
+
+    # [0 1 0; 1 -4 1; 0 1 0]; squares reach 1020^2, so they need int32
+    laplacian = (cross - center4).astype(np.int32)
+    laplacian_sum = int(laplacian.sum(dtype=np.int64))
+    laplacian *= laplacian
+    laplacian_squares = int(laplacian.sum(dtype=np.int64))
+
+    # Immerkær (1996): [1 -2 1; -2 4 -2; 1 -2 1] cancels image structure up
+    # to second order, leaving mostly noise
+    residual = corners - 2 * cross
+    residual += center4
+    np.abs(residual, out=residual)
+
+    # FIND_EDGES [-1 -1 -1; -1 8 -1; -1 -1 -1], clipped to 0-255 like
+    # Pillow's 8-bit output
+    edges = 2 * center4
+    edges -= cross
+    edges -= corners
+    np.clip(edges, 0, 255, out=edges)
+
+    return (
+        center.size,
+        laplacian_sum,
+        laplacian_squares,
+        int(residual.sum(dtype=np.int64)),
+        int(edges.sum(dtype=np.int64)),
+        int(center.sum(dtype=np.int64)),
+    )
+
+
+def _kernel_measurements(sums, luma_sum, height, width):
+    """(laplacian_variance, noise_sigma, edge_density) from accumulated sums."""
+    interior, laplacian_sum, laplacian_squares, residual_sum, edge_sum, center_sum = sums
+    if not interior:
+        return 0.0, 0.0, luma_sum / (height * width) if height * width else 0.0
+    # Exact integer numerator, so strip boundaries cannot change the result
+    laplacian_variance = (laplacian_squares * interior - laplacian_sum ** 2) / interior ** 2
+    noise_sigma = math.sqrt(math.pi / 2) * residual_sum / (6 * interior)
+    # Pillow copies the border pixels unfiltered
+    border = luma_sum - center_sum
+    edge_density = (edge_sum + border) / (height * width)
+    return laplacian_variance, noise_sigma, edge_density
+
+
+def kernel_stats(luma):
+    """Blur, noise and edge measurements of a 2-D uint8 luma array.
+
+    Returns:
+        tuple: (laplacian_variance, noise_sigma, edge_density)
+    """
+    height, width = luma.shape
+    pixels = luma.astype(np.int16)
+    sums = _kernel_sums(pixels) if height >= 3 and width >= 3 else (0,) * 6
+    return _kernel_measurements(sums, int(pixels.sum(dtype=np.int64)), height, width)
+
+
+class StatsAccumulator:
+    """Builds ImageStats from horizontal strips fed top to bottom.
+
+    Histograms simply add up. For the 3x3 kernels, each strip is filtered
+    together with the last two luma rows of the previous one (the halo), so
+    every interior pixel is filtered exactly once with its real neighbours,
+    and all kernel responses are reduced to integer sums. The result is
+    therefore the same as compute_image_stats() of the whole image, while
+    memory is bounded by the strip size.
+
+    Example:
+        accumulator = StatsAccumulator()
+        for strip in strips:
+            accumulator.add(strip)
+        stats = accumulator.result()
+    """
+
+    def __init__(self):
+        self.width = None
+        self.height = 0
+        self.bands = None
+        self._histogram = None
+        self._luma_histogram = np.zeros(256, dtype=np.int64)
+        self._luma_sum = 0
+        self._kernel_sums = [0] * 6
+        self._halo = None
+
+    def add(self, img):
+        """Add the next strip: a PIL image as full-width as the previous ones.
+
+        Args:
+            img: PIL image in RGB or L; other modes are converted as in
+                compute_image_stats()
+
+        Raises:
+            ValueError: If the strip's width or bands differ from earlier strips
+        """
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB" if img.mode in ("RGBA", "CMYK", "P", "YCbCr", "LAB", "HSV") else "L")
+        if self.bands is None:
+            self.width, self.bands = img.width, img.getbands()
+            self._histogram = np.zeros(256 * len(self.bands), dtype=np.int64)
+        elif (img.width, img.getbands()) != (self.width, self.bands):
+            raise ValueError(f"Strip is {img.width} px {img.mode}, expected {self.width} px {''.join(self.bands)}")
+
+        # One histogram call covers every band: 256 bins each, concatenated
+        self._histogram += img.histogram()
+        gray = img if img.mode == "L" else img.convert("L")
+        self._luma_histogram += gray.histogram()
+
+        pixels = np.asarray(gray).astype(np.int16)
+        self._luma_sum += int(pixels.sum(dtype=np.int64))
+        if self._halo is not None:
+            pixels = np.concatenate([self._halo, pixels])
+        if pixels.shape[0] >= 3 and self.width >= 3:
+            for i, value in enumerate(_kernel_sums(pixels)):
+                self._kernel_sums[i] += value
+        self._halo = pixels[-2:]
+        self.height += img.height
+
+    def end_image(self):
+        """Finish the current image, e.g. one frame of an animation.
+
+        Later strips start a new image of the same width: the kernels don't
+        filter across the boundary, and its first and last rows count as
+        border. The result then describes the pixels of all the images
+        pooled together.
+        """
+        self._halo = None
+
+    def result(self):
+        """The ImageStats of everything added so far."""
+        histogram = self._histogram if self._histogram is not None else np.zeros(256, dtype=np.int64)
+        bands = self.bands or ("L",)
+        channels = {band: channel_stats(histogram[i * 256:(i + 1) * 256]) for i, band in enumerate(bands)}
+        luma = channel_stats(self._luma_histogram)
+        laplacian_variance, noise_sigma, edge_density = _kernel_measurements(
+            self._kernel_sums, self._luma_sum, self.height, self.width or 0
+        )
+        return ImageStats(
+            version=STATS_VERSION,
+            width=self.width or 0,
+            height=self.height,
+            luma=luma,
+            channels=channels,
+            brightness=round(luma.mean / 255, 5),
+            contrast=round(max(stats.std for stats in channels.values()) / 255, 5),
+            laplacian_variance=round(laplacian_variance, 3),
+            noise_sigma=round(noise_sigma, 3),
+            edge_density=round(edge_density, 3),
+        )
+
+
+def compute_image_stats(img):
+    """Measure a working image in one histogram pass plus one kernel pass.
+
+    Args:
+        img: PIL image in RGB (color statistics) or L (grayscale); other
+            modes are converted, color ones to RGB
+
+    Returns:
+        ImageStats
+    """
+    accumulator = StatsAccumulator()
+    accumulator.add(img)
+    return accumulator.result()
@@ -0,0 +1,416 @@
+"""Persistent background job queue for captioning and local analysis.
+
+Jobs are rows in a SQLite file (JOB_QUEUE_PATH) that the Streamlit app and
+any number of worker processes share. The app submits a job and polls its
+status instead of running a slow Gemini call or a heavy analysis on the
+session's script thread; results are read back from the same file, so a
+page reload or an app restart does not lose them.
+
+Start the workers next to the app:
+
+    python job_queue.py --workers 4
+
+Each claimed job is leased to one worker for JOB_LEASE_SECONDS and the lease
+is renewed while the job runs. If a worker dies, its job is claimed again
+once the lease expires, up to JOB_MAX_ATTEMPTS times; the supervisor above
+restarts dead worker processes. A finished job's result is kept for
+JOB_RETENTION_SECONDS; the image bytes are dropped as soon as no queued or
+running job needs them.
+
+Kinds of job (see JOB_HANDLERS):
+
+    analysis  {}                                   -> {"report": str}
+    caption   {"prompt", "use_cache"}              -> {"caption": str, "upload_stats": dict | None}
+    variants  {"variants", "prompt_options", "use_cache"} -> {"variants": [dict]}
+
+Gemini rate limits (GEMINI_RPM, GEMINI_TPM) apply per process, so divide
+them by the number of workers.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from dotenv import load_dotenv
+
+from metrics import get_metrics, stage_timer
+from singleton import process_singleton
+
+load_dotenv()
+
+logger = logging.getLogger("job_queue")
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# How often idle workers look for new jobs, and the app for finished ones
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+
+PENDING_STATUSES = ("queued", "running")
+FINISHED_STATUSES = ("done", "failed")
+
+Job = namedtuple("Job", [
+    "id", "kind", "status", "owner", "params", "result", "error", "attempts", "created", "started", "finished",
+])
+
+_JOB_COLUMNS = "id, kind, status, owner, params, result, error, attempts, created, started, finished"
+
+
+def _job(row):
+    fields = dict(zip(Job._fields, row))
+    fields["params"] = json.loads(fields["params"])
+    if fields["result"] is not None:
+        fields["result"] = json.loads(fields["result"])
+    return Job(**fields)
+
+
+class JobQueue:
+    """SQLite-backed job queue shared between processes.
+
+    All methods are thread-safe; every process opens its own JobQueue on
+    the same path.
+    """
+
+    def __init__(self, path, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Autocommit mode: claims run in explicit BEGIN IMMEDIATE transactions
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS images (sha256 TEXT PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner TEXT,
+                params TEXT NOT NULL,
+                image_sha256 TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+            CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created);
+        """)
+
+    @classmethod
+    def from_env(cls):
+        """Create a queue from JOB_* environment variables, or None if JOB_QUEUE_PATH is unset."""
+        if not JOB_QUEUE_PATH:
+            return None
+        return cls(JOB_QUEUE_PATH)
+
+    def submit(self, kind, image_bytes, params=None, owner=None):
+        """Queue a job and return its id.
+
+        Args:
+            kind: A key of JOB_HANDLERS
+            image_bytes: The encoded image the job works on
+            params: JSON-serializable handler arguments
+            owner: Optional id of the submitting client, see list_jobs()
+        """
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind: {kind!r} (expected one of {sorted(JOB_HANDLERS)})")
+        job_id = uuid.uuid4().hex
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        with self._lock, self._transaction():
+            self._db.execute("INSERT OR IGNORE INTO images (sha256, data) VALUES (?, ?)", (sha256, image_bytes))
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, status, owner, params, image_sha256, created) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, owner, json.dumps(params or {}, ensure_ascii=False), sha256, time.time()),
+            )
+        get_metrics().inc("jobs_total", kind=kind, status="submitted")
+        return job_id
+
+    def get(self, job_id):
+        """Return the Job with this id, or None."""
+        with self._lock:
+            row = self._db.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row is not None else None
+
+    def list_jobs(self, owner, limit=20):
+        """Return owner's most recent jobs, newest first."""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs WHERE owner = ? ORDER BY created DESC LIMIT ?", (owner, limit)
+            ).fetchall()
+        return [_job(row) for row in rows]
+
+    def counts(self):
+        """Return {status: number of jobs}."""
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def claim(self, worker):
+        """Lease the oldest runnable job to worker.
+
+        Runnable means queued, or running under an expired lease (its
+        worker died). Jobs that have used up their attempts are failed
+        instead of being claimed again.
+
+        Returns:
+            tuple: (Job, image_bytes), or None if nothing is runnable
+        """
+        now = time.time()
+        with self._lock, self._transaction():
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, worker = NULL, "
+                "error = 'The worker stopped while running this job ' || attempts || ' times' "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = self._db.execute(
+                f"UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                f"started = ? WHERE id = (SELECT id FROM jobs WHERE status = 'queued' "
+                f"OR (status = 'running' AND lease_expires < ?) ORDER BY created LIMIT 1) "
+                f"RETURNING {_JOB_COLUMNS}, image_sha256",
+                (worker, now + self.lease_seconds, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            data = self._db.execute("SELECT data FROM images WHERE sha256 = ?", (row[-1],)).fetchone()[0]
+        return _job(row[:-1]), data
+
+    def heartbeat(self, job_id, worker):
+        """Extend worker's lease on a job; False if the lease was lost."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        """Store a job's result; ignored (False) if worker no longer holds the lease."""
+        return self._finish(job_id, worker, "done", result=json.dumps(result, ensure_ascii=False))
+
+    def fail(self, job_id, worker, error):
+        """Mark a job failed with an error message; ignored (False) if worker no longer holds the lease."""
+        return self._finish(job_id, worker, "failed", error=str(error))
+
+    def purge(self, older_than=JOB_RETENTION_SECONDS):
+        """Delete jobs finished more than older_than seconds ago; return how many."""
+        with self._lock, self._transaction():
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (time.time() - older_than,)
+            )
+            self._delete_unused_images()
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _finish(self, job_id, worker, status, result=None, error=None):
+        with self._lock, self._transaction():
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, worker = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (status, result, error, time.time(), job_id, worker),
+            )
+            if cursor.rowcount:
+                self._delete_unused_images()
+        return cursor.rowcount == 1
+
+    def _delete_unused_images(self):
+        """Drop image bytes no pending job needs; the caller holds the lock."""
+        self._db.execute(
+            "DELETE FROM images WHERE sha256 NOT IN "
+            "(SELECT image_sha256 FROM jobs WHERE status IN ('queued', 'running'))"
+        )
+
+    def _transaction(self):
+        return _ImmediateTransaction(self._db)
+
+
+class _ImmediateTransaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error.
+
+    IMMEDIATE takes the write lock up front, so two workers can't both read
+    the same queued row before either updates it.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+@process_singleton
+def get_job_queue():
+    """Process-wide JobQueue from JOB_QUEUE_PATH, or None if background jobs are off."""
+    return JobQueue.from_env()
+
+
+def _run_analysis(image_bytes, params):
+    from captioning import generate_caption
+
+    return {"report": generate_caption(image_bytes, caption_source="local", use_cache=params.get("use_cache", True))}
+
+
+def _run_caption(image_bytes, params):
+    from captioning import caption_with_gemini
+
+    stats = {}
+    caption = caption_with_gemini(
+        image_bytes, params.get("prompt"), use_cache=params.get("use_cache", True), on_upload=stats.update
+    )
+    return {"caption": caption, "upload_stats": stats or None}
+
+
+def _run_variants(image_bytes, params):
+    from captioning import caption_variants
+
+    return {"variants": caption_variants(
+        image_bytes, params["variants"], params["prompt_options"], use_cache=params.get("use_cache", True)
+    )}
+
+
+# Handlers take (image_bytes, params) and return a JSON-serializable result;
+# exceptions fail the job with their message. Imported lazily so the app
+# only pays for what it submits.
+JOB_HANDLERS = {
+    "analysis": _run_analysis,
+    "caption": _run_caption,
+    "variants": _run_variants,
+}
+
+
+def run_job(queue, job, image_bytes, worker):
+    """Run one claimed job, renewing its lease until the handler returns."""
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(queue.lease_seconds / 3):
+            if not queue.heartbeat(job.id, worker):
+                logger.warning("Lost the lease on job %s", job.id)
+                return
+
+    threading.Thread(target=renew, name=f"lease-{job.id[:8]}", daemon=True).start()
+    get_metrics().observe("stage_seconds", time.time() - job.created, stage="queue_wait", pipeline="jobs")
+    try:
+        with stage_timer("run", pipeline="jobs", kind=job.kind):
+            result = JOB_HANDLERS[job.kind](image_bytes, job.params)
+    except Exception as e:
+        logger.exception("Job %s (%s) failed", job.id, job.kind)
+        queue.fail(job.id, worker, e)
+        get_metrics().inc("jobs_total", kind=job.kind, status="failed")
+    else:
+        queue.complete(job.id, worker, result)
+        get_metrics().inc("jobs_total", kind=job.kind, status="done")
+    finally:
+        stopped.set()
+
+
+def run_worker(path, poll_interval=JOB_POLL_INTERVAL, max_jobs=None, stop=None):
+    """Claim and run jobs from the queue at path until stopped.
+
+    Args:
+        path: SQLite file of the queue
+        poll_interval: Seconds to sleep when no job is runnable
+        max_jobs: Return after this many jobs (None: run forever)
+        stop: Optional threading/multiprocessing Event ending the loop
+    """
+    queue = JobQueue(path)
+    worker = f"{os.uname().nodename}:{os.getpid()}" if hasattr(os, "uname") else str(os.getpid())
+    done = 0
+    last_purge = 0.0
+    while (max_jobs is None or done < max_jobs) and not (stop is not None and stop.is_set()):
+        if time.time() - last_purge > 3600:
+            last_purge = time.time()
+            queue.purge()
+        claimed = queue.claim(worker)
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+        run_job(queue, *claimed, worker)
+        done += 1
+    queue.close()
+
+
+def _worker_main(path, poll_interval):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    # The supervisor handles Ctrl+C and terminates workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(path, poll_interval)
+
+
+def supervise(path, workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL, stop=None):
+    """Keep `workers` worker processes running until interrupted, restarting any that die.
+
+    Args:
+        stop: Optional threading Event that also ends supervision
+    """
+    # Spawn rather than fork: workers start clean of the parent's threads and sockets
+    context = multiprocessing.get_context("spawn")
+    stop = stop or threading.Event()
+    processes = {}
+    try:
+        while not stop.is_set():
+            for slot in range(workers):
+                process = processes.get(slot)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.warning("Worker %s exited with %s; restarting", process.name, process.exitcode)
+                process = context.Process(
+                    target=_worker_main, args=(path, poll_interval), name=f"job-worker-{slot}", daemon=True
+                )
+                process.start()
+                processes[slot] = process
+            stop.wait(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run background captioning workers.")
+    parser.add_argument("--path", default=JOB_QUEUE_PATH or None, help="Queue file (default: JOB_QUEUE_PATH)")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS,
+                        help=f"Worker processes (default: JOB_WORKERS, {JOB_WORKERS})")
+    parser.add_argument("--poll-interval", type=float, default=JOB_POLL_INTERVAL,
+                        help=f"Idle polling interval in seconds (default: {JOB_POLL_INTERVAL})")
+    args = parser.parse_args(argv)
+    if not args.path:
+        parser.error("set JOB_QUEUE_PATH or pass --path")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    JobQueue(args.path).close()  # create the schema before the workers race to
+    logger.info("Running %d workers on %s", args.workers, args.path)
+    supervise(args.path, args.workers, args.poll_interval)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
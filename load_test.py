@@ -0,0 +1,390 @@
+"""Load test: many concurrent simulated sessions uploading, analyzing and captioning.
+
+Each session is a thread, as Streamlit runs each browser session's script in
+a thread of one server process. A session repeatedly does what a user of the
+app does: upload an image (ImageUpload plus its preview), run the local
+analysis through generate_caption(), ask generate_caption() for a Gemini
+caption in a random mood, then pauses for a think time. Gemini requests go
+to a local fake server (fake_gemini_server.py) with configurable latency,
+error rate and 429 behavior, through the async engine.
+
+    python load_test.py --sessions 50 --duration 120
+    python load_test.py --sessions 50 --latency 1.5 --error-rate 0.02 --rate-limit-rate 0.05 --rpm-limit 600
+    python load_test.py --sessions 20 --workflow analysis --megapixels 12
+    python load_test.py --api-base http://127.0.0.1:8765   # an already running fake server
+
+Reports throughput, p50/p95/p99/max latency and error rates per operation,
+API errors by type (including ones that were retried successfully) and
+process RSS sampled every --sample-interval seconds, with its growth rate
+over the second half of the run. Exits with status 1 if --max-error-rate or
+--max-growth-mb is exceeded.
+
+The client-side Gemini rate limit (GEMINI_RPM, default 60) applies as in the
+app, so with many sessions caption latency is usually dominated by waiting
+for it; pass --gemini-rpm to size a replica for a different quota.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+from benchmark import peak_rss_mb, synthetic_pixels
+from fake_gemini_server import FakeGeminiConfig, FakeGeminiServer
+
+OPERATIONS = ("upload", "analysis", "caption")
+WORKFLOWS = {
+    "both": ("analysis", "caption"),
+    "analysis": ("analysis",),
+    "caption": ("caption",),
+}
+CONTENTS = ["flat", "noisy", "high-edge"]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def current_rss_mb():
+    """Resident set size of this process in MiB (the peak where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return peak_rss_mb()
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def synthetic_uploads(count, megapixels, seed=0):
+    """Distinct JPEG files, so caches only help when --use-cache is given."""
+    uploads = []
+    for number in range(count):
+        pixels = synthetic_pixels(megapixels, CONTENTS[number % len(CONTENTS)], seed=seed + number)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+        uploads.append(buffer.getvalue())
+    return uploads
+
+
+def error_type(message):
+    """Short label for a failure message, e.g. "http_429"."""
+    match = re.search(r"\b([45]\d\d)\b", message)
+    return f"http_{match.group(1)}" if match else "error"
+
+
+class LoadStats:
+    """Thread-safe latencies and failures per operation.
+
+    Throughput only counts work finished before close_window(), so the
+    drain of operations still running at the end doesn't dilute it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: Counter() for operation in OPERATIONS}
+        self.completed_in_window = Counter()
+        self.iterations = 0
+        self.window_open = True
+
+    def record(self, operation, seconds, error=None):
+        with self._lock:
+            self.latencies[operation].append(seconds)
+            if error is not None:
+                self.errors[operation][error] += 1
+            if self.window_open:
+                self.completed_in_window[operation] += 1
+
+    def finish_iteration(self):
+        with self._lock:
+            if self.window_open:
+                self.iterations += 1
+
+    def close_window(self):
+        with self._lock:
+            self.window_open = False
+
+    def totals(self):
+        """(operations, failures) recorded so far."""
+        with self._lock:
+            return (sum(len(values) for values in self.latencies.values()),
+                    sum(sum(errors.values()) for errors in self.errors.values()))
+
+
+def run_session(number, uploads, moods, args, stats, stop):
+    """One simulated user, looping until stop is set."""
+    from captioning import generate_caption
+    from uploads import ImageUpload, MemoryLedger, UploadRejected
+
+    rng = random.Random(args.seed * 100_003 + number)
+    ledger = MemoryLedger()
+    # Sessions start evenly spread over the ramp-up
+    if stop.wait(args.ramp_up * number / max(1, args.sessions)):
+        return
+
+    while not stop.is_set():
+        data = rng.choice(uploads)
+        started = time.perf_counter()
+        try:
+            upload = ImageUpload(data, ledger=ledger)
+            upload.preview()
+        except UploadRejected as e:
+            stats.record("upload", time.perf_counter() - started, error_type(str(e)))
+            continue
+        stats.record("upload", time.perf_counter() - started)
+
+        try:
+            for operation in WORKFLOWS[args.workflow]:
+                failures = []
+
+                def notify(level, message):
+                    if level == "error":
+                        failures.append(message)
+
+                started = time.perf_counter()
+                generate_caption(
+                    data,
+                    caption_source="local" if operation == "analysis" else "gemini",
+                    mood_type=rng.choice(moods),
+                    use_cache=args.use_cache,
+                    notify=notify,
+                    upload=upload,
+                )
+                stats.record(operation, time.perf_counter() - started, error_type(failures[0]) if failures else None)
+        finally:
+            upload.release()
+        stats.finish_iteration()
+
+        if args.think_time and stop.wait(rng.expovariate(1 / args.think_time)):
+            return
+
+
+def sample_memory(stats, stop, interval, started, samples, active):
+    """Append (elapsed_s, rss_mb, operations, failures, active_sessions) every interval and once at stop."""
+    def sample():
+        operations, failures = stats.totals()
+        samples.append((time.perf_counter() - started, current_rss_mb(), operations, failures,
+                        sum(thread.is_alive() for thread in active)))
+        print(f"{samples[-1][0]:6.0f}s  {samples[-1][1]:7.0f} MB  {operations} operations, {failures} failed",
+              file=sys.stderr)
+
+    sample()
+    while not stop.wait(interval):
+        sample()
+    sample()
+
+
+def memory_growth(samples):
+    """(growth_mb, mb_per_minute): first to last sample, and the trend over the second half."""
+    if len(samples) < 4:
+        return samples[-1][1] - samples[0][1], 0.0
+    tail = samples[len(samples) // 2:]
+    elapsed = np.array([sample[0] for sample in tail])
+    rss = np.array([sample[1] for sample in tail])
+    slope = np.polyfit(elapsed, rss, 1)[0]
+    return samples[-1][1] - samples[0][1], float(slope * 60)
+
+
+def build_report(args, stats, window, drain, samples, api_errors, server_counters):
+    """Summary dict for printing and --json."""
+    operations = {}
+    for operation in OPERATIONS:
+        latencies = stats.latencies[operation]
+        if not latencies:
+            continue
+        failed = sum(stats.errors[operation].values())
+        operations[operation] = {
+            "count": len(latencies),
+            "failed": failed,
+            "error_rate": failed / len(latencies),
+            "errors": dict(stats.errors[operation]),
+            "per_s": stats.completed_in_window[operation] / window,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies) * 1000,
+        }
+    # Memory released while draining says nothing about growth under load
+    growth_mb, growth_mb_per_min = memory_growth([sample for sample in samples if sample[0] <= window] or samples)
+    return {
+        "sessions": args.sessions,
+        "workflow": args.workflow,
+        "window_s": window,
+        "drain_s": drain,
+        "iterations": stats.iterations,
+        "iterations_per_s": stats.iterations / window,
+        "operations": operations,
+        "api_errors": api_errors,
+        "server": server_counters,
+        "memory": {
+            "start_mb": samples[0][1],
+            "end_mb": samples[-1][1],
+            "peak_mb": max(peak_rss_mb(), max(sample[1] for sample in samples)),
+            "growth_mb": growth_mb,
+            "growth_mb_per_min": growth_mb_per_min,
+            "samples": samples,
+        },
+    }
+
+
+def format_report(report):
+    lines = [
+        f"{report['sessions']} sessions, workflow {report['workflow']}, {report['window_s']:.0f} s: "
+        f"{report['iterations']} iterations ({report['iterations_per_s']:.2f}/s); "
+        f"{report['drain_s']:.1f} s to finish the operations still running",
+        "",
+        f"{'operation':<10} {'count':>7} {'per s':>7} {'failed':>7} {'error %':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}",
+    ]
+    for operation, row in report["operations"].items():
+        lines.append(
+            f"{operation:<10} {row['count']:>7} {row['per_s']:>7.2f} {row['failed']:>7} {row['error_rate']:>8.2%} "
+            f"{row['p50_ms']:>8.0f} {row['p95_ms']:>8.0f} {row['p99_ms']:>8.0f} {row['max_ms']:>8.0f}"
+        )
+        if row["errors"]:
+            lines.append(f"{'':<10} failures: {', '.join(f'{kind} {count}' for kind, count in row['errors'].items())}")
+    if report["api_errors"]:
+        lines.append("\nGemini API errors, including retried ones: "
+                     + ", ".join(f"{kind} {count}" for kind, count in sorted(report["api_errors"].items())))
+    if report["server"]:
+        lines.append("Fake server: " + ", ".join(f"{name} {count}" for name, count in sorted(report["server"].items())))
+
+    memory = report["memory"]
+    lines.append(
+        f"\nMemory: {memory['start_mb']:.0f} MB at start, {memory['end_mb']:.0f} MB at end, "
+        f"{memory['peak_mb']:.0f} MB peak; under load it grew {memory['growth_mb']:+.0f} MB, "
+        f"trending {memory['growth_mb_per_min']:+.1f} MB/min over the second half"
+    )
+    lines.append(f"\n{'elapsed s':>9} {'RSS MB':>7} {'ops/s':>7} {'failed':>7} {'sessions':>8}")
+    previous = (0.0, 0)
+    for elapsed, rss, operations, failures, active in memory["samples"]:
+        rate = (operations - previous[1]) / (elapsed - previous[0]) if elapsed > previous[0] else 0.0
+        lines.append(f"{elapsed:>9.0f} {rss:>7.0f} {rate:>7.2f} {failures:>7} {active:>8}")
+        previous = (elapsed, operations)
+    return "\n".join(lines)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Load-test the captioning paths with concurrent simulated sessions.")
+    parser.add_argument("--sessions", type=int, default=50, help="Concurrent simulated users (default: 50)")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run after ramp-up starts (default: 60)")
+    parser.add_argument("--ramp-up", type=float, default=10, help="Seconds over which sessions start (default: 10)")
+    parser.add_argument("--think-time", type=float, default=2.0,
+                        help="Mean pause between a session's iterations in seconds, exponential (default: 2)")
+    parser.add_argument("--workflow", choices=list(WORKFLOWS), default="both",
+                        help="What each iteration runs after the upload (default: both)")
+    parser.add_argument("--images", type=int, default=24, help="Distinct synthetic images (default: 24)")
+    parser.add_argument("--megapixels", type=float, default=2, help="Size of each image (default: 2)")
+    parser.add_argument("--use-cache", action="store_true", help="Let the analysis and caption caches serve repeats")
+    parser.add_argument("--sample-interval", type=float, default=5, help="Seconds between RSS samples (default: 5)")
+    parser.add_argument("--api-base", help="Use a running fake server at this URL instead of starting one")
+    parser.add_argument("--latency", type=float, default=0.8, help="Fake server mean latency in seconds (default: 0.8)")
+    parser.add_argument("--jitter", type=float, default=0.4, help="Fake server latency jitter in seconds (default: 0.4)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests failing with 429")
+    parser.add_argument("--rpm-limit", type=int, default=0, help="Fake server returns 429 above this many requests/min")
+    parser.add_argument("--gemini-rpm", type=int, help="Client-side GEMINI_RPM (default: the app's setting)")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    parser.add_argument("--max-error-rate", type=float, help="Exit 1 if any operation fails more often than this")
+    parser.add_argument("--max-growth-mb", type=float, help="Exit 1 if RSS grows by more than this many MB")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    server = None
+    if args.api_base is None:
+        server = FakeGeminiServer(config=FakeGeminiConfig(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate, rpm_limit=args.rpm_limit, seed=args.seed,
+        )).start()
+    # Must be set before captioning is imported
+    os.environ.update({
+        "GEMINI_ENGINE": "async",
+        "GEMINI_API_BASE": args.api_base or server.base_url,
+        "GOOGLE_GEMINI_API_KEY": os.getenv("GOOGLE_GEMINI_API_KEY") or "load-test",
+    })
+    if args.gemini_rpm:
+        os.environ["GEMINI_RPM"] = str(args.gemini_rpm)
+
+    # Imported before the first memory sample so module loading isn't counted as growth
+    from captioning import get_mood_prompts
+    from metrics import get_metrics
+
+    moods = [mood for mood in get_mood_prompts() if mood != "Custom"]
+
+    print(f"Generating {args.images} synthetic {args.megapixels:g} MP images", file=sys.stderr)
+    uploads = synthetic_uploads(args.images, args.megapixels, args.seed)
+
+    stats = LoadStats()
+    stop = threading.Event()
+    sampler_stop = threading.Event()
+    samples = []
+    sessions = [
+        threading.Thread(target=run_session, args=(number, uploads, moods, args, stats, stop),
+                         name=f"session-{number}", daemon=True)
+        for number in range(args.sessions)
+    ]
+    started = time.perf_counter()
+    sampler = threading.Thread(
+        target=sample_memory, args=(stats, sampler_stop, args.sample_interval, started, samples, sessions),
+        name="load-test-memory", daemon=True,
+    )
+    sampler.start()
+    for session in sessions:
+        session.start()
+    try:
+        stop.wait(args.duration)
+    except KeyboardInterrupt:
+        print("Interrupted; waiting for running operations to finish", file=sys.stderr)
+    finally:
+        stats.close_window()
+        window = time.perf_counter() - started
+        stop.set()
+        # Operations in flight are finished; their latencies still count
+        for session in sessions:
+            session.join()
+        drain = time.perf_counter() - started - window
+        sampler_stop.set()
+        sampler.join()
+        server_counters = dict(server.counters) if server is not None else {}
+        if server is not None:
+            server.stop()
+
+    api_errors = {
+        dict(labels)["type"]: value
+        for (name, labels), value in get_metrics().snapshot()["counters"].items()
+        if name == "api_errors_total"
+    }
+    report = build_report(args, stats, window, drain, samples, api_errors, server_counters)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if args.max_error_rate is not None:
+        for operation, row in report["operations"].items():
+            if row["error_rate"] > args.max_error_rate:
+                failures.append(f"{operation} error rate {row['error_rate']:.2%} is over {args.max_error_rate:.2%}")
+    if args.max_growth_mb is not None and report["memory"]["growth_mb"] > args.max_growth_mb:
+        failures.append(f"RSS grew {report['memory']['growth_mb']:.0f} MB, over {args.max_growth_mb:.0f} MB")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""Process-wide metrics: stage latencies, payload sizes, cache hits, API errors.
+
+Instrumented code records into the shared registry from get_metrics():
+
+    with stage_timer("decode", pipeline="analysis"):
+        img = Image.open(...)
+    get_metrics().inc("api_errors_total", type="http_429")
+
+Metrics leave the process through pluggable sinks, selected with METRICS_SINKS
+(comma separated):
+
+* log              - periodic summary lines on the "metrics" logger
+* prometheus_file  - Prometheus text format written atomically to
+                     METRICS_PROMETHEUS_FILE (node_exporter textfile collector)
+* prometheus_http  - GET /metrics served on METRICS_PROMETHEUS_PORT
+
+Periodic sinks are flushed every METRICS_FLUSH_INTERVAL seconds. The
+Streamlit admin panel (METRICS_ADMIN_PANEL=1) reads snapshot() directly.
+
+Metrics are per process: work done in batch-mode worker processes is not
+recorded.
+"""
+
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from singleton import process_singleton
+
+load_dotenv()
+
+logger = logging.getLogger("metrics")
+
+METRIC_PREFIX = "caption_app_"
+
+# Show the metrics admin panel in the Streamlit sidebar
+METRICS_ADMIN_PANEL = os.getenv("METRICS_ADMIN_PANEL", "0").lower() in ("1", "true", "yes")
+
+# Histogram upper bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20)
+
+# Descriptions for the Prometheus HELP lines
+METRIC_HELP = {
+    "stage_seconds": "Wall time of one pipeline stage",
+    "payload_bytes": "Image payload size",
+    "cache_requests_total": "Cache lookups by cache and result",
+    "api_errors_total": "Gemini API errors by type",
+    "tokens_total": "Gemini tokens used by kind",
+    "fanout_variants_total": "Fan-out caption variants by how they were produced",
+    "uploads_rejected_total": "Uploads refused by the byte or pixel ceilings",
+    "upload_memory_bytes": "Memory held by one upload once its working image is decoded",
+    "jobs_total": "Background jobs by kind and outcome (submitted, done, failed)",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket containing it."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Thread-safe store of counters and histograms keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.sinks = []
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Record one observation in a histogram."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """Time the enclosed block into the stage_seconds histogram."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+    def snapshot(self):
+        """Return a consistent copy of all metrics.
+
+        Returns:
+            dict: {"counters": {(name, labels): value},
+                   "histograms": {(name, labels): Histogram}}
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {}
+            for key, histogram in self._histograms.items():
+                copy = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum, copy.count = histogram.sum, histogram.count
+                histograms[key] = copy
+        return {"counters": counters, "histograms": histograms}
+
+    def flush(self):
+        """Push the current snapshot to every sink."""
+        for sink in self.sinks:
+            try:
+                sink.export(self)
+            except Exception:
+                logger.exception("Metrics sink %s failed", type(sink).__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(registry):
+    """Render all metrics in the Prometheus text exposition format."""
+    snapshot = registry.snapshot()
+    lines = []
+    declared = set()
+
+    def declare(name, metric_type):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {METRIC_HELP.get(name, name.replace('_', ' '))}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+
+    for (name, labels), value in sorted(snapshot["counters"].items()):
+        declare(name, "counter")
+        lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {_format_value(value)}")
+
+    for (name, labels), histogram in sorted(snapshot["histograms"].items(), key=lambda item: item[0]):
+        declare(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            bucket_labels = _format_labels(labels, [("le", _format_value(float(bound)))])
+            lines.append(f"{METRIC_PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+        lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+class LogSink:
+    """Log one line per histogram (count, p50, p95, mean) and counter."""
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def export(self, registry):
+        snapshot = registry.snapshot()
+        for (name, labels), histogram in sorted(snapshot["histograms"].items(), key=lambda item: item[0]):
+            logger.log(
+                self.level, "%s%s count=%d p50<=%s p95<=%s mean=%.4g",
+                name, _format_labels(labels), histogram.count,
+                _format_value(histogram.quantile(0.5)), _format_value(histogram.quantile(0.95)),
+                histogram.sum / histogram.count if histogram.count else 0,
+            )
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            logger.log(self.level, "%s%s %s", name, _format_labels(labels), _format_value(value))
+
+
+class PrometheusFileSink:
+    """Write the Prometheus text format to a file, replacing it atomically."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, registry):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render_prometheus(registry))
+        os.replace(tmp_path, self.path)
+
+
+class PrometheusHTTPSink:
+    """Serve GET /metrics from a background thread; always current, so
+    export() is a no-op."""
+
+    def __init__(self, registry, host="127.0.0.1", port=9464):
+        # Imported here so processes without the HTTP sink don't pay for it
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_prometheus(registry).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+
+    def export(self, registry):
+        pass
+
+
+def _flush_periodically(registry, interval):
+    while True:
+        time.sleep(interval)
+        registry.flush()
+
+
+@process_singleton
+def get_metrics():
+    """Process-wide metrics registry with sinks configured from METRICS_* env vars."""
+    registry = MetricsRegistry()
+    sink_names = [name.strip() for name in os.getenv("METRICS_SINKS", "").split(",") if name.strip()]
+    for name in sink_names:
+        if name == "log":
+            registry.sinks.append(LogSink())
+        elif name == "prometheus_file":
+            registry.sinks.append(PrometheusFileSink(os.getenv("METRICS_PROMETHEUS_FILE", "caption_app.prom")))
+        elif name == "prometheus_http":
+            registry.sinks.append(PrometheusHTTPSink(
+                registry,
+                host=os.getenv("METRICS_PROMETHEUS_HOST", "127.0.0.1"),
+                port=int(os.getenv("METRICS_PROMETHEUS_PORT", "9464")),
+            ))
+        else:
+            raise ValueError(f"Unknown metrics sink: {name!r} (expected log, prometheus_file or prometheus_http)")
+
+    interval = float(os.getenv("METRICS_FLUSH_INTERVAL", "60"))
+    if registry.sinks and interval > 0:
+        threading.Thread(
+            target=_flush_periodically, args=(registry, interval), name="metrics-flush", daemon=True
+        ).start()
+    return registry
+
+
+def stage_timer(stage, **labels):
+    """Shorthand for get_metrics().timer(stage, **labels)."""
+    return get_metrics().timer(stage, **labels)
+
+
+def record_payload(kind, size, **labels):
+    """Record the size in bytes of an image payload (original, sent, ...)."""
+    get_metrics().observe("payload_bytes", size, buckets=BYTES_BUCKETS, kind=kind, **labels)
+
+
+def record_cache(cache, hit):
+    """Count one cache lookup as a hit or a miss."""
+    get_metrics().inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def record_api_error(error_type):
+    """Count one Gemini API error, e.g. "http_429", "connection" or an exception name."""
+    get_metrics().inc("api_errors_total", type=error_type)
+
+
+def record_tokens(prompt_tokens=None, output_tokens=None, total_tokens=None):
+    """Add Gemini usage metadata to the token counters (missing values are skipped)."""
+    metrics = get_metrics()
+    for kind, value in (("prompt", prompt_tokens), ("output", output_tokens), ("total", total_tokens)):
+        if value:
+            metrics.inc("tokens_total", value, kind=kind)
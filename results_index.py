@@ -0,0 +1,441 @@
+"""Searchable store of past analyses and captions.
+
+Every analysis and caption the app, batch mode or the CLI produces can be
+recorded in a SQLite file (RESULTS_INDEX_PATH) and searched later instead of
+captioning the same work again. Images themselves are never stored; an image
+is identified by the SHA-256 of its bytes and, where known, its file name.
+
+    index = ResultsIndex("results.sqlite3")
+    index.add_many(records)
+    index.search("portrait, dark, vibrant blue, contains #travel")
+
+A query is a comma-separated list of terms (see parse_query()):
+
+* orientation, aspect, brightness, contrast and complexity levels, e.g.
+  "portrait", "panoramic", "dark", "high contrast", "minimalist"
+* "grayscale" / "color", "blurry" / "sharp"
+* dominant colors, by full name ("vibrant blue") or any shade of a hue ("blue")
+* hashtags ("#travel")
+* anything else is matched as words in the captions (FTS5)
+
+The level filters are indexed columns, colors and hashtags are indexed
+tables, and caption words go through an FTS5 index, so each term narrows the
+search with an index lookup rather than a scan; benchmark_results_index.py
+measures queries over hundreds of thousands of images.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from image_stats import BLUR_THRESHOLD
+
+# SQLite page cache per connection, in MB
+RESULTS_INDEX_CACHE_MB = int(os.getenv("RESULTS_INDEX_CACHE_MB", "64"))
+
+# One image's results; captions are (source, prompt, caption) tuples with
+# source "local" or "gemini"
+IndexRecord = namedtuple("IndexRecord", ["sha256", "name", "analysis", "captions"], defaults=(None, None, ()))
+
+SearchResult = namedtuple("SearchResult", [
+    "id", "sha256", "name", "width", "height", "orientation", "aspect_class",
+    "brightness_level", "complexity_level", "colors", "caption", "updated",
+])
+
+# Indexed columns a query term can filter on
+LEVEL_COLUMNS = ("orientation", "aspect_class", "brightness_level", "contrast_level", "complexity_level")
+
+QUERY_TERMS = {
+    "landscape": ("orientation", "Landscape"),
+    "portrait": ("orientation", "Portrait"),
+    "square": ("orientation", "Square"),
+    "panoramic": ("aspect_class", "Ultra-wide/Panoramic"),
+    "ultra-wide": ("aspect_class", "Ultra-wide/Panoramic"),
+    "wide": ("aspect_class", "Wide"),
+    "standard landscape": ("aspect_class", "Standard Landscape"),
+    "standard portrait": ("aspect_class", "Standard Portrait"),
+    "tall": ("aspect_class", "Tall Portrait"),
+    "tall portrait": ("aspect_class", "Tall Portrait"),
+    "ultra-tall": ("aspect_class", "Ultra-tall"),
+    "dark": ("brightness_level", "Dark"),
+    "bright": ("brightness_level", "Bright"),
+    "balanced": ("brightness_level", "Balanced"),
+    "low contrast": ("contrast_level", "Low"),
+    "medium contrast": ("contrast_level", "Medium"),
+    "high contrast": ("contrast_level", "High"),
+    "simple": ("complexity_level", "Simple/Minimalist"),
+    "minimalist": ("complexity_level", "Simple/Minimalist"),
+    "well-composed": ("complexity_level", "Well-Composed"),
+    "detailed": ("complexity_level", "Detailed/Complex"),
+    "complex": ("complexity_level", "Detailed/Complex"),
+    "grayscale": ("is_color", False),
+    "black and white": ("is_color", False),
+    "black & white": ("is_color", False),
+    "b&w": ("is_color", False),
+    "color": ("is_color", True),
+    "colour": ("is_color", True),
+    "blurry": ("blurry", True),
+    "sharp": ("blurry", False),
+}
+
+ANALYSIS_COLUMNS = (
+    "width", "height", "orientation", "aspect_class", "is_color", "brightness_level", "contrast_level",
+    "complexity_level", "brightness", "contrast", "edge_density", "laplacian_variance", "noise_sigma",
+    "analysis_version",
+)
+
+# A record without an analysis (analysis_version NULL) keeps the stored one
+UPSERT_IMAGE = (
+    f"INSERT INTO images (sha256, name, {', '.join(ANALYSIS_COLUMNS)}, updated) "
+    f"VALUES ({', '.join('?' * (len(ANALYSIS_COLUMNS) + 3))}) "
+    "ON CONFLICT (sha256) DO UPDATE SET name = coalesce(excluded.name, name), "
+    + ", ".join(
+        f"{column} = CASE WHEN excluded.analysis_version IS NULL THEN {column} ELSE excluded.{column} END"
+        for column in ANALYSIS_COLUMNS
+    )
+    + ", updated = excluded.updated RETURNING id"
+)
+
+HASHTAG = re.compile(r"#(\w+)")
+# Leading words that only make a term read naturally
+FILLER_WORDS = ("contains", "with", "has")
+
+
+def _color_vocabulary():
+    from color_engine import NAME_TABLE
+
+    names = {str(name).lower(): str(name) for name in NAME_TABLE}
+    hues = {name.split()[-1].lower(): name.split()[-1] for name in names.values()}
+    return names, hues
+
+
+COLOR_NAMES, COLOR_HUES = _color_vocabulary()
+
+
+def hashtags(text):
+    """Lower-cased hashtags in text, without the #."""
+    return {tag.lower() for tag in HASHTAG.findall(text or "")}
+
+
+def parse_query(query):
+    """Turn a comma-separated query into search() filters.
+
+    >>> parse_query("portrait, dark, vibrant blue, contains #travel")
+    {'colors': ['Vibrant Blue'], 'hues': [], 'hashtags': ['travel'], 'text': [],
+     'orientation': 'Portrait', 'brightness_level': 'Dark'}
+    """
+    filters = {"colors": [], "hues": [], "hashtags": [], "text": []}
+    for term in query.split(","):
+        term = " ".join(term.lower().split())
+        filters["hashtags"].extend(sorted(hashtags(term)))
+        term = HASHTAG.sub("", term).strip()
+        for word in FILLER_WORDS:
+            if term == word or term.startswith(word + " "):
+                term = term[len(word):].strip()
+        if not term:
+            continue
+        if term in QUERY_TERMS:
+            column, value = QUERY_TERMS[term]
+            filters[column] = value
+        elif term in COLOR_HUES:
+            # A bare hue ("blue") matches every shade of it
+            filters["hues"].append(COLOR_HUES[term])
+        elif term in COLOR_NAMES:
+            filters["colors"].append(COLOR_NAMES[term])
+        else:
+            filters["text"].append(term)
+    return filters
+
+
+def _fts_query(terms):
+    """FTS5 MATCH expression requiring every word of every term."""
+    words = [word for term in terms for word in re.findall(r"\w+", term)]
+    return " AND ".join('"' + word + '"' for word in words)
+
+
+def _analysis_row(analysis):
+    """ANALYSIS_COLUMNS values for an analyze_image_detailed() result (all None without one)."""
+    if analysis is None:
+        return (None,) * len(ANALYSIS_COLUMNS)
+    basic_info = analysis["basic_info"]
+    color_analysis = analysis["color_analysis"]
+    statistics = analysis.get("statistics") or {}
+    return (
+        basic_info.get("width"),
+        basic_info.get("height"),
+        basic_info.get("orientation"),
+        basic_info.get("aspect_class"),
+        int(bool(color_analysis.get("is_color"))),
+        color_analysis.get("brightness_level"),
+        color_analysis.get("contrast_level"),
+        analysis["complexity"]["level"],
+        color_analysis.get("brightness"),
+        color_analysis.get("contrast"),
+        analysis["complexity"]["edge_density"],
+        statistics.get("laplacian_variance"),
+        statistics.get("noise_sigma"),
+        analysis.get("version"),
+    )
+
+
+class ResultsIndex:
+    """SQLite store of analyses and captions with indexed search.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Hundreds of thousands of images make indexes far larger than the
+        # 2 MB default page cache
+        self._db.execute(f"PRAGMA cache_size=-{RESULTS_INDEX_CACHE_MB * 1024}")
+        # Colors, hues and hashtags carry a copy of images.updated, so a
+        # search driven by one of them can walk its index most recently
+        # indexed image first
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY,
+                sha256 TEXT NOT NULL UNIQUE,
+                name TEXT,
+                width INTEGER,
+                height INTEGER,
+                orientation TEXT,
+                aspect_class TEXT,
+                is_color INTEGER,
+                brightness_level TEXT,
+                contrast_level TEXT,
+                complexity_level TEXT,
+                brightness REAL,
+                contrast REAL,
+                edge_density REAL,
+                laplacian_variance REAL,
+                noise_sigma REAL,
+                analysis_version TEXT,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS images_orientation ON images (orientation);
+            CREATE INDEX IF NOT EXISTS images_aspect_class ON images (aspect_class);
+            CREATE INDEX IF NOT EXISTS images_brightness_level ON images (brightness_level);
+            CREATE INDEX IF NOT EXISTS images_contrast_level ON images (contrast_level);
+            CREATE INDEX IF NOT EXISTS images_complexity_level ON images (complexity_level);
+            CREATE INDEX IF NOT EXISTS images_updated ON images (updated);
+
+            CREATE TABLE IF NOT EXISTS image_colors (
+                image_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                percentage REAL NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (image_id, name)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS image_colors_name ON image_colors (name, updated, image_id);
+            -- One row per hue however many shades of it an image has
+            CREATE TABLE IF NOT EXISTS image_hues (
+                image_id INTEGER NOT NULL,
+                hue TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (image_id, hue)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS image_hues_hue ON image_hues (hue, updated, image_id);
+
+            CREATE TABLE IF NOT EXISTS captions (
+                id INTEGER PRIMARY KEY,
+                image_id INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                prompt TEXT,
+                caption TEXT NOT NULL,
+                created REAL NOT NULL,
+                UNIQUE (image_id, caption)
+            );
+            CREATE TABLE IF NOT EXISTS hashtags (
+                tag TEXT NOT NULL,
+                image_id INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (tag, image_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS hashtags_tag ON hashtags (tag, updated, image_id);
+            CREATE INDEX IF NOT EXISTS hashtags_image ON hashtags (image_id);
+
+            -- External-content FTS over the caption text, kept in sync by triggers
+            CREATE VIRTUAL TABLE IF NOT EXISTS captions_fts USING fts5(
+                caption, content='captions', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS captions_ai AFTER INSERT ON captions BEGIN
+                INSERT INTO captions_fts (rowid, caption) VALUES (new.id, new.caption);
+            END;
+            CREATE TRIGGER IF NOT EXISTS captions_ad AFTER DELETE ON captions BEGIN
+                INSERT INTO captions_fts (captions_fts, rowid, caption) VALUES ('delete', old.id, old.caption);
+            END;
+        """)
+        self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """Create an index from RESULTS_INDEX_PATH, or None if it is unset."""
+        path = os.getenv("RESULTS_INDEX_PATH")
+        return cls(path) if path else None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def add(self, image_bytes, name=None, analysis=None, captions=()):
+        """Record one image's analysis and/or captions."""
+        self.add_many([IndexRecord(hashlib.sha256(image_bytes).hexdigest(), name, analysis, captions)])
+
+    def add_many(self, records):
+        """Record many IndexRecords in one transaction.
+
+        An image seen before keeps its row: a new analysis replaces the old
+        one, a missing analysis or name leaves the stored one, and captions
+        are added unless the image already has the same text.
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                for record in records:
+                    self._add(record, now)
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+
+    def optimize(self):
+        """Refresh planner statistics and merge FTS segments; run after large ingests."""
+        with self._lock:
+            self._db.execute("ANALYZE")
+            self._db.execute("INSERT INTO captions_fts (captions_fts) VALUES ('optimize')")
+            self._db.commit()
+
+    def search(self, query="", limit=50, **filters):
+        """Find images matching a query string and/or explicit filters.
+
+        Args:
+            query: Comma-separated terms, see parse_query()
+            limit: Maximum results, most recently indexed image first
+            **filters: parse_query()-style filters, applied on top of query
+
+        Returns:
+            list: SearchResult per image, with its newest caption
+        """
+        merged = parse_query(query) if query else {"colors": [], "hues": [], "hashtags": [], "text": []}
+        for key, value in filters.items():
+            if isinstance(merged.get(key), list):
+                merged[key] = merged[key] + list(value)
+            else:
+                merged[key] = value
+
+        # Keyed filters, most selective kind first. The first one drives the
+        # query: its (key, updated, image_id) index is walked most recently
+        # indexed image first and stops after `limit` matches, while every
+        # other filter is a point lookup per candidate. Scanning a common tag
+        # or color therefore costs about `limit` rows, not every image that
+        # has it.
+        keyed = (
+            [("hashtags", "tag", tag.lower().lstrip("#")) for tag in merged["hashtags"]]
+            + [("image_colors", "name", name) for name in merged["colors"]]
+            + [("image_hues", "hue", hue) for hue in merged["hues"]]
+        )
+        where, params = [], []
+        if keyed:
+            table, column, value = keyed[0]
+            source = f"{table} d CROSS JOIN images i ON i.id = d.image_id"
+            order = "d.updated DESC, d.image_id DESC"
+            where.append(f"d.{column} = ?")
+            params.append(value)
+        else:
+            source = "images i"
+            order = "i.updated DESC, i.id DESC"
+        for table, column, value in keyed[1:]:
+            where.append(f"EXISTS (SELECT 1 FROM {table} WHERE {column} = ? AND image_id = i.id)")
+            params.append(value)
+
+        for column in LEVEL_COLUMNS:
+            if merged.get(column):
+                where.append(f"i.{column} = ?")
+                params.append(merged[column])
+        if merged.get("is_color") is not None:
+            where.append("i.is_color = ?")
+            params.append(int(merged["is_color"]))
+        if merged.get("blurry") is not None:
+            where.append("i.laplacian_variance < ?" if merged["blurry"] else "i.laplacian_variance >= ?")
+            params.append(BLUR_THRESHOLD)
+        text = _fts_query(merged["text"])
+        if text:
+            where.append(
+                "i.id IN (SELECT c.image_id FROM captions_fts JOIN captions c ON c.id = captions_fts.rowid "
+                "WHERE captions_fts MATCH ?)"
+            )
+            params.append(text)
+
+        sql = (
+            "SELECT i.id, i.sha256, i.name, i.width, i.height, i.orientation, i.aspect_class, "
+            "i.brightness_level, i.complexity_level, "
+            "(SELECT group_concat(name, ', ') FROM "
+            " (SELECT name FROM image_colors WHERE image_id = i.id ORDER BY percentage DESC)), "
+            "(SELECT caption FROM captions WHERE image_id = i.id ORDER BY created DESC, id DESC LIMIT 1), "
+            f"i.updated FROM {source}"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + f" ORDER BY {order} LIMIT ?"
+        )
+        with self._lock:
+            rows = self._db.execute(sql, params + [limit]).fetchall()
+        return [SearchResult(*row) for row in rows]
+
+    def captions(self, image_id):
+        """All (source, prompt, caption, created) of one image, newest first."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT source, prompt, caption, created FROM captions WHERE image_id = ? "
+                "ORDER BY created DESC, id DESC", (image_id,)
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _add(self, record, now):
+        """Upsert one record without committing; the caller holds the lock."""
+        analysis = record.analysis if record.analysis and "error" not in record.analysis else None
+        values = _analysis_row(analysis)
+        image_id = self._db.execute(UPSERT_IMAGE, (record.sha256, record.name, *values, now)).fetchone()[0]
+        # Re-indexing an image moves it to the front of every search
+        self._db.execute("UPDATE hashtags SET updated = ? WHERE image_id = ?", (now, image_id))
+
+        if analysis is not None:
+            colors = {}
+            for color in analysis["color_analysis"].get("dominant_colors") or []:
+                colors[color["name"]] = colors.get(color["name"], 0) + color["percentage"]
+            self._db.execute("DELETE FROM image_colors WHERE image_id = ?", (image_id,))
+            self._db.execute("DELETE FROM image_hues WHERE image_id = ?", (image_id,))
+            self._db.executemany(
+                "INSERT INTO image_colors (image_id, name, percentage, updated) VALUES (?, ?, ?, ?)",
+                [(image_id, name, percentage, now) for name, percentage in colors.items()],
+            )
+            self._db.executemany(
+                "INSERT INTO image_hues (image_id, hue, updated) VALUES (?, ?, ?)",
+                [(image_id, hue, now) for hue in {name.split()[-1] for name in colors}],
+            )
+        else:
+            self._db.execute("UPDATE image_colors SET updated = ? WHERE image_id = ?", (now, image_id))
+            self._db.execute("UPDATE image_hues SET updated = ? WHERE image_id = ?", (now, image_id))
+
+        for source, prompt, caption in record.captions:
+            if not caption:
+                continue
+            self._db.execute(
+                "INSERT OR IGNORE INTO captions (image_id, source, prompt, caption, created) VALUES (?, ?, ?, ?, ?)",
+                (image_id, source, prompt, caption, now),
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO hashtags (tag, image_id, updated) VALUES (?, ?, ?)",
+                [(tag, image_id, now) for tag in hashtags(caption)],
+            )
+
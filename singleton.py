@@ -0,0 +1,37 @@
+"""Process-wide singletons that are safe to build from concurrent sessions.
+
+Streamlit runs every browser session in its own thread of one process, so
+the first calls to a shared getter (metrics registry, caches, indexes, job
+queue, Gemini clients) can arrive at the same moment.
+"""
+
+import functools
+import threading
+
+
+def process_singleton(build):
+    """Cache build(*args) once per process, like functools.lru_cache(maxsize=None).
+
+    lru_cache does not stop concurrent first calls from each building their
+    own value, which would give sessions separate rate limits, model
+    registries or SQLite connections, or bind a port twice. Values are built
+    under a lock instead, with a lock-free lookup once they exist.
+
+    The getter's cache_clear() forgets built values, e.g. between tests.
+    """
+    instances = {}
+    lock = threading.Lock()
+
+    @functools.wraps(build)
+    def get(*args):
+        try:
+            return instances[args]
+        except KeyError:
+            pass
+        with lock:
+            if args not in instances:
+                instances[args] = build(*args)
+            return instances[args]
+
+    get.cache_clear = instances.clear
+    return get
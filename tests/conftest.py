@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_gemini_server import FakeGeminiConfig, FakeGeminiServer  # noqa: E402
+
+
+@pytest.fixture
+def fake_gemini():
+    """A running FakeGeminiServer with fast, fixed latency; tweak .config per test."""
+    with FakeGeminiServer(config=FakeGeminiConfig(latency=0.2, jitter=0.0, chunk_delay=0.0, seed=0)) as server:
+        yield server
@@ -0,0 +1,50 @@
+import json
+
+from analysis_cache import AnalysisCache, content_key
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AnalysisCache(max_entries=2)
+    cache.put("a", {"n": 1})
+    cache.put("b", {"n": 2})
+    assert cache.get("a") == {"n": 1}  # "b" is now least recently used
+    cache.put("c", {"n": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"n": 1}
+    assert cache.get("c") == {"n": 3}
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_tier_is_bounded_by_bytes():
+    value = {"data": "x" * 100}
+    size = len(json.dumps(value).encode("utf-8"))
+    cache = AnalysisCache(max_entries=100, max_bytes=2 * size)
+    for key in ("a", "b", "c"):
+        cache.put(key, value)
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] == 2 * size
+    assert cache.get("a") is None
+
+
+def test_evicted_entries_are_served_from_disk(tmp_path):
+    cache = AnalysisCache(max_entries=1, db_path=str(tmp_path / "analysis.db"))
+    cache.put("a", {"n": 1})
+    cache.put("b", {"n": 2})
+    assert cache.get("a") == {"n": 1}
+    stats = cache.stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (0, 1, 0)
+
+    # A new process finds results written by an earlier one
+    assert AnalysisCache(db_path=str(tmp_path / "analysis.db")).get("b") == {"n": 2}
+
+
+def test_hits_are_copies():
+    cache = AnalysisCache()
+    cache.put("a", {"colors": ["red"]})
+    cache.get("a")["colors"].append("blue")
+    assert cache.get("a") == {"colors": ["red"]}
+
+
+def test_key_changes_with_version():
+    assert content_key(b"image", "6") != content_key(b"image", "7")
+    assert content_key(b"image", "6") == content_key(b"image", "6")
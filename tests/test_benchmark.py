@@ -0,0 +1,38 @@
+from benchmark import compare_to_baseline
+
+
+def _case(calibration_s, local_s, peak_rss_mb=100.0):
+    return {
+        "calibration_s": calibration_s,
+        "local_s": local_s,
+        "peak_rss_mb": peak_rss_mb,
+        "relative": {"local_s": local_s / calibration_s},
+    }
+
+
+def test_flags_a_slowdown_relative_to_calibration():
+    baseline = {"2MP-PNG-flat": _case(0.05, 0.10)}
+
+    # Twice the time on a machine twice as slow is not a regression
+    assert compare_to_baseline({"2MP-PNG-flat": _case(0.10, 0.20)}, baseline, 0.25) == []
+
+    regressions = compare_to_baseline({"2MP-PNG-flat": _case(0.05, 0.15)}, baseline, 0.25)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("2MP-PNG-flat local_s:")
+    assert "+50%" in regressions[0]
+
+
+def test_flags_memory_growth_in_absolute_terms():
+    baseline = {"2MP-PNG-flat": _case(0.05, 0.10, peak_rss_mb=100)}
+    results = {"2MP-PNG-flat": _case(0.05, 0.10, peak_rss_mb=200)}
+    assert [line.split(":")[0] for line in compare_to_baseline(results, baseline, 0.25)] == [
+        "2MP-PNG-flat peak_rss_mb"
+    ]
+
+
+def test_reports_cases_missing_from_the_baseline():
+    baseline = {"2MP-PNG-flat": _case(0.05, 0.10)}
+    results = {"2MP-PNG-flat": _case(0.05, 0.10), "50MP-PNG-flat": _case(0.05, 2.0)}
+    assert compare_to_baseline(results, baseline, 0.25) == [
+        "50MP-PNG-flat: not in the baseline; record it with --save-baseline"
+    ]
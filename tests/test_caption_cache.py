@@ -0,0 +1,69 @@
+import pytest
+
+import caption_cache
+from caption_cache import CaptionCache, MemoryCaptionBackend, SQLiteCaptionBackend, caption_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(caption_cache, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryCaptionBackend()
+    return SQLiteCaptionBackend(str(tmp_path / "captions.db"))
+
+
+def test_entries_expire_after_the_ttl(backend, clock):
+    cache = CaptionCache(backend, ttl_seconds=60)
+    cache.put("key", "A caption")
+    clock.now += 59
+    assert cache.get("key") == "A caption"
+    clock.now += 1
+    assert cache.get("key") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 0}
+
+
+def test_oldest_entries_are_evicted_past_max_entries(backend, clock):
+    cache = CaptionCache(backend, max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.put(key, key.upper())
+        clock.now += 1
+    assert [cache.get(key) for key in ("a", "b", "c")] == [None, "B", "C"]
+
+    # Writing a key again makes it the newest
+    cache.put("b", "B2")
+    clock.now += 1
+    cache.put("d", "D")
+    assert [cache.get(key) for key in ("b", "c", "d")] == ["B2", None, "D"]
+
+
+def test_expired_entries_are_trimmed_before_live_ones(backend, clock):
+    cache = CaptionCache(backend, ttl_seconds=10, max_entries=2)
+    cache.put("old", "Old")
+    clock.now += 5
+    cache.put("new", "New")
+    clock.now += 6  # "old" expired, "new" still live
+    cache.put("newest", "Newest")
+    assert len(backend) == 2
+    assert cache.get("new") == "New"
+
+
+def test_key_covers_image_prompt_and_config():
+    base = caption_key(b"image", "prompt", {"temperature": 0.4})
+    assert caption_key(b"image", "prompt", {"temperature": 0.4}) == base
+    assert caption_key(b"other", "prompt", {"temperature": 0.4}) != base
+    assert caption_key(b"image", "other", {"temperature": 0.4}) != base
+    assert caption_key(b"image", "prompt", {"temperature": 0.5}) != base
@@ -0,0 +1,37 @@
+import hashlib
+import json
+
+from PIL import Image
+
+import caption_cli
+
+
+def _lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_matches_paths_from_another_working_directory(tmp_path, monkeypatch):
+    photos = tmp_path.resolve() / "photos"
+    photos.mkdir()
+    for name, color in [("a.png", "red"), ("b.png", "blue")]:
+        Image.new("RGB", (32, 24), color).save(photos / name)
+    output = tmp_path / "captions.jsonl"
+
+    monkeypatch.chdir(tmp_path)
+    assert caption_cli.main(["photos", "-o", str(output), "--workers", "1"]) == 0
+    first = _lines(output)
+    assert sorted(record["path"] for record in first) == [str(photos / "a.png"), str(photos / "b.png")]
+
+    # Same tree, spelled differently and from elsewhere: nothing left to do
+    monkeypatch.chdir(photos)
+    assert caption_cli.main([".", "-o", str(output), "--workers", "1", "--resume"]) == 0
+    assert _lines(output) == first
+
+
+def test_exact_mode_hashes_the_whole_file(tmp_path, monkeypatch):
+    path = tmp_path / "scan.tiff"
+    Image.new("RGB", (64, 48), "green").save(path)
+    monkeypatch.setattr(caption_cli, "HASH_CHUNK_BYTES", 1000)  # several chunks
+    record = caption_cli.caption_file_exact(str(path))
+    assert record["sha256"] == hashlib.sha256(path.read_bytes()).hexdigest()
@@ -0,0 +1,59 @@
+import hashlib
+import io
+
+import pytest
+from PIL import Image
+
+import captioning
+from gemini_async import AsyncGeminiEngine
+
+PROMPT = "Describe this image."
+
+
+def _gif(colors, duration=100):
+    frames = [Image.new("RGB", (64, 48), color) for color in colors]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def gemini_env(fake_gemini, monkeypatch, tmp_path):
+    """Async engine against the fake server, with fresh dedup and results indexes."""
+    monkeypatch.setenv("GOOGLE_GEMINI_API_KEY", "test-key")
+    monkeypatch.setenv("GEMINI_API_BASE", fake_gemini.base_url)
+    monkeypatch.setenv("DEDUP_INDEX_PATH", str(tmp_path / "dedup.db"))
+    monkeypatch.setenv("RESULTS_INDEX_PATH", str(tmp_path / "results.db"))
+    monkeypatch.setattr(captioning, "GEMINI_ENGINE", "async")
+    getters = [captioning.get_async_engine, captioning.get_caption_cache,
+               captioning.get_dedup_index, captioning.get_results_index]
+    for getter in getters:
+        getter.cache_clear()
+    yield fake_gemini
+    for getter in getters:
+        getter.cache_clear()
+
+
+def test_animation_caption_is_indexed_under_the_users_prompt(gemini_env, monkeypatch):
+    sent_prompts = []
+    caption_request = AsyncGeminiEngine.caption
+
+    def spy(self, prompt, *args, **kwargs):
+        sent_prompts.append(prompt)
+        return caption_request(self, prompt, *args, **kwargs)
+
+    monkeypatch.setattr(AsyncGeminiEngine, "caption", spy)
+    image_bytes = _gif(["red", "green", "blue"])
+    caption = captioning.caption_with_gemini(image_bytes, PROMPT)
+
+    # Gemini is told it is looking at keyframes...
+    assert sent_prompts == [PROMPT + captioning.ANIMATION_PROMPT_NOTE]
+    # ...but the caption is found again with the prompt the user typed,
+    # here for the same frames saved with a different timing
+    fingerprint = captioning.fingerprint_image(_gif(["red", "green", "blue"], duration=120))
+    assert captioning.find_near_duplicate_caption(fingerprint, PROMPT) == (caption, 0)
+    index = captioning.get_results_index()
+    [result] = index.search()
+    assert result.sha256 == hashlib.sha256(image_bytes).hexdigest()
+    stored = index.captions(result.id)
+    assert [(source, prompt, text) for source, prompt, text, _ in stored] == [("gemini", PROMPT, caption)]
@@ -0,0 +1,84 @@
+import colorsys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from color_engine import (
+    StreamingPalette, dominant_colors, dominant_colors_batch, image_pixels, name_colors, rgb_to_hsv,
+)
+
+
+def _scalar_name(r, g, b):
+    """The original per-pixel if/elif rules that name_colors() vectorizes."""
+    h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+    if s < 0.1:
+        return "Black" if v < 0.3 else "White" if v > 0.8 else "Gray"
+    if h < 0.05 or h > 0.95: name = "Red"
+    elif h < 0.15: name = "Orange"
+    elif h < 0.22: name = "Yellow"
+    elif h < 0.41: name = "Green"
+    elif h < 0.55: name = "Teal"
+    elif h < 0.75: name = "Blue"
+    elif h < 0.82: name = "Purple"
+    else: name = "Pink"
+    if s < 0.4: name = f"Pale {name}"
+    elif s > 0.8: name = f"Vibrant {name}"
+    if v < 0.4: name = f"Dark {name}"
+    return name
+
+
+def _random_colors(count=5000):
+    return np.random.default_rng(0).integers(0, 256, (count, 3))
+
+
+def test_rgb_to_hsv_matches_colorsys():
+    colors = _random_colors()
+    h, s, v = rgb_to_hsv(colors)
+    expected = np.array([colorsys.rgb_to_hsv(*(c / 255)) for c in colors])
+    np.testing.assert_allclose(np.stack([h, s, v], axis=1), expected, atol=1e-12)
+
+
+def test_names_match_the_scalar_rules():
+    colors = _random_colors()
+    assert name_colors(colors).tolist() == [_scalar_name(*c) for c in colors]
+
+
+def _blocks(*blocks, height=10):
+    """Image of solid vertical blocks given as (rgb, width) pairs."""
+    row = np.concatenate([np.tile(rgb, (width, 1)) for rgb, width in blocks])
+    return Image.fromarray(np.tile(row, (height, 1, 1)).astype(np.uint8))
+
+
+def test_dominant_colors_of_solid_blocks():
+    img = _blocks(((220, 30, 30), 60), ((30, 30, 220), 30), ((250, 250, 250), 10))
+    colors = dominant_colors(img, k=3)
+    assert [(c["name"], c["percentage"], c["rgb"]) for c in colors] == [
+        ("Vibrant Red", 60.0, [220, 30, 30]),
+        ("Vibrant Blue", 30.0, [30, 30, 220]),
+        ("White", 10.0, [250, 250, 250]),
+    ]
+
+
+@pytest.fixture
+def photo_like():
+    rng = np.random.default_rng(1)
+    ramp = np.add.outer(np.arange(90), np.arange(120))[..., None] * [1.5, 0.7, 0.3]
+    return Image.fromarray(np.clip(ramp + rng.normal(0, 20, (90, 120, 3)), 0, 255).astype(np.uint8))
+
+
+def test_batch_matches_single_images(photo_like):
+    other = photo_like.transpose(Image.Transpose.FLIP_LEFT_RIGHT).convert("L")
+    assert dominant_colors_batch([photo_like, other]) == [dominant_colors(photo_like), dominant_colors(other)]
+
+
+def test_streaming_palette_matches_the_whole_image(photo_like):
+    strips = [photo_like.crop((0, top, photo_like.width, min(top + 7, photo_like.height)))
+              for top in range(0, photo_like.height, 7)]
+    palette = StreamingPalette(photo_like.width * photo_like.height)
+    for strip in strips:
+        palette.sample(image_pixels(strip))
+    palette.fit()
+    for strip in strips:
+        palette.assign(image_pixels(strip))
+    assert palette.palette() == dominant_colors(photo_like)
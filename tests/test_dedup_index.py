@@ -0,0 +1,62 @@
+import io
+import random
+
+import pytest
+from PIL import Image, ImageFilter
+
+from dedup_index import Fingerprint, NearDuplicateIndex, image_fingerprint
+
+
+def _flip(image_hash, bits):
+    for bit in bits:
+        image_hash ^= 1 << bit
+    return image_hash
+
+
+@pytest.fixture(scope="module")
+def populated():
+    """Index of random hashes: most in the sorted tables, the last few pending."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(20000)]
+    # Clusters of near neighbors, so queries have several true matches
+    for center in hashes[:50]:
+        hashes.extend(_flip(center, rng.sample(range(64), rng.randint(1, 12))) for _ in range(4))
+    index = NearDuplicateIndex()
+    index.add_many(Fingerprint(f"{i:064x}", h) for i, h in enumerate(hashes[:-100]))
+    index.find(0)  # build the sorted tables
+    for i, h in enumerate(hashes[-100:], start=len(hashes) - 100):
+        index.add(Fingerprint(f"{i:064x}", h))
+    return index, hashes
+
+
+@pytest.mark.parametrize("radius", [0, 3, 4, 7, 8, 11, 12])
+def test_finds_every_hash_within_the_radius(populated, radius):
+    index, hashes = populated
+    rng = random.Random(radius)
+    for center in rng.sample(hashes, 30) + hashes[:20] + hashes[-20:]:
+        query = _flip(center, rng.sample(range(64), radius))
+        expected = {i: (h ^ query).bit_count() for i, h in enumerate(hashes) if (h ^ query).bit_count() <= radius}
+        matches = index.find(query, max_distance=radius, limit=len(hashes))
+        assert {int(m.sha256, 16): m.distance for m in matches} == expected
+        assert [m.distance for m in matches] == sorted(m.distance for m in matches)
+
+
+def _jpeg(img, quality=90):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def test_recompressed_and_resized_copies_match():
+    rng = random.Random(1)
+    img = Image.new("RGB", (320, 240))
+    img.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(320 * 240)])
+    img = img.filter(ImageFilter.GaussianBlur(8))
+
+    index = NearDuplicateIndex(max_distance=6)
+    original = image_fingerprint(_jpeg(img))
+    index.add(original)
+    for copy in (_jpeg(img, quality=60), _jpeg(img.resize((160, 120)))):
+        [match] = index.find(image_fingerprint(copy).hash)
+        assert match.sha256 == original.sha256
+        assert match.distance <= 6
@@ -0,0 +1,152 @@
+"""AsyncGeminiEngine and the captioning entry points against FakeGeminiServer."""
+
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import captioning
+from gemini_async import AsyncGeminiEngine, GeminiAPIError
+from gemini_client import GeminiModelUnavailable
+
+PROMPT = "Describe this image."
+CONFIG = dict(captioning.GEMINI_GENERATION_CONFIG)
+
+
+def _png(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _engine(server, **kwargs):
+    kwargs.setdefault("models", ["gemini-test"])
+    kwargs.setdefault("base_delay", 0.01)
+    return AsyncGeminiEngine("test-key", base_url=server.base_url, **kwargs)
+
+
+def _concurrently(count, call):
+    """Run call() from count threads released at the same moment; return the results."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        barrier.wait()
+        results[i] = call()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_caption_round_trip(fake_gemini):
+    engine = _engine(fake_gemini)
+    caption = engine.caption(PROMPT, _png("red"), "image/png", CONFIG, [])
+    assert caption.startswith("A fake caption for image")
+    assert fake_gemini.counters["requests"] == 1
+    assert engine.counters == {"requests": 1, "retries": 0, "coalesced": 0, "errors": 0}
+
+
+def test_identical_requests_are_coalesced(fake_gemini):
+    engine = _engine(fake_gemini)
+    payload = _png("green")
+    captions = _concurrently(8, lambda: engine.caption(PROMPT, payload, "image/png", CONFIG, [], key="same"))
+    assert len(set(captions)) == 1
+    assert fake_gemini.counters["requests"] == 1
+    assert engine.counters["coalesced"] == 7
+
+
+def test_concurrent_cold_start_shares_one_engine(fake_gemini, monkeypatch):
+    monkeypatch.setenv("GOOGLE_GEMINI_API_KEY", "test-key")
+    monkeypatch.setenv("GEMINI_API_BASE", fake_gemini.base_url)
+    monkeypatch.setattr(captioning, "GEMINI_ENGINE", "async")
+    # A slow first build (e.g. importing the HTTP stack) widens the window
+    # in which concurrent sessions could each construct an engine
+    from_env = AsyncGeminiEngine.from_env.__func__
+
+    def slow_from_env(cls, api_key):
+        time.sleep(0.1)
+        return from_env(cls, api_key)
+
+    monkeypatch.setattr(AsyncGeminiEngine, "from_env", classmethod(slow_from_env))
+    captioning.get_async_engine.cache_clear()
+    captioning.get_caption_cache.cache_clear()
+    try:
+        image_bytes = _png("blue")
+        captions = _concurrently(10, lambda: captioning.caption_with_gemini(image_bytes))
+        assert len(set(captions)) == 1
+        assert fake_gemini.counters["requests"] == 1
+        assert captioning.get_async_engine("test-key").counters["coalesced"] == 9
+    finally:
+        captioning.get_async_engine.cache_clear()
+        captioning.get_caption_cache.cache_clear()
+
+
+def test_rate_limited_request_is_retried(fake_gemini):
+    # With seed 3 the first request rolls a 429 and the second succeeds
+    fake_gemini.config = type(fake_gemini.config)(latency=0.0, jitter=0.0, rate_limit_rate=0.5, seed=3)
+    engine = _engine(fake_gemini)
+    caption = engine.caption(PROMPT, _png("white"), "image/png", CONFIG, [])
+    assert caption.startswith("A fake caption for image")
+    assert fake_gemini.counters["status_429"] == 1
+    assert fake_gemini.counters["status_200"] == 1
+    assert engine.counters["retries"] == 1
+
+
+def test_server_errors_give_up_after_max_retries(fake_gemini):
+    fake_gemini.config.error_rate = 1.0
+    fake_gemini.config.latency = 0.0
+    engine = _engine(fake_gemini, max_retries=2)
+    with pytest.raises(GeminiAPIError) as excinfo:
+        engine.caption(PROMPT, _png("black"), "image/png", CONFIG, [])
+    assert excinfo.value.status == 500
+    assert fake_gemini.counters["status_500"] == 3
+    assert engine.counters["retries"] == 2
+    assert engine.counters["errors"] == 1
+
+
+def test_unknown_models_fall_back_to_the_next_candidate(fake_gemini):
+    fake_gemini.config.models = ["gemini-served"]
+    engine = _engine(fake_gemini, models=["gemini-missing", "gemini-served"])
+    engine.caption(PROMPT, _png("gray"), "image/png", CONFIG, [])
+    assert engine.model_name == "gemini-served"
+    assert fake_gemini.counters["status_404"] == 1
+
+    fake_gemini.config.models = []
+    with pytest.raises(GeminiModelUnavailable):
+        engine.caption(PROMPT, _png("gray"), "image/png", CONFIG, [])
+
+
+def test_stream_yields_the_full_caption(fake_gemini):
+    engine = _engine(fake_gemini)
+    payload = _png("yellow")
+    chunks = list(engine.stream(PROMPT, payload, "image/png", CONFIG, []))
+    assert len(chunks) > 1
+    assert "".join(chunks).strip() == engine.caption(PROMPT, payload, "image/png", CONFIG, [])
+
+
+def test_concurrent_requests_reuse_pooled_connections(fake_gemini, caplog):
+    # More requests in flight than requests' default pool of 10 connections
+    engine = _engine(fake_gemini, max_concurrency=16)
+    payloads = [_png((i, 0, 0)) for i in range(16)]
+    calls = iter(range(16))
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            i = next(calls)
+        return engine.caption(PROMPT, payloads[i], "image/png", CONFIG, [])
+
+    started = time.perf_counter()
+    captions = _concurrently(16, call)
+    elapsed = time.perf_counter() - started
+
+    assert len(set(captions)) == 16
+    assert "Connection pool is full" not in caplog.text
+    # All 16 overlap rather than queueing behind a few executor threads
+    assert elapsed < 3 * fake_gemini.config.latency
@@ -0,0 +1,62 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_analysis
+from image_analysis import analyze_image_detailed, analyze_image_tiled
+
+
+def _encode(img, format="PNG"):
+    buffer = io.BytesIO()
+    img.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def test_cache_write_failure_still_returns_the_analysis(monkeypatch, caplog):
+    class BrokenCache:
+        def get(self, key):
+            return None
+
+        def put(self, key, value):
+            raise OSError("disk full")
+
+    monkeypatch.setattr(image_analysis, "get_analysis_cache", BrokenCache)
+    analysis = analyze_image_detailed(_encode(Image.new("RGB", (64, 48), (200, 30, 30))))
+
+    assert "error" not in analysis
+    assert analysis["basic_info"]["width"] == 64
+    assert "Could not store the analysis" in caplog.text
+
+
+def _test_image(mode, width=173, height=131):
+    """Gradient plus noise, with a noisy alpha channel for RGBA."""
+    rng = np.random.default_rng(0)
+    ramp = np.add.outer(np.arange(height), np.arange(width))[..., None] * [1.0, 0.5, 2.0]
+    pixels = np.clip(ramp % 256 + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels).convert(mode)
+    if mode == "RGBA":
+        img.putalpha(Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8)))
+    return img
+
+
+@pytest.mark.parametrize("file_format", ["TIFF", "PNG"])  # read in strips / decoded in full
+@pytest.mark.parametrize("mode", ["RGB", "L", "RGBA"])
+def test_tiled_analysis_matches_full_resolution(tmp_path, mode, file_format):
+    img = _test_image(mode)
+    path = tmp_path / f"image.{file_format.lower()}"
+    img.save(path, format=file_format)
+    # 10-row strips: 131 rows leave a short last strip
+    tiled = analyze_image_tiled(str(path), tile_pixels=img.width * 10)
+    full = analyze_image_detailed(path.read_bytes(), use_cache=False, max_edge=0)
+
+    assert "error" not in tiled
+    # Grayscale images have no dominant colors
+    tiled_colors = tiled["color_analysis"].pop("dominant_colors", [])
+    full_colors = full["color_analysis"].pop("dominant_colors", [])
+    assert tiled == full
+    # Equal barring a float tie in assigning a pixel, see analyze_image_tiled()
+    assert [c["name"] for c in tiled_colors] == [c["name"] for c in full_colors]
+    for tiled_color, full_color in zip(tiled_colors, full_colors):
+        assert tiled_color["percentage"] == pytest.approx(full_color["percentage"], abs=0.1)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from image_stats import BLUR_THRESHOLD, ImageStats, StatsAccumulator, compute_image_stats
+
+
+def _gray(pixels):
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode="L")
+
+
+def _checkerboard(size=256, square=8):
+    y, x = np.indices((size, size))
+    return _gray(((x // square + y // square) % 2) * 200 + 28)
+
+
+def test_flat_image_has_no_blur_response_or_noise():
+    stats = compute_image_stats(Image.new("L", (64, 48), 128))
+    assert stats.laplacian_variance == 0
+    assert stats.noise_sigma == 0
+    assert stats.is_blurry
+
+
+def test_blur_lowers_laplacian_variance():
+    sharp = _checkerboard()
+    soft = sharp.filter(ImageFilter.GaussianBlur(3))
+    sharp_stats, soft_stats = compute_image_stats(sharp), compute_image_stats(soft)
+    assert not sharp_stats.is_blurry
+    assert soft_stats.is_blurry
+    assert soft_stats.laplacian_variance < BLUR_THRESHOLD < sharp_stats.laplacian_variance
+
+
+def test_laplacian_variance_matches_a_direct_computation():
+    img = _checkerboard().filter(ImageFilter.GaussianBlur(1))
+    p = np.asarray(img, dtype=np.float64)
+    laplacian = p[:-2, 1:-1] + p[2:, 1:-1] + p[1:-1, :-2] + p[1:-1, 2:] - 4 * p[1:-1, 1:-1]
+    assert compute_image_stats(img).laplacian_variance == pytest.approx(laplacian.var(), abs=1e-3)
+
+
+@pytest.mark.parametrize("sigma", [2, 5, 10, 20])
+def test_noise_sigma_estimates_added_gaussian_noise(sigma):
+    rng = np.random.default_rng(sigma)
+    # A smooth ramp: structure the estimator must ignore
+    ramp = np.add.outer(np.linspace(60, 190, 400), np.linspace(0, 20, 400))
+    stats = compute_image_stats(_gray(ramp + rng.normal(0, sigma, ramp.shape)))
+    assert stats.noise_sigma == pytest.approx(sigma, rel=0.1)
+
+
+def test_edge_density_matches_pillow_find_edges():
+    img = _checkerboard().filter(ImageFilter.GaussianBlur(1))
+    expected = np.asarray(img.filter(ImageFilter.FIND_EDGES), dtype=np.float64).mean()
+    assert compute_image_stats(img).edge_density == pytest.approx(expected, abs=1e-3)
+
+
+def test_strips_give_the_same_result_as_the_whole_image():
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (101, 67, 3), dtype=np.uint8))
+    accumulator = StatsAccumulator()
+    for top in range(0, img.height, 10):
+        accumulator.add(img.crop((0, top, img.width, min(top + 10, img.height))))
+    assert accumulator.result() == compute_image_stats(img)
+
+
+def test_round_trips_through_a_dict():
+    stats = compute_image_stats(_checkerboard().convert("RGB"))
+    assert ImageStats.from_dict(stats.to_dict()) == stats
@@ -0,0 +1,151 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+import job_queue
+from job_queue import JobQueue, run_worker, supervise
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "jobs.db")
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(queue_path):
+    queue = JobQueue(queue_path, lease_seconds=0.2)
+    job_id = queue.submit("analysis", b"image", owner="tester")
+
+    job, data = queue.claim("worker-a")
+    assert (job.id, job.attempts, data) == (job_id, 1, b"image")
+    assert queue.claim("worker-b") is None  # leased to worker-a
+
+    time.sleep(0.3)
+    job, data = queue.claim("worker-b")
+    assert (job.id, job.attempts, data) == (job_id, 2, b"image")
+
+    # worker-a lost the lease, so its late result is ignored
+    assert not queue.heartbeat(job_id, "worker-a")
+    assert not queue.complete(job_id, "worker-a", {"report": "stale"})
+    assert queue.complete(job_id, "worker-b", {"report": "fresh"})
+    assert queue.get(job_id).result == {"report": "fresh"}
+    queue.close()
+
+
+def test_heartbeat_keeps_the_lease(queue_path):
+    queue = JobQueue(queue_path, lease_seconds=0.3)
+    job_id = queue.submit("analysis", b"image")
+    queue.claim("worker-a")
+    for _ in range(3):
+        time.sleep(0.15)
+        assert queue.heartbeat(job_id, "worker-a")
+    assert queue.claim("worker-b") is None
+    queue.close()
+
+
+def test_job_fails_after_max_attempts(queue_path):
+    queue = JobQueue(queue_path, lease_seconds=0.1, max_attempts=2)
+    job_id = queue.submit("analysis", b"image")
+    for attempt in (1, 2):
+        job, _ = queue.claim(f"worker-{attempt}")
+        assert job.attempts == attempt
+        time.sleep(0.15)
+
+    assert queue.claim("worker-3") is None
+    job = queue.get(job_id)
+    assert job.status == "failed"
+    assert job.attempts == 2
+    assert job.error == "The worker stopped while running this job 2 times"
+    assert queue.counts() == {"failed": 1}
+    queue.close()
+
+
+def test_concurrent_claims_never_share_a_job(queue_path):
+    JobQueue(queue_path).close()
+    submitter = JobQueue(queue_path)
+    job_ids = {submitter.submit("analysis", bytes([i])) for i in range(40)}
+
+    barrier = threading.Barrier(8)
+    claimed = []
+
+    def claim_all(worker):
+        queue = JobQueue(queue_path)  # own connection, like a worker process
+        barrier.wait()
+        while (item := queue.claim(worker)) is not None:
+            claimed.append(item[0].id)
+        queue.close()
+
+    threads = [threading.Thread(target=claim_all, args=(f"worker-{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(job_ids)
+    assert submitter.counts() == {"running": 40}
+    submitter.close()
+
+
+def test_worker_records_results_and_errors(queue_path, monkeypatch):
+    def handler(image_bytes, params):
+        if params.get("explode"):
+            raise RuntimeError("boom")
+        return {"size": len(image_bytes)}
+
+    monkeypatch.setitem(job_queue.JOB_HANDLERS, "test", handler)
+    queue = JobQueue(queue_path)
+    ok = queue.submit("test", b"12345")
+    bad = queue.submit("test", b"image", params={"explode": True})
+
+    run_worker(queue_path, poll_interval=0.01, max_jobs=2)
+
+    assert queue.get(ok).status == "done"
+    assert queue.get(ok).result == {"size": 5}
+    assert queue.get(bad).status == "failed"
+    assert queue.get(bad).error == "boom"
+    queue.close()
+
+
+def test_submit_rejects_unknown_kind(queue_path):
+    queue = JobQueue(queue_path)
+    with pytest.raises(ValueError, match="Unknown job kind"):
+        queue.submit("nope", b"image")
+    queue.close()
+
+
+def _workers():
+    return {p.name: p for p in multiprocessing.active_children() if p.name.startswith("job-worker-")}
+
+
+def _wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError("timed out")
+
+
+def test_supervisor_restarts_dead_workers(queue_path):
+    JobQueue(queue_path).close()
+    stop = threading.Event()
+    thread = threading.Thread(target=supervise, args=(queue_path, 2, 0.05), kwargs={"stop": stop})
+    thread.start()
+    try:
+        workers = _wait_for(lambda: len(_workers()) == 2 and _workers())
+        victim = workers["job-worker-0"]
+        victim.kill()
+        victim.join()
+
+        def restarted():
+            worker = _workers().get("job-worker-0")
+            return worker is not None and worker.pid != victim.pid and worker.is_alive()
+
+        _wait_for(restarted)
+        assert _workers()["job-worker-1"].pid == workers["job-worker-1"].pid
+    finally:
+        stop.set()
+        thread.join()
+    assert not _workers()
@@ -0,0 +1,55 @@
+"""Metrics registry setup."""
+
+import socket
+import threading
+import time
+
+import metrics
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_concurrent_first_calls_build_one_registry(monkeypatch):
+    built = []
+
+    class CountingSink(metrics.PrometheusHTTPSink):
+        def __init__(self, *args, **kwargs):
+            # Slow enough that racing first calls overlap
+            time.sleep(0.1)
+            super().__init__(*args, **kwargs)
+            built.append(self)
+
+    monkeypatch.setenv("METRICS_SINKS", "prometheus_http")
+    monkeypatch.setenv("METRICS_PROMETHEUS_PORT", str(_free_port()))
+    monkeypatch.setenv("METRICS_FLUSH_INTERVAL", "0")
+    monkeypatch.setattr(metrics, "PrometheusHTTPSink", CountingSink)
+    metrics.get_metrics.cache_clear()
+    try:
+        barrier = threading.Barrier(8)
+        registries, errors = [], []
+
+        def first_call():
+            barrier.wait()
+            try:
+                registries.append(metrics.get_metrics())
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=first_call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert len(built) == 1
+        assert len({id(registry) for registry in registries}) == 1
+    finally:
+        for sink in built:
+            sink.server.shutdown()
+            sink.server.server_close()
+        metrics.get_metrics.cache_clear()
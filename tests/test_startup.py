@@ -0,0 +1,8 @@
+"""Cold-start guard: heavy Gemini dependencies must load lazily."""
+
+from benchmark_startup import LAZY_MODULES, STARTUP_MODULES, measure
+
+
+def test_startup_modules_do_not_import_lazy_dependencies():
+    imported = {name for name, _, _, _ in measure(STARTUP_MODULES)}
+    assert [name for name in LAZY_MODULES if name in imported] == []
@@ -0,0 +1,58 @@
+import io
+
+import pytest
+from PIL import Image
+
+import uploads
+from uploads import ImageUpload, UploadRejected, open_image
+
+
+def _png(width, height, mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, (width, height)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_byte_ceiling():
+    data = _png(64, 48)
+    assert open_image(data, max_bytes=len(data)).size == (64, 48)
+    with pytest.raises(UploadRejected, match="upload limit"):
+        open_image(data, max_bytes=len(data) - 1)
+    assert open_image(data, max_bytes=0).size == (64, 48)
+
+
+def test_pixel_ceiling_is_checked_from_the_header(monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_MAX_PIXELS", 1000)
+    data = _png(40, 30)  # 1200 pixels
+    with pytest.raises(UploadRejected, match=r"40 × 30 .* limit"):
+        open_image(data)
+    with pytest.raises(UploadRejected):
+        ImageUpload(data)
+
+    # A caller may set a ceiling above the upload limit, or none at all
+    img = open_image(data, max_pixels=1200)
+    assert img.size == (40, 30)
+    assert img.tile  # header only, nothing decoded yet
+    assert open_image(data, max_pixels=0).size == (40, 30)
+
+
+def test_pixel_ceiling_applies_to_paths(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(_png(40, 30))
+    with pytest.raises(UploadRejected):
+        open_image(str(path), max_pixels=1000)
+    assert open_image(str(path), max_pixels=1200).size == (40, 30)
+
+
+def test_unreadable_data_is_rejected():
+    with pytest.raises(UploadRejected, match="not a readable"):
+        open_image(b"not an image")
+
+
+def test_preview_is_cached_per_edge():
+    upload = ImageUpload(_png(400, 300), working_edge=0)
+    small = upload.preview(max_edge=100)
+    large = upload.preview(max_edge=200)
+    assert Image.open(io.BytesIO(small)).size == (100, 75)
+    assert Image.open(io.BytesIO(large)).size == (200, 150)
+    assert upload.preview(max_edge=100) is small
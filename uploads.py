@@ -0,0 +1,245 @@
+"""Bounded-memory handling of uploaded images.
+
+An ImageUpload wraps the uploaded bytes and decodes them at most once, into
+a working image no larger than UPLOAD_WORKING_EDGE on its longest edge. The
+on-screen preview, local analysis and the Gemini upload all use that one
+working image instead of decoding the file again each (the preview used to
+decode every upload at full resolution, on every rerun).
+
+Uploads are checked against byte and pixel ceilings using only the image
+header, before any pixel data is decoded, and refused with UploadRejected:
+
+    UPLOAD_MAX_BYTES     largest accepted file (default 50 MB)
+    UPLOAD_MAX_PIXELS    largest accepted width x height (default 100 MP)
+    UPLOAD_WORKING_EDGE  longest edge of the shared working image (default 2048)
+    UPLOAD_PREVIEW_EDGE  longest edge of the on-screen preview (default 1280)
+
+The uploaded bytes are never copied: Streamlit's UploadedFile.getvalue() and
+io.BytesIO over a bytes object share one buffer. (UploadedFile.getbuffer()
+would return a memoryview, but CPython copies the buffer to export it.)
+
+Memory held by an upload is charged to a MemoryLedger, one per session,
+which tracks the current total and its peak. The peak includes the decode
+buffer needed while the working image is produced, estimated from the
+header; Pillow allocates pixel memory outside the Python heap, so it can't
+be measured directly per session.
+"""
+
+import io
+import os
+import threading
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from animation import is_animated
+from metrics import BYTES_BUCKETS, get_metrics, stage_timer
+
+load_dotenv()
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", "100000000"))
+UPLOAD_WORKING_EDGE = int(os.getenv("UPLOAD_WORKING_EDGE", "2048"))
+UPLOAD_PREVIEW_EDGE = int(os.getenv("UPLOAD_PREVIEW_EDGE", "1280"))
+
+# Pillow's own decompression-bomb check is off: open_image() applies each
+# caller's ceiling to the header itself, and some (tiled analysis) are far
+# above the upload limit. Every image the app decodes goes through it.
+Image.MAX_IMAGE_PIXELS = None
+
+# Bytes per pixel of the decoded image, by mode
+_MODE_BYTES = {"1": 1, "L": 1, "P": 1, "LA": 2, "I;16": 2, "RGB": 3, "YCbCr": 3, "LAB": 3, "HSV": 3}
+
+
+class UploadRejected(ValueError):
+    """The upload is too large or not a readable image; the message says why."""
+
+
+def _format_bytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+def image_memory(img):
+    """Approximate size in bytes of an image's decoded pixel data."""
+    return img.width * img.height * _MODE_BYTES.get(img.mode, 4)
+
+
+def estimate_decode_memory(img, max_edge):
+    """Peak pixel memory of decoding img down to max_edge with thumbnail().
+
+    JPEG draft mode lets the decoder skip DCT scales (1/2, 1/4, 1/8) while
+    staying at least twice max_edge; other formats decode at full size.
+    """
+    scale = 1
+    if max_edge and img.format == "JPEG":
+        target = 2 * max_edge
+        fit = min(img.width // target, img.height // target)
+        scale = next((s for s in (8, 4, 2) if fit >= s), 1)
+    return -(-img.width // scale) * -(-img.height // scale) * _MODE_BYTES.get(img.mode, 4)
+
+
+def open_image(data, max_bytes=None, max_pixels=None):
+    """Open an encoded image after checking it against the upload ceilings.
+
+    Only the header is parsed, so nothing large is allocated for a file
+    that is then rejected.
+
+    Args:
+        data: The encoded image bytes, or the path of an image file
+        max_bytes: Byte ceiling, defaults to UPLOAD_MAX_BYTES (0 disables)
+        max_pixels: Pixel ceiling, defaults to UPLOAD_MAX_PIXELS (0 disables)
+
+    Returns:
+        PIL.Image.Image: The lazily-decoded image
+
+    Raises:
+        UploadRejected: If a ceiling is exceeded or the data isn't an image
+    """
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    max_pixels = UPLOAD_MAX_PIXELS if max_pixels is None else max_pixels
+
+    is_path = isinstance(data, (str, os.PathLike))
+    size = os.path.getsize(data) if is_path else len(data)
+    if max_bytes and size > max_bytes:
+        get_metrics().inc("uploads_rejected_total", reason="bytes")
+        raise UploadRejected(
+            f"The file is {_format_bytes(size)}, above the {_format_bytes(max_bytes)} upload limit."
+        )
+    try:
+        img = Image.open(data if is_path else io.BytesIO(data))
+    except (OSError, ValueError) as e:
+        get_metrics().inc("uploads_rejected_total", reason="unreadable")
+        raise UploadRejected("The file is not a readable JPEG, PNG, GIF or WebP image.") from e
+
+    pixels = img.width * img.height
+    if max_pixels and pixels > max_pixels:
+        get_metrics().inc("uploads_rejected_total", reason="pixels")
+        raise UploadRejected(
+            f"The image is {img.width} × {img.height} ({pixels / 1e6:.0f} MP), "
+            f"above the {max_pixels / 1e6:.0f} MP limit."
+        )
+    return img
+
+
+class MemoryLedger:
+    """Running total and peak of the bytes held by one session's uploads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def allocate(self, size):
+        with self._lock:
+            self.current += size
+            self.peak = max(self.peak, self.current)
+
+    def release(self, size):
+        with self._lock:
+            self.current = max(0, self.current - size)
+
+
+class ImageUpload:
+    """One uploaded image: its bytes, header and a single shared working image.
+
+    The working image is shared by every consumer and must not be modified
+    in place; use fit() for a resized copy.
+    """
+
+    def __init__(self, data, max_bytes=None, max_pixels=None, working_edge=None, ledger=None):
+        self.image = open_image(data, max_bytes, max_pixels)
+        self.data = data
+        self.size = self.image.size
+        self.format = self.image.format
+        self.mode = self.image.mode
+        # The working image (and preview) is the first frame of an animation
+        self.animated = is_animated(self.image)
+        self.frame_count = getattr(self.image, "n_frames", 1)
+        self.working_edge = UPLOAD_WORKING_EDGE if working_edge is None else working_edge
+        self.ledger = ledger
+        self._working = None
+        self._previews = {}
+        self._charged = len(data)
+        if ledger is not None:
+            ledger.allocate(len(data))
+
+    @property
+    def downscaled(self):
+        """Whether the working image is smaller than the original."""
+        return bool(self.working_edge) and max(self.size) > self.working_edge
+
+    def working_image(self):
+        """Decode (once) and return the shared working image."""
+        if self._working is None:
+            transient = estimate_decode_memory(self.image, self.working_edge if self.downscaled else 0)
+            if self.ledger is not None:
+                self.ledger.allocate(transient)
+            try:
+                with stage_timer("decode", pipeline="upload"):
+                    if self.downscaled:
+                        self.image.thumbnail((self.working_edge, self.working_edge), reducing_gap=2.0)
+                    else:
+                        self.image.load()
+                self._working = self.image
+                # Charged before the decode buffer is released: both are live at the peak
+                self._charge(image_memory(self._working))
+            finally:
+                if self.ledger is not None:
+                    self.ledger.release(transient)
+            get_metrics().observe("upload_memory_bytes", self._charged, buckets=BYTES_BUCKETS)
+        return self._working
+
+    def can_serve(self, max_edge):
+        """Whether the working image is detailed enough to stand in for a
+        decode limited to max_edge (0 meaning full resolution)."""
+        return not self.downscaled or bool(max_edge) and max_edge <= self.working_edge
+
+    def fit(self, max_edge):
+        """The working image, or a copy shrunk to max_edge if it is larger."""
+        img = self.working_image()
+        if not max_edge or max(img.size) <= max_edge:
+            return img
+        resized = img.copy()
+        resized.thumbnail((max_edge, max_edge), reducing_gap=2.0)
+        return resized
+
+    def preview(self, max_edge=None):
+        """Encoded (once) on-screen preview, at most max_edge on its longest edge.
+
+        Streamlit re-encodes a PIL image passed to st.image on every rerun;
+        bytes are served as they are, so the preview costs nothing after the
+        first render. Each max_edge is encoded and kept separately.
+
+        Args:
+            max_edge: Longest edge in pixels, defaults to UPLOAD_PREVIEW_EDGE
+
+        Returns:
+            bytes: JPEG, or PNG if the image has transparency
+        """
+        max_edge = UPLOAD_PREVIEW_EDGE if max_edge is None else max_edge
+        preview = self._previews.get(max_edge)
+        if preview is None:
+            with stage_timer("preview", pipeline="upload"):
+                img = self.fit(max_edge)
+                buffer = io.BytesIO()
+                if img.mode in ("RGBA", "LA", "P"):
+                    img.save(buffer, format="PNG")
+                else:
+                    img.convert("RGB").save(buffer, format="JPEG", quality=85)
+                preview = self._previews[max_edge] = buffer.getvalue()
+            self._charge(len(preview))
+        return preview
+
+    def _charge(self, size):
+        self._charged += size
+        if self.ledger is not None:
+            self.ledger.allocate(size)
+
+    def release(self):
+        """Drop the working image and return this upload's bytes to the ledger."""
+        self._working = None
+        self._previews = {}
+        self.image = None
+        if self.ledger is not None:
+            self.ledger.release(self._charged)
+        self._charged = 0